@@ -341,22 +341,22 @@ void mqtt_loop() {
 
   // Update system
   if (updateSystem()) {
-    client.publish((stateTopic + "/system").c_str(), getSystemState().c_str());
+    client.publish((stateTopic + "/system").c_str(), getSystemState().c_str(), true);
   }
 
   // Update audio
   if (updateAudio() || audioPlayerStateChanged()) {
-    client.publish((stateTopic + "/audio").c_str(), getAudioState().c_str());
+    client.publish((stateTopic + "/audio").c_str(), getAudioState().c_str(), true);
   }
 
   // Update lights
   if (updateLights()) {
-    client.publish((stateTopic + "/light").c_str(), getLightState().c_str());
+    client.publish((stateTopic + "/light").c_str(), getLightState().c_str(), true);
   }
 
   // Update presence
   if (updatePresence()) {
-    client.publish((stateTopic + "/presence").c_str(), getPresenceState().c_str());
+    client.publish((stateTopic + "/presence").c_str(), getPresenceState().c_str(), true);
   }
 }
 
@@ -462,11 +462,11 @@ void connectToMqtt() {
       Serial.println("Connected to MQTT broker as " + String(device_name));
       // Publish online message
       client.publish((String(root_topic) + "/" + String(device_name) + "/self").c_str(), String("ONLINE").c_str(), true);
-      // Publish initial state
-      client.publish((stateTopic + "/system").c_str(), getSystemState().c_str());
-      client.publish((stateTopic + "/audio").c_str(), getAudioState().c_str());
-      client.publish((stateTopic + "/light").c_str(), getLightState().c_str());
-      client.publish((stateTopic + "/presence").c_str(), getPresenceState().c_str());
+      // Publish initial state (retained, so a controller that (re)starts later gets the state of the tile right away)
+      client.publish((stateTopic + "/system").c_str(), getSystemState().c_str(), true);
+      client.publish((stateTopic + "/audio").c_str(), getAudioState().c_str(), true);
+      client.publish((stateTopic + "/light").c_str(), getLightState().c_str(), true);
+      client.publish((stateTopic + "/presence").c_str(), getPresenceState().c_str(), true);
       // Subscribe to command subtopic
       client.subscribe((commandTopic + "/#").c_str());
       Serial.println("Connected to MQTT broker as " + String(device_name));
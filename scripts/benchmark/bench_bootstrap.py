@@ -0,0 +1,82 @@
+"""Benchmarks how fast a (re)started controller knows a large fleet from the retained states of the tiles.
+
+Publishes the retained online message and states of a fleet (like the emulator and firmware do),
+starts the controller and measures the time till all tiles are in the tile list and till all
+their values are known. The retained messages are cleared afterwards.
+
+Uses the MQTT broker at MQTT_SERVER and MQTT_PORT (an in-process broker if not set) and websocket port 3000."""
+import json
+import time
+import asyncio
+import paho.mqtt.client as mqtt
+from benchutil import print_table
+from bench_discovery import MQTT_SERVER, MQTT_PORT, TIMEOUT, start_controller, connect, get_stats
+
+TILES: list[int] = [100, 1000]
+
+def get_states(tile_name: str) -> dict[str, str]:
+  """Returns the retained states of a tile (subtopic -> payload)."""
+  return {
+    "system": json.dumps({"firmware": "0.0.6", "hardware": "0.0.2", "ping": False, "uptime": 1234, "sounds": [f"Sound {i+1}" for i in range(52)], "features": ["groups"]}),
+    "audio": json.dumps({"state": 0, "looping": False, "sound": "Sound 1", "volume": 0}),
+    "light": json.dumps({"brightness": 0, "pixels": [{"r": 0, "g": 0, "b": 0, "w": 0} for _ in range(12)]}),
+    "presence": json.dumps({"detected": False})
+  }
+
+def publish_fleet(root_topic: str, amount: int, clear: bool = False) -> None:
+  """Publishes (or clears, with empty payloads) the retained messages of the fleet."""
+  client = mqtt.Client()
+  client.connect(MQTT_SERVER, int(MQTT_PORT))
+  client.loop_start()
+  messages = []
+  for i in range(amount):
+    tile_name = f"TILE{i+1}"
+    messages.append(client.publish(f"{root_topic}/{tile_name}/self", "" if clear else "ONLINE", 1, retain=True))
+    for subtopic, payload in get_states(tile_name).items():
+      messages.append(client.publish(f"{root_topic}/{tile_name}/self/state/{subtopic}", "" if clear else payload, 1, retain=True))
+  for message in messages:
+    message.wait_for_publish()
+  client.loop_stop()
+  client.disconnect()
+
+async def wait_till_bootstrapped(amount: int, started: float) -> tuple[float, float, dict]:
+  """Polls the stats of the controller till all tiles are listed and known.
+
+  Returns the seconds since started till all tiles were listed and known (None on timeout), and the discovery stats."""
+  websocket = await connect()
+  listed = None
+  try:
+    while True:
+      discovery = (await get_stats(websocket))["discovery"]
+      if listed is None and sum(discovery["states"].values()) >= amount:
+        listed = time.monotonic() - started
+      if discovery["states"]["done"] >= amount:
+        return listed, time.monotonic() - started, discovery
+      if time.monotonic() - started > TIMEOUT:
+        return listed, None, discovery
+      await asyncio.sleep(0.01)
+  finally:
+    await websocket.close()
+
+def run(amount: int) -> list:
+  # Unique root topic, so retained messages of earlier runs don't count
+  root_topic = "bench" + str(time.time_ns())
+  publish_fleet(root_topic, amount)
+  started = time.monotonic()
+  controller = start_controller(root_topic)
+  try:
+    listed, known, discovery = asyncio.run(wait_till_bootstrapped(amount, started))
+  finally:
+    controller.terminate()
+    controller.wait()
+    publish_fleet(root_topic, amount, clear=True)
+  seconds = lambda value: f"{value:.2f} s" if value is not None else "timeout"
+  return [amount, seconds(listed), seconds(known), discovery["probes"]]
+
+def main() -> None:
+  rows = [run(amount) for amount in TILES]
+  print(f"Controller start with a retained fleet (broker {MQTT_SERVER}:{MQTT_PORT}, includes the start of the controller process)\n")
+  print_table(["Tiles", "All listed after", "All known after", "Probes"], rows)
+
+if __name__ == "__main__":
+  main()
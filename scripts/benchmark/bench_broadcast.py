@@ -0,0 +1,72 @@
+"""Benchmarks the cost of sending one tile state update to a growing number of dashboards.
+
+Compares encoding (pretty printed) and sending per websocket against encoding once
+(compact) and broadcasting the same frame to every websocket."""
+import asyncio
+import json
+import time
+import websockets
+from benchutil import create_websocket, format_ns, print_table
+from messages import create_tile_state_message
+from tile import Tile, StateType
+
+SUBSCRIBERS: list[int] = [1, 10, 100, 500]
+UPDATES: int = 200 # State updates per measurement
+
+def create_tile() -> Tile:
+  """Creates a tile with a realistic light state (12 pixels)."""
+  tile = Tile("TILE1")
+  pixels = [{"r": i * 20, "g": 255 - i * 20, "b": 128, "w": 0} for i in range(12)]
+  tile.update_state(StateType.LIGHT, json.dumps({"brightness": 100, "pixels": pixels}))
+  return tile
+
+async def legacy_update(subscribers: list, tile: Tile) -> None:
+  """Builds, pretty prints and sends the state for every websocket."""
+  for websocket in subscribers:
+    responds = {
+      "action": "state",
+      "type": StateType.LIGHT.value,
+      "tile": tile.device_name,
+      "args": tile.get_state(StateType.LIGHT)
+    }
+    await websocket.send(json.dumps(responds, indent=4))
+
+async def broadcast_update(subscribers: list, tile: Tile) -> None:
+  """Encodes the state once and broadcasts the same frame."""
+  websockets.broadcast(subscribers, create_tile_state_message(tile, StateType.LIGHT))
+
+async def measure_update(update, subscribers: list, tile: Tile) -> tuple[float, int]:
+  """Returns the time per update in nanoseconds and the bytes written per update."""
+  transport = subscribers[0].transport
+  written = transport.bytes_written
+  await update(subscribers, tile)
+  frame_bytes = (transport.bytes_written - written) * len(subscribers)
+  start = time.perf_counter_ns()
+  for _ in range(UPDATES):
+    await update(subscribers, tile)
+  return (time.perf_counter_ns() - start) / UPDATES, frame_bytes
+
+async def run() -> list[list]:
+  tile = create_tile()
+  rows = []
+  for amount in SUBSCRIBERS:
+    subscribers = [create_websocket() for _ in range(amount)]
+    legacy_time, legacy_bytes = await measure_update(legacy_update, subscribers, tile)
+    broadcast_time, broadcast_bytes = await measure_update(broadcast_update, subscribers, tile)
+    rows.append([
+      amount,
+      format_ns(legacy_time),
+      format_ns(legacy_time / amount),
+      format_ns(broadcast_time),
+      format_ns(broadcast_time / amount),
+      f"{legacy_bytes / amount:.0f} B -> {broadcast_bytes / amount:.0f} B",
+    ])
+  return rows
+
+def main() -> None:
+  rows = asyncio.run(run())
+  print(f"Light state update (12 pixels), {UPDATES} updates per measurement\n")
+  print_table(["Subscribers", "Per update (legacy)", "Per subscriber (legacy)", "Per update (broadcast)", "Per subscriber (broadcast)", "Frame size"], rows)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,160 @@
+"""Benchmarks end-to-end MQTT throughput through the in-process broker (broker.py of the controller).
+
+The broker, the tiles and the controller run on one event loop, with the MQTT client of the controller
+(mqtt_async.py) and the captured state payloads (payloads.json), so the results only depend on the machine
+and the benchmark runs offline:
+
+- State ingest: every tile publishes its states, the controller subscribes with wildcards
+- Command fan-out: the controller publishes group commands, every tile receives them
+- Round trip: the controller commands a tile and waits for its state, without and with injected broker latency"""
+import time
+import asyncio
+import statistics
+from benchutil import print_table
+from bench_model import load_payloads
+from broker import Broker
+from mqtt_async import AsyncMqttClient
+from tile import create_light_command
+from pixel import PixelBuffer
+
+TILES: int = 100
+STATES: int = 50 # States every tile publishes (state ingest)
+COMMANDS: int = 200 # Group commands (command fan-out)
+ROUND_TRIPS: int = 200 # Commands to one tile (round trip)
+LATENCIES: list[float] = [0.0, 0.002] # Injected broker latencies (round trip)
+SUBSCRIBE_TIME: float = 0.5 # Seconds to give the broker to handle the subscriptions before a scenario starts
+
+async def connect_clients(port: int, names: list[str]) -> list[AsyncMqttClient]:
+  """Connects a client per name, returns when all of them are connected."""
+  clients = []
+  connected = []
+  for name in names:
+    client = AsyncMqttClient(client_id=name)
+    event = asyncio.Event()
+    client.on_connect = lambda client, userdata, flags, rc, event=event: event.set()
+    await client.connect("127.0.0.1", port)
+    clients.append(client)
+    connected.append(event.wait())
+  await asyncio.gather(*connected)
+  return clients
+
+async def disconnect_clients(clients: list[AsyncMqttClient]) -> None:
+  await asyncio.gather(*(client.disconnect() for client in clients))
+
+def summarize(name: str, messages: int, seconds: float, broker: Broker, latencies: list[float] = None) -> list:
+  """Returns a table row for the given run."""
+  row = [name, messages, f"{seconds:.2f} s", f"{messages / seconds:,.0f} msg/s"]
+  if latencies is not None:
+    latencies = sorted(latencies)
+    row += [f"{statistics.median(latencies) * 1000:.2f} ms", f"{latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms"]
+  else:
+    row += ["-", "-"]
+  return row + [f"{broker.stats.bytes_in / 1e6:.1f} MB", f"{broker.stats.bytes_out / 1e6:.1f} MB"]
+
+async def run_ingest(broker: Broker, payloads: dict) -> list:
+  """Every tile publishes its states, the controller receives them all."""
+  root = "ingest"
+  done = asyncio.Event()
+  received = 0
+  total = TILES * STATES
+
+  def on_message(client, userdata, message):
+    nonlocal received
+    received += 1
+    if received == total:
+      done.set()
+  controller = (await connect_clients(broker.port, ["CONTROLLER"]))[0]
+  controller.on_message = on_message
+  controller.subscribe(root + "/+/self/state/+")
+  tiles = await connect_clients(broker.port, [f"TILE{i+1}" for i in range(TILES)])
+  await asyncio.sleep(SUBSCRIBE_TIME)
+  broker.stats.reset()
+
+  # The captured states, in turns (light as JSON, the other states in between)
+  states = [(subtopic, payload) for subtopic in ["light", "audio", "system", "presence"] for payload in payloads[subtopic]]
+  started = time.monotonic()
+  for i in range(STATES):
+    subtopic, payload = states[i % len(states)]
+    for j, tile in enumerate(tiles):
+      tile.publish(f"{root}/TILE{j+1}/self/state/{subtopic}", payload)
+    # Let the event loop write and deliver (like tiles publishing over time)
+    await asyncio.sleep(0)
+  await done.wait()
+  seconds = time.monotonic() - started
+  await disconnect_clients(tiles + [controller])
+  return summarize(f"State ingest ({TILES} tiles -> controller)", total, seconds, broker)
+
+async def run_fan_out(broker: Broker) -> list:
+  """The controller publishes group commands, every tile receives them."""
+  root = "fanout"
+  done = asyncio.Event()
+  received = 0
+  total = TILES * COMMANDS
+
+  def on_message(client, userdata, message):
+    nonlocal received
+    received += 1
+    if received == total:
+      done.set()
+  tiles = await connect_clients(broker.port, [f"TILE{i+1}" for i in range(TILES)])
+  for tile in tiles:
+    tile.on_message = on_message
+    tile.subscribe(root + "/group/all/command/#")
+  controller = (await connect_clients(broker.port, ["CONTROLLER"]))[0]
+  await asyncio.sleep(SUBSCRIBE_TIME)
+  broker.stats.reset()
+
+  pixels = PixelBuffer(12)
+  started = time.monotonic()
+  for i in range(COMMANDS):
+    pixels.fill(i % 256, 0, 255 - i % 256, 0)
+    controller.publish(root + "/group/all/command/light", create_light_command(100, pixels))
+    await asyncio.sleep(0)
+  await done.wait()
+  seconds = time.monotonic() - started
+  await disconnect_clients(tiles + [controller])
+  return summarize(f"Command fan-out (controller -> {TILES} tiles)", total, seconds, broker)
+
+async def run_round_trip(broker: Broker, latency: float) -> list:
+  """The controller commands a tile and waits for the state it answers with, one command at a time."""
+  root = "roundtrip"
+  answered = asyncio.Event()
+  tile, controller = await connect_clients(broker.port, ["TILE1", "CONTROLLER"])
+  # The tile answers every command with its state
+  tile.on_message = lambda client, userdata, message: tile.publish(root + "/TILE1/self/state/light", message.payload)
+  tile.subscribe(root + "/TILE1/self/command/+")
+  controller.on_message = lambda client, userdata, message: answered.set()
+  controller.subscribe(root + "/+/self/state/+")
+  await asyncio.sleep(SUBSCRIBE_TIME)
+  broker.stats.reset()
+  broker.latency = latency
+
+  pixels = PixelBuffer(12)
+  latencies = []
+  started = time.monotonic()
+  for i in range(ROUND_TRIPS):
+    pixels.fill(i % 256, 0, 0, 0)
+    answered.clear()
+    sent = time.monotonic()
+    controller.publish(root + "/TILE1/self/command/light", create_light_command(100, pixels))
+    await answered.wait()
+    latencies.append(time.monotonic() - sent)
+  seconds = time.monotonic() - started
+  broker.latency = 0.0
+  await disconnect_clients([tile, controller])
+  return summarize(f"Round trip (latency {latency * 1000:.0f} ms)", ROUND_TRIPS, seconds, broker, latencies)
+
+async def main() -> None:
+  broker = Broker("127.0.0.1", 0)
+  await broker.start()
+  try:
+    rows = [await run_ingest(broker, load_payloads()), await run_fan_out(broker)]
+    for latency in LATENCIES:
+      rows.append(await run_round_trip(broker, latency))
+  finally:
+    await broker.stop()
+  print(f"End-to-end MQTT through the in-process broker (one event loop for broker and clients)\n")
+  print_table(["Scenario", "Messages", "Time", "Throughput", "p50", "p99", "Payload in", "Payload out"], rows)
+
+if __name__ == "__main__":
+  asyncio.run(main())
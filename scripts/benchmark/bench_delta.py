@@ -0,0 +1,57 @@
+"""Benchmarks light state updates during a streamed animation (a chase over 12 pixels).
+
+Compares rewriting every pixel and sending the full light state against diffing
+the pixels and sending only the changed ones (light deltas)."""
+import json
+from benchutil import measure, format_ns, print_table
+from messages import create_tile_state_message, create_tile_light_delta_message
+from tile import Tile, StateType
+
+PIXELS: int = 12
+
+def create_frames() -> list[str]:
+  """Creates the light states of one chase loop (one lit pixel moving around)."""
+  frames = []
+  for lit in range(PIXELS):
+    pixels = [{"r": 255 if i == lit else 0, "g": 0, "b": 0, "w": 0} for i in range(PIXELS)]
+    frames.append(json.dumps({"brightness": 100, "pixels": pixels}))
+  return frames
+
+def legacy_update_light_state(tile: Tile, state: str) -> None:
+  """The light state update before deltas: every pixel is rewritten."""
+  state_json: dict = json.loads(state)
+  tile._brightness = int(state_json["brightness"])
+  pixels = list(map(dict, state_json["pixels"]))
+  tile._pixels.resize(len(pixels))
+  for i in range(len(pixels)):
+    tile._pixels[i].from_dict(pixels[i])
+  tile._changed(StateType.LIGHT)
+
+def main() -> None:
+  frames = create_frames()
+  legacy_tile = Tile("TILE1")
+  delta_tile = Tile("TILE1")
+  state = {"frame": 0}
+
+  def legacy_frame():
+    frame = state["frame"] = (state["frame"] + 1) % PIXELS
+    legacy_update_light_state(legacy_tile, frames[frame])
+    return create_tile_state_message(legacy_tile, StateType.LIGHT)
+
+  def delta_frame():
+    frame = state["frame"] = (state["frame"] + 1) % PIXELS
+    delta_tile.update_light_state(frames[frame])
+    return create_tile_light_delta_message(delta_tile)
+
+  legacy_time = measure(legacy_frame)
+  delta_time = measure(delta_frame)
+  legacy_bytes = len(legacy_frame())
+  delta_bytes = len(delta_frame())
+  print(f"Chase animation over {PIXELS} pixels (2 pixels change per frame)\n")
+  print_table(["Path", "Controller time per frame", "Bytes per frame per dashboard"], [
+    ["Full light state", format_ns(legacy_time), legacy_bytes],
+    ["Light delta", format_ns(delta_time), delta_bytes],
+  ])
+
+if __name__ == "__main__":
+  main()
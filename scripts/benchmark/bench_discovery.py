@@ -0,0 +1,116 @@
+"""Benchmarks the discovery of a fleet of tiles with the controller and the emulator.
+
+Measures the time till every tile is fully known (system, audio and light values) and the amount
+of probe commands, for a floor that powers up while the controller runs ("tiles start") and for a
+controller that starts while the floor is already up ("controller start").
+
+Uses the MQTT broker at MQTT_SERVER and MQTT_PORT (an in-process broker if not set) and websocket port 3000."""
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+import websockets
+from benchutil import ROOT_DIR, CONTROL_DIR, get_broker_address, print_table
+
+TILES: list[int] = [10, 50]
+TIMEOUT: float = float(os.getenv("TIMEOUT", "60")) # Seconds to wait for the fleet to be known
+MQTT_SERVER, MQTT_PORT = get_broker_address()
+EMULATOR_DIR: str = os.path.join(ROOT_DIR, "scripts", "emulator")
+
+def start_controller(root_topic: str) -> subprocess.Popen:
+  env = dict(os.environ, MQTT_SERVER=MQTT_SERVER, MQTT_PORT=MQTT_PORT, MQTT_ROOT_TOPIC=root_topic)
+  return subprocess.Popen([sys.executable, "main.py"], cwd=CONTROL_DIR, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def start_emulator(root_topic: str, amount: int) -> subprocess.Popen:
+  env = dict(os.environ, MQTT_HOST=MQTT_SERVER, MQTT_PORT=MQTT_PORT, ROOT_TOPIC=root_topic)
+  emulator = subprocess.Popen([sys.executable, "main.py"], cwd=EMULATOR_DIR, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True)
+  # Answer the question of the emulator: how many tiles?
+  emulator.stdin.write(str(amount) + "\n")
+  emulator.stdin.flush()
+  return emulator
+
+def stop(process: subprocess.Popen) -> None:
+  if process.stdin is not None:
+    # The emulator stops on enter
+    try:
+      process.stdin.write("\n")
+      process.stdin.flush()
+    except OSError:
+      pass
+  try:
+    process.wait(10)
+  except subprocess.TimeoutExpired:
+    process.kill()
+    process.wait()
+
+async def get_stats(websocket) -> dict:
+  await websocket.send(json.dumps({"action": "stats"}))
+  while True:
+    message = json.loads(await websocket.recv())
+    if message["action"] == "stats":
+      return message
+
+async def connect() -> websockets.WebSocketClientProtocol:
+  """Connects to the websocket server of the controller (waits till it's started)."""
+  while True:
+    try:
+      return await websockets.connect("ws://127.0.0.1:3000")
+    except OSError:
+      await asyncio.sleep(0.1)
+
+async def wait_for_controller() -> None:
+  websocket = await connect()
+  await websocket.close()
+
+async def wait_till_known(amount: int, started: float) -> tuple[float, dict]:
+  """Polls the stats of the controller till all tiles are discovered.
+
+  Returns the seconds since started and the discovery stats (seconds is None on timeout)."""
+  websocket = await connect()
+  try:
+    while True:
+      discovery = (await get_stats(websocket))["discovery"]
+      if discovery["states"]["done"] >= amount:
+        return time.monotonic() - started, discovery
+      if time.monotonic() - started > TIMEOUT:
+        return None, discovery
+      await asyncio.sleep(0.05)
+  finally:
+    await websocket.close()
+
+def run(scenario: str, amount: int) -> list:
+  # Unique root topic, so retained messages of earlier runs don't count
+  root_topic = "bench" + str(time.time_ns())
+  if scenario == "tiles start":
+    # The controller is running when the floor powers up
+    controller = start_controller(root_topic)
+    asyncio.run(wait_for_controller())
+    started = time.monotonic()
+    emulator = start_emulator(root_topic, amount)
+  else:
+    # The floor is up (and has published its state) when the controller starts
+    emulator = start_emulator(root_topic, amount)
+    time.sleep(2 + amount * 0.02)
+    started = time.monotonic()
+    controller = start_controller(root_topic)
+  try:
+    seconds, discovery = asyncio.run(wait_till_known(amount, started))
+  finally:
+    stop(emulator)
+    controller.terminate()
+    controller.wait()
+  known = f"{seconds:.2f} s" if seconds is not None else f"timeout ({discovery['states']['done']} known)"
+  return [scenario, amount, known, f"{discovery['mean_s']:.2f} s", discovery["probes"], discovery["timeouts"], discovery["failed"]]
+
+def main() -> None:
+  rows = []
+  for amount in TILES:
+    for scenario in ["tiles start", "controller start"]:
+      rows.append(run(scenario, amount))
+  print(f"Discovery of a fleet (broker {MQTT_SERVER}:{MQTT_PORT}, controller settings from the environment)\n")
+  print_table(["Scenario", "Tiles", "All known after", "Mean per tile", "Probes", "Timeouts", "Failed"], rows)
+
+if __name__ == "__main__":
+  main()
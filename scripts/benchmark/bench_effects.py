@@ -0,0 +1,58 @@
+"""Benchmarks the effects engine: frames per second against the amount of tiles.
+
+Every frame renders the effect for all tiles (one core) and encodes a light frame
+for every tile that changed, like the controller does before publishing."""
+import colorsys
+import time
+from benchutil import print_table
+from effects import EFFECTS, EffectsEngine
+from lightframe import encode_light_frame
+from pixel import PixelBuffer
+
+TILE_COUNTS: list[int] = [10, 100, 300, 1000]
+AMOUNT_OF_PIXELS: int = 12
+TARGET_FPS: float = 30.0
+DURATION: float = 0.5 # Seconds to render per measurement
+
+def frames_per_second(render) -> float:
+  """Renders frames (with a moving time) for DURATION seconds, returns the amount of frames per second."""
+  frames = 0
+  start = time.perf_counter()
+  while time.perf_counter() - start < DURATION:
+    render(frames / TARGET_FPS)
+    frames += 1
+  return frames / (time.perf_counter() - start)
+
+def python_rainbow(tile_names: list[str]):
+  """A rainbow rendered per tile and per pixel in plain Python (the baseline)."""
+  def render(t: float) -> None:
+    for tile_index, tile_name in enumerate(tile_names):
+      pixels = PixelBuffer(AMOUNT_OF_PIXELS)
+      for i in range(AMOUNT_OF_PIXELS):
+        red, green, blue = colorsys.hsv_to_rgb((i / AMOUNT_OF_PIXELS + tile_index * 0.05 + t) % 1.0, 1.0, 1.0)
+        pixels[i].from_dict({"r": int(red * 255), "g": int(green * 255), "b": int(blue * 255), "w": 0})
+      encode_light_frame(None, pixels)
+  return render
+
+def engine_effect(effect: str, tile_names: list[str]):
+  """An effect rendered by the engine (for all tiles at once)."""
+  engine = EffectsEngine(AMOUNT_OF_PIXELS)
+  engine.start(effect, tile_names, {}, 0.0)
+  def render(t: float) -> None:
+    for tile_name, pixel_bytes, brightness in engine.render(t):
+      encode_light_frame(brightness, PixelBuffer(data=pixel_bytes))
+  return render
+
+def main() -> None:
+  rows = []
+  for tiles in TILE_COUNTS:
+    tile_names = [f"TILE{i+1}" for i in range(tiles)]
+    row = [tiles, f"{frames_per_second(python_rainbow(tile_names)):.0f}"]
+    for effect in EFFECTS:
+      row.append(f"{frames_per_second(engine_effect(effect, tile_names)):.0f}")
+    rows.append(row)
+  print(f"Frames per second (render + encode light frames), {AMOUNT_OF_PIXELS} pixels per tile, target {TARGET_FPS:.0f} fps\n")
+  print_table(["Tiles", "rainbow (per pixel Python)"] + list(EFFECTS), rows)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,118 @@
+"""Benchmarks MQTT ingestion and websocket fan-out with a few slow dashboards.
+
+The legacy path sends to every websocket in turn from the MQTT thread (with
+run_until_complete), the dispatcher hands messages over to the event loop and
+queues them in the send queue of every websocket there (ClientOutbox, like the controller),
+so every websocket is sent to by its own task."""
+import asyncio
+import statistics
+import threading
+import time
+from benchutil import print_table
+from fanout import Dispatcher, MqttEvent
+from outbox import ClientOutbox
+
+MESSAGES: int = 500 # Messages received by the "MQTT thread"
+RATE: int = 250 # Messages per second arriving from the broker
+FAST_CLIENTS: int = 20 # Dashboards on a good connection
+SLOW_CLIENTS: int = 4 # Dashboards on a bad connection
+SLOW_SEND_TIME: float = 0.002 # Time a send to a slow dashboard takes (seconds)
+
+class FakeWebsocket:
+  """Stands in for a websocket connection, records the delivery latency of each message."""
+  def __init__(self, send_time: float = 0.0):
+    self.send_time: float = send_time
+    self.latencies: list[float] = []
+
+  async def send(self, event: MqttEvent) -> None:
+    if self.send_time > 0:
+      await asyncio.sleep(self.send_time)
+    else:
+      await asyncio.sleep(0)
+    self.latencies.append(time.monotonic() - event.received)
+
+def create_clients() -> list[FakeWebsocket]:
+  return [FakeWebsocket() for _ in range(FAST_CLIENTS)] + [FakeWebsocket(SLOW_SEND_TIME) for _ in range(SLOW_CLIENTS)]
+
+def wait_for_arrival(start: float, i: int) -> float:
+  """Sleeps until message i arrives from the broker, returns its arrival time."""
+  arrival = start + i / RATE
+  delay = arrival - time.monotonic()
+  if delay > 0:
+    time.sleep(delay)
+  return arrival
+
+def summarize(name: str, ingest_time: float, total_time: float, clients: list[FakeWebsocket]) -> list:
+  """Returns a table row for the given run."""
+  latencies = sorted(latency for client in clients[:FAST_CLIENTS] for latency in client.latencies)
+  return [
+    name,
+    f"{ingest_time:.2f} s",
+    f"{MESSAGES / total_time:,.0f} msg/s",
+    f"{statistics.median(latencies) * 1000:.2f} ms",
+    f"{latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms",
+  ]
+
+def run_legacy() -> list:
+  """Sends to every websocket in turn from the MQTT thread."""
+  clients = create_clients()
+  result = {}
+
+  def mqtt_thread():
+    loop = asyncio.new_event_loop()
+    start = time.monotonic()
+    for i in range(MESSAGES):
+      event = MqttEvent("TILE1", "light", "{}", wait_for_arrival(start, i))
+      for ws in clients:
+        loop.run_until_complete(ws.send(event))
+    result["ingest"] = time.monotonic() - start
+    loop.close()
+
+  thread = threading.Thread(target=mqtt_thread)
+  thread.start()
+  thread.join()
+  return summarize("Legacy (sequential, MQTT thread)", result["ingest"], result["ingest"], clients)
+
+async def run_dispatcher() -> list:
+  """Hands messages over to the event loop and queues them for every websocket."""
+  clients = create_clients()
+  outboxes = [ClientOutbox(ws, MESSAGES) for ws in clients]
+  for outbox in outboxes:
+    outbox.start()
+
+  async def handler(event: MqttEvent) -> None:
+    # Keyed like the states in the controller (a slow dashboard gets the latest state)
+    for outbox in outboxes:
+      outbox.put((event.tile_name, event.subtopic), event)
+
+  dispatcher = Dispatcher(handler, maxsize=MESSAGES)
+  dispatcher.start()
+  result = {}
+
+  def mqtt_thread():
+    start = time.monotonic()
+    for i in range(MESSAGES):
+      dispatcher.submit_threadsafe(MqttEvent("TILE1", "light", "{}", wait_for_arrival(start, i)))
+    result["ingest"] = time.monotonic() - start
+
+  start = time.monotonic()
+  thread = threading.Thread(target=mqtt_thread)
+  thread.start()
+  # Wait till all messages are processed and sent
+  while dispatcher.processed + dispatcher.dropped < MESSAGES or any(outbox.pending > 0 for outbox in outboxes):
+    await asyncio.sleep(0.001)
+  total = time.monotonic() - start
+  thread.join()
+  await dispatcher.stop()
+  for outbox in outboxes:
+    await outbox.close()
+  return summarize("Dispatcher (event loop, send queues)", result["ingest"], total, clients)
+
+def main() -> None:
+  rows = [run_legacy(), asyncio.run(run_dispatcher())]
+  print(f"{MESSAGES} messages at {RATE} msg/s, {FAST_CLIENTS} fast dashboards + {SLOW_CLIENTS} slow dashboards ({SLOW_SEND_TIME * 1000:.0f} ms per send)")
+  print("Latency is measured at the fast dashboards, from arrival at the MQTT client to websocket send\n")
+  print_table(["Path", "Time to ingest all", "Fan-out throughput", "Latency p50", "Latency p99"], rows)
+
+if __name__ == "__main__":
+  main()
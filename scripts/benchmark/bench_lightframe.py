@@ -0,0 +1,57 @@
+"""Benchmarks the binary light frame against the JSON light command and light state.
+
+Measures encoding a light command, decoding a light state into a tile and the
+amount of bytes on the wire, for the 12 pixels of a tile."""
+import json
+from benchutil import measure, format_ns, print_table
+from pixel import Pixel, PixelBuffer
+from tile import Tile, StateType, create_light_command
+from lightframe import encode_light_frame, decode_light_frame
+
+AMOUNT_OF_PIXELS: int = 12
+
+def create_pixels(offset: int) -> PixelBuffer:
+  """Creates a realistic set of pixels (every pixel a different color)."""
+  return PixelBuffer.from_pixels([Pixel((i * 20 + offset) % 256, (255 - i * 20) % 256, (128 + offset) % 256, 0) for i in range(AMOUNT_OF_PIXELS)])
+
+def create_states(pixels: PixelBuffer) -> tuple[str, bytes]:
+  """Creates the light state like the emulator publishes it, as JSON and as light frame."""
+  state_json = json.dumps({"brightness": 100, "pixels": pixels.to_dicts()})
+  return state_json, encode_light_frame(100, pixels)
+
+def main() -> None:
+  pixels = create_pixels(0)
+  json_command = create_light_command(100, pixels)
+  frame_command = encode_light_frame(100, pixels)
+
+  # Encode (controller -> tile)
+  encode_json = measure(lambda: create_light_command(100, pixels))
+  encode_frame = measure(lambda: encode_light_frame(100, pixels))
+  # Decode only (tile side, without applying the values)
+  decode_json = measure(lambda: json.loads(json_command))
+  decode_frame = measure(lambda: decode_light_frame(frame_command))
+  # Decode into a tile (tile -> controller), alternating between two states so every update changes all pixels
+  states = [create_states(create_pixels(0)), create_states(create_pixels(1))]
+  tile_json = Tile("JSON")
+  tile_frame = Tile("FRAME")
+  counter = [0]
+  def update_json():
+    counter[0] += 1
+    tile_json.update_state(StateType.LIGHT, states[counter[0] & 1][0])
+  def update_frame():
+    counter[0] += 1
+    tile_frame.update_state(StateType.LIGHT, states[counter[0] & 1][1])
+  apply_json = measure(update_json)
+  apply_frame = measure(update_frame)
+
+  print(f"Light command/state of {AMOUNT_OF_PIXELS} pixels\n")
+  print_table(["", "JSON", "Light frame", "Speedup"], [
+    ["Bytes on the wire (command)", len(json_command.encode("utf-8")), len(frame_command), f"{len(json_command.encode('utf-8')) / len(frame_command):.1f}x"],
+    ["Bytes on the wire (state)", len(states[0][0].encode("utf-8")), len(states[0][1]), f"{len(states[0][0].encode('utf-8')) / len(states[0][1]):.1f}x"],
+    ["Encode command", format_ns(encode_json), format_ns(encode_frame), f"{encode_json / encode_frame:.1f}x"],
+    ["Decode command", format_ns(decode_json), format_ns(decode_frame), f"{decode_json / decode_frame:.1f}x"],
+    ["Apply state to tile", format_ns(apply_json), format_ns(apply_frame), f"{apply_json / apply_frame:.1f}x"],
+  ])
+
+if __name__ == "__main__":
+  main()
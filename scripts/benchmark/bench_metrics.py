@@ -0,0 +1,48 @@
+"""Benchmarks the overhead of the metrics on the hot paths, and collecting them.
+
+Measures recording (counter, histogram with timing) against the work it is recorded around
+(processing a state update of a tile), and rendering all metrics of the controller."""
+import json
+import time
+from benchutil import measure, format_ns, print_table
+from metrics import Metrics
+from tile import Tile, StateType
+
+LABELS: list[str] = ["online", "system", "audio", "light", "presence"] # Label values (like the state types)
+
+def main() -> None:
+  metrics = Metrics("bench_")
+  counter = metrics.counter("messages_total", "Messages", ("subtopic",))
+  histogram = metrics.histogram("update_seconds", "Update time", ("type",))
+  unlabeled = metrics.histogram("on_message_seconds", "On message time").labels()
+  for label in LABELS:
+    for i in range(1000):
+      histogram.labels(label).observe(i * 1e-6)
+      counter.labels(label).inc()
+
+  tile = Tile("TILE1")
+  presence = [json.dumps({"detected": detected}) for detected in (True, False)]
+  toggle = [0]
+  def update_state():
+    toggle[0] ^= 1
+    tile.update_state(StateType.PRESENCE, presence[toggle[0]])
+  def update_state_with_metrics():
+    started = time.perf_counter()
+    update_state()
+    histogram.labels("presence").observe(time.perf_counter() - started)
+    counter.labels("presence").inc()
+
+  rows = [
+    ["counter inc (labels lookup)", format_ns(measure(lambda: counter.labels("presence").inc()))],
+    ["histogram observe (no labels)", format_ns(measure(lambda: unlabeled.observe(0.00003)))],
+    ["histogram observe (labels lookup)", format_ns(measure(lambda: histogram.labels("presence").observe(0.00003)))],
+    ["presence update_state", format_ns(measure(update_state))],
+    ["presence update_state + timing + counter", format_ns(measure(update_state_with_metrics))],
+    ["render Prometheus text", format_ns(measure(metrics.render))],
+    ["to_dict (websocket stats)", format_ns(measure(metrics.to_dict))]
+  ]
+  print("Metrics overhead\n")
+  print_table(["Operation", "Time"], rows)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,138 @@
+"""Micro-benchmarks of the hot paths of the controller's data model and codecs.
+
+State updates, full states, commands, pixels, tile lookups and websocket messages, with the payloads
+captured from the emulator (payloads.json, see capture_payloads.py). Prints a table, use run.py for
+JSON output and a comparison with a baseline."""
+import os
+import json
+import base64
+import asyncio
+import itertools
+import websockets
+from typing import Callable
+from benchutil import create_websocket, measure, format_ns, print_table
+from lightframe import FRAME_SUBTOPIC
+from messages import TileListChange, create_tile_state_message, create_tile_light_delta_message, create_tile_list_message
+from pixel import Pixel, PixelBuffer
+from registry import TileRegistry
+from tile import Tile, StateType, create_light_command, create_audio_command, create_system_command
+
+PAYLOADS_FILE: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads.json")
+FLEET_SIZES: list[int] = [10, 100, 1000, 10000]
+SUBSCRIBERS: int = 10 # Websockets a state is broadcast to
+
+def load_payloads(path: str = PAYLOADS_FILE) -> dict[str, list[str | bytes]]:
+  """Returns the captured state payloads per subtopic (binary light frames as bytes)."""
+  with open(path) as file:
+    states = json.load(file)["states"]
+  states[FRAME_SUBTOPIC] = [base64.b64decode(payload) for payload in states.get(FRAME_SUBTOPIC, [])]
+  return states
+
+def create_tile(payloads: dict[str, list[str | bytes]], name: str = "TILE1") -> Tile:
+  """Creates a tile with the last captured state of every type."""
+  tile = Tile(name)
+  tile.update_state(StateType.ONLINE, "ONLINE")
+  for state_type in [StateType.SYSTEM, StateType.AUDIO, StateType.LIGHT, StateType.PRESENCE]:
+    tile.update_state(state_type, payloads[state_type.value][-1])
+  return tile
+
+def cycle_updates(tile: Tile, state_type: StateType, states: list[str | bytes]) -> Callable[[], None]:
+  """Returns a function that updates the state with the next captured payload (so every update changes the state)."""
+  states = itertools.cycle(states)
+  return lambda: tile.update_state(state_type, next(states))
+
+def get_benchmarks(payloads: dict[str, list[str | bytes]]) -> dict[str, Callable[[], object]]:
+  """Returns the benchmarks (name -> function to measure).
+
+  The names are stable, baselines are compared by name."""
+  benchmarks: dict[str, Callable[[], object]] = {}
+  tile = create_tile(payloads)
+
+  # Tile.update_state per state type (light as JSON and as binary light frame)
+  benchmarks["tile.update_state.online"] = cycle_updates(tile, StateType.ONLINE, payloads["online"])
+  benchmarks["tile.update_state.system"] = cycle_updates(tile, StateType.SYSTEM, payloads["system"])
+  benchmarks["tile.update_state.audio"] = cycle_updates(tile, StateType.AUDIO, payloads["audio"])
+  benchmarks["tile.update_state.light"] = cycle_updates(tile, StateType.LIGHT, payloads["light"])
+  benchmarks["tile.update_state.light_frame"] = cycle_updates(tile, StateType.LIGHT, payloads[FRAME_SUBTOPIC])
+  benchmarks["tile.update_state.presence"] = cycle_updates(tile, StateType.PRESENCE, payloads["presence"])
+
+  # Full state, as dictionary and as (cached) JSON
+  full_tile = create_tile(payloads)
+  benchmarks["tile.get_full_state"] = full_tile.get_full_state
+  benchmarks["tile.get_state_json.full"] = lambda: full_tile.get_state_json(StateType.FULL)
+  light_updates = cycle_updates(full_tile, StateType.LIGHT, payloads["light"])
+
+  def full_state_after_light_update():
+    light_updates()
+    return full_tile.get_state_json(StateType.FULL)
+  benchmarks["tile.get_state_json.full_after_light_update"] = full_state_after_light_update
+
+  # Commands (the payload the controller publishes)
+  pixels = tile.pixels.copy()
+  benchmarks["command.light"] = lambda: create_light_command(100, pixels)
+  benchmarks["command.light.tile"] = lambda: tile.create_light_command(brightness=50)
+  benchmarks["command.audio"] = lambda: create_audio_command(1, False, "Sound 1", 20)
+  benchmarks["command.audio.tile"] = lambda: tile.create_audio_command(mode=1)
+  benchmarks["command.system"] = lambda: create_system_command(False, True)
+
+  # Pixels (the dataclass and the view on a pixel buffer)
+  pixel_dict = json.loads(payloads["light"][-1])["pixels"][0]
+  pixel = Pixel()
+  view = pixels[0]
+  benchmarks["pixel.from_dict"] = lambda: pixel.from_dict(pixel_dict)
+  benchmarks["pixel.to_dict"] = pixel.to_dict
+  benchmarks["pixel_view.from_dict"] = lambda: view.from_dict(pixel_dict)
+  benchmarks["pixel_view.to_dict"] = view.to_dict
+  benchmarks["pixel_buffer.to_dicts"] = pixels.to_dicts
+
+  # get_existing_tile (a registry lookup) at different fleet sizes, of the last added tile
+  for size in FLEET_SIZES:
+    registry = TileRegistry()
+    for i in range(size):
+      registry.add(Tile(f"TILE{i+1}"))
+    benchmarks[f"get_existing_tile.{size}"] = lambda registry=registry, name=f"TILE{size}": registry.get(name)
+  fleet = registry # The largest fleet
+  benchmarks["get_existing_tile.missing"] = lambda: fleet.get("TILE0")
+
+  # Websocket messages: building the message, and encoding and writing the frame to every subscriber
+  for state_type in [StateType.SYSTEM, StateType.AUDIO, StateType.LIGHT, StateType.FULL]:
+    benchmarks["ws.state_message." + state_type.value] = lambda state_type=state_type: create_tile_state_message(tile, state_type)
+  message_tile = create_tile(payloads)
+  message_updates = cycle_updates(message_tile, StateType.LIGHT, payloads["light"])
+
+  def light_message_after_update():
+    message_updates()
+    return create_tile_state_message(message_tile, StateType.LIGHT)
+  benchmarks["ws.state_message.light_after_update"] = light_message_after_update
+
+  def light_delta_message_after_update():
+    message_updates()
+    return create_tile_light_delta_message(message_tile)
+  benchmarks["ws.light_delta_message_after_update"] = light_delta_message_after_update
+  benchmarks["ws.tile_list_message.1000"] = lambda tiles=fleet.tiles[:1000]: create_tile_list_message(tiles, TileListChange.LIST)
+
+  async def create_subscribers():
+    subscribers = [create_websocket() for _ in range(SUBSCRIBERS)]
+    # Broadcasting writes to the transport directly, the background tasks of the connections aren't needed
+    tasks = [task for websocket in subscribers for task in (websocket.transfer_data_task, websocket.keepalive_ping_task, websocket.close_connection_task)]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return subscribers
+  loop = asyncio.new_event_loop()
+  subscribers = loop.run_until_complete(create_subscribers())
+  loop.close()
+  message = create_tile_state_message(tile, StateType.LIGHT)
+  benchmarks[f"ws.broadcast.light.{SUBSCRIBERS}"] = lambda: websockets.broadcast(subscribers, message)
+  return benchmarks
+
+def run_benchmarks(benchmarks: dict[str, Callable[[], object]], repeat: int = 5, min_time: float = 0.05) -> dict[str, float]:
+  """Measures every benchmark, returns the best time per call in nanoseconds (name -> time)."""
+  return {name: measure(function, repeat, min_time) for name, function in benchmarks.items()}
+
+def main() -> None:
+  results = run_benchmarks(get_benchmarks(load_payloads()))
+  print_table(["Benchmark", "Time"], [[name, format_ns(time)] for name, time in results.items()])
+
+if __name__ == "__main__":
+  main()
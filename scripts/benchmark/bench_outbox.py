@@ -0,0 +1,66 @@
+"""Benchmarks the per websocket send queues with a slow dashboard during a streamed animation.
+
+Every tile publishes a light state at FPS frames per second. Fast dashboards should receive
+every update, the slow dashboard should get coalesced (latest) updates without slowing down
+the others or letting its queue grow."""
+import asyncio
+import time
+from benchutil import print_table
+from outbox import ClientOutbox, OutboxCounters
+
+TILES: int = 100
+FPS: int = 30
+DURATION: float = 2.0 # Seconds
+FAST_CLIENTS: int = 10
+SLOW_SEND_TIME: float = 0.02 # Time a send to the slow dashboard takes (seconds)
+QUEUE_SIZE: int = 1000
+
+class FakeWebsocket:
+  """Stands in for a websocket connection, sending takes send_time seconds."""
+  def __init__(self, send_time: float = 0.0):
+    self.send_time: float = send_time
+    self.received: int = 0
+
+  async def send(self, message: str) -> None:
+    await asyncio.sleep(self.send_time)
+    self.received += 1
+
+async def run() -> tuple[list[ClientOutbox], list[int], float]:
+  totals = OutboxCounters()
+  clients = [FakeWebsocket() for _ in range(FAST_CLIENTS)] + [FakeWebsocket(SLOW_SEND_TIME)]
+  outboxes = [ClientOutbox(client, QUEUE_SIZE, 0.0, totals) for client in clients]
+  for outbox in outboxes:
+    outbox.start()
+  peaks = [0 for _ in outboxes]
+  frames = int(FPS * DURATION)
+  start = time.monotonic()
+  for frame in range(frames):
+    message = '{"frame":' + str(frame) + '}'
+    # Every tile publishes a new light state
+    for tile in range(TILES):
+      for outbox in outboxes:
+        outbox.put((f"TILE{tile+1}", "light"), message)
+    for i, outbox in enumerate(outboxes):
+      peaks[i] = max(peaks[i], outbox.pending)
+    # Wait for the next frame
+    delay = start + (frame + 1) / FPS - time.monotonic()
+    await asyncio.sleep(max(0, delay))
+  # How far behind the publisher the frames ended up (the publisher should never fall behind)
+  lag = time.monotonic() - start - DURATION
+  for outbox in outboxes:
+    await outbox.close()
+  return outboxes, peaks, lag
+
+def main() -> None:
+  outboxes, peaks, lag = asyncio.run(run())
+  updates = int(FPS * DURATION) * TILES
+  rows = []
+  for name, index in [("Fast dashboard", 0), ("Slow dashboard", len(outboxes) - 1)]:
+    counters = outboxes[index].counters
+    rows.append([name, f"{counters.sent} / {updates}", counters.coalesced, counters.dropped, peaks[index]])
+  print(f"{TILES} tiles at {FPS} FPS for {DURATION:.0f} s, {FAST_CLIENTS} fast dashboards + 1 slow dashboard ({SLOW_SEND_TIME * 1000:.0f} ms per send)\n")
+  print_table(["Client", "Sent", "Coalesced", "Dropped", "Peak queue"], rows)
+  print(f"\nPublisher lag after {DURATION:.0f} s: {lag * 1000:.1f} ms")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,56 @@
+"""Benchmarks the pixels of a tile as a list of Pixel objects against a PixelBuffer.
+
+Measures the memory per tile and the cost of the operations the controller and the
+emulator do per light update (copy, compare, fill with one color)."""
+import tracemalloc
+from benchutil import measure, format_ns, print_table
+from pixel import Pixel, PixelBuffer
+
+AMOUNT_OF_PIXELS: int = 12
+TILES: int = 1000
+
+def create_list(offset: int = 0) -> list[Pixel]:
+  return [Pixel((i * 20 + offset) % 256, (255 - i * 20) % 256, 128, 0) for i in range(AMOUNT_OF_PIXELS)]
+
+def measure_memory(create) -> float:
+  """Returns the memory (in bytes) per tile of the pixels created by create."""
+  tracemalloc.start()
+  fleet = [create() for _ in range(TILES)]
+  size, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del fleet
+  return size / TILES
+
+def main() -> None:
+  pixels_list = create_list()
+  other_list = create_list(1)
+  pixels_buffer = PixelBuffer.from_pixels(pixels_list)
+  other_buffer = PixelBuffer.from_pixels(other_list)
+  # Equal values, different objects (the worst case of a compare)
+  equal_list = create_list()
+  equal_buffer = PixelBuffer.from_pixels(equal_list)
+
+  rows = []
+  list_memory = measure_memory(create_list)
+  buffer_memory = measure_memory(lambda: PixelBuffer(AMOUNT_OF_PIXELS))
+  rows.append(["Memory per tile", f"{list_memory:.0f} B", f"{buffer_memory:.0f} B", f"{list_memory / buffer_memory:.1f}x"])
+  operations = [
+    # Copy (the emulator's previous pixels)
+    ("Copy", lambda: [Pixel(pixel.red, pixel.green, pixel.blue, pixel.white) for pixel in pixels_list], lambda: pixels_buffer.copy()),
+    # Compare (has the light state changed?)
+    ("Compare", lambda: pixels_list == equal_list, lambda: pixels_buffer == equal_buffer),
+    # Changed pixels (light deltas)
+    ("Changed pixels", lambda: [i for i in range(AMOUNT_OF_PIXELS) if pixels_list[i].to_dict() != other_list[i].to_dict()], lambda: pixels_buffer.diff(other_buffer)),
+    # Fill with one color (project master rgb command)
+    ("Fill", lambda: [pixel.from_dict({"r": 10, "g": 20, "b": 30, "w": 0}) for pixel in pixels_list], lambda: pixels_buffer.fill(10, 20, 30, 0)),
+  ]
+  for name, list_operation, buffer_operation in operations:
+    list_time = measure(list_operation)
+    buffer_time = measure(buffer_operation)
+    rows.append([name, format_ns(list_time), format_ns(buffer_time), f"{list_time / buffer_time:.1f}x"])
+
+  print(f"{AMOUNT_OF_PIXELS} pixels per tile\n")
+  print_table(["", "list[Pixel]", "PixelBuffer", "Improvement"], rows)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,100 @@
+"""Benchmarks the presence history of a large fleet over months.
+
+Writes synthetic day files (per minute and per hour rollups) for the past days, records a day of
+presence events and heartbeats, and measures recording, querying (from disk and from the cache),
+the memory of the store and the size of the files."""
+import os
+import time
+import random
+import asyncio
+import tempfile
+import numpy as np
+from benchutil import measure, format_ns, print_table
+from presence import PresenceStore, Rollup, RESOLUTIONS, SECONDS_PER_DAY
+
+TILES: int = 1000
+DAYS: int = 90 # Days of history
+EVENTS: int = 100000 # Presence events recorded today
+
+def write_history(store: PresenceStore, today: int) -> None:
+  """Writes random rollups of the past days (like a fleet that detected presence now and then)."""
+  tile_names = [f"TILE{i+1}" for i in range(TILES)]
+  generator = np.random.default_rng(1)
+  for day in range(today - DAYS, today):
+    rollups = {}
+    for resolution, size in RESOLUTIONS.items():
+      rollup = Rollup(size, TILES)
+      rollup.occupied[:] = generator.random(rollup.occupied.shape, dtype=np.float32) * size * (generator.random(rollup.occupied.shape) < 0.1)
+      rollup.detections[:] = rollup.occupied > 0
+      rollup.heartbeats[:] = size // 60
+      rollups[resolution] = rollup
+    # Minute rollups older than the retention are deleted by the write
+    store._write_files(day, tile_names, rollups)
+
+def get_memory(store: PresenceStore) -> int:
+  """Returns the bytes of the arrays the store keeps in memory."""
+  total = sum(ring.times.nbytes + ring.values.nbytes for ring in store._raw.values())
+  rollups = list(store._today.rollups.values()) + [rollup for cache in store._cache.values() for _, rollup in cache.values()]
+  return total + sum(getattr(rollup, column).nbytes for rollup in rollups for column in Rollup.COLUMNS)
+
+def get_disk_size(directory: str) -> int:
+  return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+async def run(directory: str) -> None:
+  now = time.time()
+  today = int(now // SECONDS_PER_DAY)
+  store = PresenceStore(directory)
+  write_history(store, today)
+  store.open(now)
+  # Record a day of events (presence toggles and heartbeats of random tiles, in time order)
+  start = today * SECONDS_PER_DAY
+  times = sorted(random.uniform(start, now) for _ in range(EVENTS))
+  tiles = [f"TILE{random.randint(1, TILES)}" for _ in range(EVENTS)]
+  detected = {}
+  started = time.perf_counter_ns()
+  for t, tile_name in zip(times, tiles):
+    detected[tile_name] = not detected.get(tile_name, False)
+    store.record_presence(tile_name, detected[tile_name], t)
+  presence_ns = (time.perf_counter_ns() - started) / EVENTS
+  started = time.perf_counter_ns()
+  for t, tile_name in zip(times, tiles):
+    store.record_heartbeat(tile_name, t)
+  heartbeat_ns = (time.perf_counter_ns() - started) / EVENTS
+  flush_started = time.perf_counter_ns()
+  await store.flush()
+  flush_ns = time.perf_counter_ns() - flush_started
+
+  all_tiles = [f"TILE{i+1}" for i in range(TILES)]
+  queries = [
+    ("1 tile, last day, minute", ["TILE1"], now - SECONDS_PER_DAY, now, "minute"),
+    ("all tiles, last day, minute", all_tiles, now - SECONDS_PER_DAY, now, "minute"),
+    ("all tiles, last week, minute", all_tiles, now - 7 * SECONDS_PER_DAY, now, "minute"),
+    ("all tiles, last month, hour", all_tiles, now - 30 * SECONDS_PER_DAY, now, "hour"),
+    (f"all tiles, last {DAYS} days, hour", all_tiles, now - DAYS * SECONDS_PER_DAY, now, "hour")
+  ]
+  rows = []
+  for name, tile_names, query_start, query_end, resolution in queries:
+    # Cold: the past days are read from disk
+    for cache in store._cache.values():
+      cache.clear()
+    started = time.perf_counter_ns()
+    result = await store.query(tile_names, query_start, query_end, resolution, now)
+    cold = time.perf_counter_ns() - started
+    started = time.perf_counter_ns()
+    await store.query(tile_names, query_start, query_end, resolution, now)
+    warm = time.perf_counter_ns() - started
+    rows.append([name, len(result["buckets"]), format_ns(cold), format_ns(warm)])
+  raw = measure(lambda: store.query_events(all_tiles, now - SECONDS_PER_DAY, now))
+
+  print(f"{TILES} tiles, {DAYS} days of history, {EVENTS} presence events and heartbeats today\n")
+  print_table(["Query", "Buckets", "From disk", "Cached"], rows)
+  print(f"\nRaw events of all tiles (last {store.raw_capacity} per tile): {format_ns(raw)}")
+  print(f"Record presence: {format_ns(presence_ns)} per event, heartbeat: {format_ns(heartbeat_ns)} per event, flush of today: {format_ns(flush_ns)}")
+  print(f"Memory of the store: {get_memory(store) / 1e6:.1f} MB, files on disk: {get_disk_size(directory) / 1e6:.1f} MB ({len(os.listdir(directory))} files)")
+
+def main() -> None:
+  with tempfile.TemporaryDirectory() as directory:
+    asyncio.run(run(directory))
+
+if __name__ == "__main__":
+  main()
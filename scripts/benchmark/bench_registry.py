@@ -0,0 +1,80 @@
+"""Benchmarks tile lookups and websocket disconnects as the fleet grows.
+
+Compares the registry against the linear list scans the controller used before."""
+from benchutil import measure, format_ns, print_table
+from registry import TileRegistry
+from tile import Tile
+
+FLEET_SIZES: list[int] = [10, 100, 1000, 5000]
+CLIENTS: int = 50 # Connected dashboards
+SUBSCRIPTIONS_PER_CLIENT: int = 10 # Tiles each dashboard is subscribed to
+
+class FakeWebsocket:
+  """Stands in for a websocket connection (only needs to be hashable)."""
+  pass
+
+def build_fleet(size: int) -> tuple[TileRegistry, list[Tile], dict[str, list], list[FakeWebsocket]]:
+  """Creates a registry and the equivalent legacy lists with the same subscriptions."""
+  registry = TileRegistry()
+  tiles: list[Tile] = []
+  channel_states: dict[str, list] = {}
+  for i in range(size):
+    tile = Tile(f"TILE{i+1}")
+    registry.add(tile)
+    tiles.append(tile)
+    channel_states[tile.device_name] = []
+  clients = [FakeWebsocket() for _ in range(CLIENTS)]
+  for c, client in enumerate(clients):
+    for s in range(SUBSCRIPTIONS_PER_CLIENT):
+      tile_name = tiles[(c * SUBSCRIPTIONS_PER_CLIENT + s) % size].device_name
+      registry.subscribe_state(client, tile_name)
+      if client not in channel_states[tile_name]:
+        channel_states[tile_name].append(client)
+  return registry, tiles, channel_states, clients
+
+def main() -> None:
+  rows = []
+  for size in FLEET_SIZES:
+    registry, tiles, channel_states, clients = build_fleet(size)
+    # Worst case lookup for the linear scan: the last tile in the list
+    name = tiles[-1].device_name
+
+    def legacy_lookup():
+      for tile in tiles:
+        if tile.device_name == name:
+          return tile
+      return None
+
+    def registry_lookup():
+      return registry.get(name)
+
+    # Disconnect of a client with SUBSCRIPTIONS_PER_CLIENT subscriptions (resubscribed every run)
+    client = FakeWebsocket()
+    client_tiles = [tiles[i % size].device_name for i in range(SUBSCRIPTIONS_PER_CLIENT)]
+
+    def legacy_disconnect():
+      for tile_name in client_tiles:
+        if client not in channel_states[tile_name]:
+          channel_states[tile_name].append(client)
+      for tile_name in channel_states:
+        if client in channel_states[tile_name]:
+          channel_states[tile_name].remove(client)
+
+    def registry_disconnect():
+      for tile_name in client_tiles:
+        registry.subscribe_state(client, tile_name)
+      registry.remove_client(client)
+
+    rows.append([
+      size,
+      format_ns(measure(legacy_lookup)),
+      format_ns(measure(registry_lookup)),
+      format_ns(measure(legacy_disconnect)),
+      format_ns(measure(registry_disconnect)),
+    ])
+
+  print(f"{CLIENTS} clients, {SUBSCRIPTIONS_PER_CLIENT} subscriptions per client\n")
+  print_table(["Tiles", "Lookup (list)", "Lookup (registry)", "Disconnect (lists)", "Disconnect (registry)"], rows)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,118 @@
+"""Benchmarks the frame scheduler: does a 30 fps effect over 300 tiles hold 30 fps?
+
+Runs the effect for a few seconds while other work (like processing MQTT messages)
+blocks the event loop now and then, with the frame scheduler and with a plain
+"render, then sleep one frame" loop, and reports the achieved frame rate and lateness.
+Then streams light commands to the controller (queue_light_command of main.py) faster than the
+frame rate, and checks that they are coalesced to at most one publish per frame."""
+import os
+import time
+import random
+import asyncio
+from benchutil import print_table
+from effects import EffectsEngine
+from lightframe import encode_light_frame
+from pixel import PixelBuffer
+from metrics import Histogram
+from scheduler import FrameScheduler, LATENESS_BOUNDS
+
+TILES: int = 300
+FPS: float = 30.0
+DURATION: float = 3.0 # Seconds per run
+LOAD_INTERVAL: float = 0.05 # Other work every 50 ms ...
+LOAD_MAX: float = 0.04 # ... that blocks the event loop for up to 40 ms
+COMMANDS: int = 100 # Streamed light commands ...
+COMMAND_INTERVAL: float = 0.002 # ... one every 2 ms
+
+def create_engine() -> EffectsEngine:
+  engine = EffectsEngine()
+  engine.start("rainbow", [f"TILE{i+1}" for i in range(TILES)], {}, 0.0)
+  return engine
+
+def render_frame(engine: EffectsEngine, t: float) -> None:
+  """Renders a frame and encodes the light frames (like the controller does before publishing)."""
+  for tile_name, pixel_bytes, brightness in engine.render(t):
+    encode_light_frame(brightness, PixelBuffer(data=pixel_bytes))
+
+async def load(stop: asyncio.Event) -> None:
+  """Blocks the event loop for a random time, every LOAD_INTERVAL seconds."""
+  generator = random.Random(1)
+  while not stop.is_set():
+    await asyncio.sleep(LOAD_INTERVAL)
+    end = time.perf_counter() + generator.uniform(0, LOAD_MAX)
+    while time.perf_counter() < end:
+      pass
+
+async def run_scheduler() -> dict:
+  engine = create_engine()
+  scheduler = FrameScheduler(FPS, window=DURATION)
+  loop = asyncio.get_running_loop()
+  end = loop.time() + DURATION
+  def tick(deadline: float) -> bool:
+    render_frame(engine, deadline)
+    return loop.time() < end
+  scheduler.add_callback(tick)
+  stop = asyncio.Event()
+  load_task = asyncio.create_task(load(stop))
+  scheduler.wake()
+  await scheduler._task
+  stop.set()
+  await load_task
+  return {"frames": scheduler.ticks, "skipped": scheduler.skipped, "lateness": scheduler.lateness}
+
+async def run_sleep_loop() -> dict:
+  engine = create_engine()
+  loop = asyncio.get_running_loop()
+  lateness = Histogram(LATENESS_BOUNDS)
+  stop = asyncio.Event()
+  load_task = asyncio.create_task(load(stop))
+  start = loop.time()
+  frames = 0
+  while loop.time() < start + DURATION:
+    # Lateness against the frame's intended time (start + frame / fps)
+    lateness.observe(max(0.0, loop.time() - (start + frames / FPS)))
+    render_frame(engine, loop.time())
+    frames += 1
+    await asyncio.sleep(1 / FPS)
+  stop.set()
+  await load_task
+  return {"frames": frames, "skipped": 0, "lateness": lateness}
+
+async def run_light_commands() -> dict:
+  """Streams light commands for one tile through the controller, counts what it publishes."""
+  os.environ.setdefault("MQTT_PORT", "1883")
+  import main as controller
+  controller.scheduler = FrameScheduler(FPS)
+  controller.scheduler.add_callback(controller.light_commands_tick)
+  published = []
+  loop = asyncio.get_running_loop()
+  # Count the publishes instead of sending them
+  controller.mqtt_send_command_to_tiles = lambda *args: published.append(loop.time())
+  tiles = [controller.Tile("TILE1")]
+  pixels = PixelBuffer(12)
+  for i in range(COMMANDS):
+    pixels.fill(i % 256, 0, 0, 0)
+    controller.queue_light_command(tiles, None, 100, pixels)
+    await asyncio.sleep(COMMAND_INTERVAL)
+  # Let the last command go out
+  while controller.scheduler.running:
+    await asyncio.sleep(1 / FPS)
+  seconds = published[-1] - published[0]
+  return {"published": len(published), "coalesced": controller.light_commands_coalesced, "rate": (len(published) - 1) / seconds if seconds > 0 else 0.0}
+
+def main() -> None:
+  rows = []
+  for name, run in [("sleep(1/fps) loop", run_sleep_loop), ("FrameScheduler", run_scheduler)]:
+    result = asyncio.run(run())
+    lateness = result["lateness"]
+    rows.append([name, f"{result['frames'] / DURATION:.1f}", result["skipped"], f"{lateness.percentile(50) * 1000:.1f} ms", f"{lateness.percentile(95) * 1000:.1f} ms", f"{lateness.percentile(99) * 1000:.1f} ms", f"{lateness.max * 1000:.1f} ms"])
+  print(f"Rainbow over {TILES} tiles at {FPS:.0f} fps for {DURATION:.0f} s, event loop blocked up to {LOAD_MAX * 1000:.0f} ms every {LOAD_INTERVAL * 1000:.0f} ms\n")
+  print_table(["Loop", "Achieved fps", "Skipped", "Lateness p50", "p95", "p99", "max"], rows)
+  print("\n(lateness percentiles are bucket upper bounds; the sleep loop's lateness grows because it drifts)")
+
+  result = asyncio.run(run_light_commands())
+  print(f"\n{COMMANDS} light commands for one tile, one every {COMMAND_INTERVAL * 1000:.0f} ms ({1 / COMMAND_INTERVAL:.0f} per second), at most {FPS:.0f} fps\n")
+  print_table(["Published", "Coalesced", "Publish rate", "Capped"], [[result["published"], result["coalesced"], f"{result['rate']:.1f}/s", "yes" if result["rate"] <= FPS * 1.05 and result["published"] + result["coalesced"] == COMMANDS else "NO"]])
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,62 @@
+"""Benchmarks subscribing dashboards to the full state of a large fleet.
+
+Compares rebuilding and encoding the full state for every subscription against
+the cached, versioned JSON snapshots of the tiles."""
+import json
+import time
+from benchutil import format_ns, print_table
+from messages import create_tile_state_message
+from tile import Tile, StateType
+
+TILES: int = 1000
+DASHBOARDS: list[int] = [1, 10, 50]
+EXTRAPOLATE_TO: int = 500 # Dashboards to extrapolate the total time to
+
+def create_fleet() -> list[Tile]:
+  """Creates tiles with a realistic state (like the emulator publishes)."""
+  system = json.dumps({"firmware": "0.0.6", "hardware": "0.0.2", "ping": False, "uptime": 1234, "sounds": [f"Sound {i+1}" for i in range(52)]})
+  audio = json.dumps({"state": 0, "looping": False, "sound": "Sound 1", "volume": 50})
+  light = json.dumps({"brightness": 100, "pixels": [{"r": i * 20, "g": 255 - i * 20, "b": 128, "w": 0} for i in range(12)]})
+  presence = json.dumps({"detected": False})
+  fleet = []
+  for i in range(TILES):
+    tile = Tile(f"TILE{i+1}")
+    tile.update_state(StateType.ONLINE, "ONLINE")
+    tile.update_state(StateType.SYSTEM, system)
+    tile.update_state(StateType.AUDIO, audio)
+    tile.update_state(StateType.LIGHT, light)
+    tile.update_state(StateType.PRESENCE, presence)
+    fleet.append(tile)
+  return fleet
+
+def legacy_message(tile: Tile) -> str:
+  """Rebuilds the full state dictionary and encodes it."""
+  return json.dumps({"action": "state", "type": "full", "tile": tile.device_name, "args": tile.get_state(StateType.FULL)}, indent=4)
+
+def subscribe_all(fleet: list[Tile], dashboards: int, create_message) -> float:
+  """Creates the full state message of every tile for every dashboard, returns the time in nanoseconds."""
+  start = time.perf_counter_ns()
+  for _ in range(dashboards):
+    for tile in fleet:
+      create_message(tile)
+  return time.perf_counter_ns() - start
+
+def main() -> None:
+  fleet = create_fleet()
+  rows = []
+  for dashboards in DASHBOARDS:
+    # Every dashboard subscribes after one tile (out of 10) changed its presence state
+    for tile in fleet[::10]:
+      tile.update_state(StateType.PRESENCE, json.dumps({"detected": not tile.detected}))
+    legacy = subscribe_all(fleet, dashboards, legacy_message)
+    cached = subscribe_all(fleet, dashboards, lambda tile: create_tile_state_message(tile, StateType.FULL))
+    rows.append([dashboards, format_ns(legacy / (dashboards * TILES)), format_ns(cached / (dashboards * TILES)), format_ns(legacy), format_ns(cached)])
+  # Extrapolate the last measurement
+  legacy_per_message = legacy / (DASHBOARDS[-1] * TILES)
+  cached_per_message = cached / (DASHBOARDS[-1] * TILES)
+  print(f"{TILES} tiles, full state subscriptions\n")
+  print_table(["Dashboards", "Per message (rebuild)", "Per message (snapshot)", "Total (rebuild)", "Total (snapshot)"], rows)
+  print(f"\nExtrapolated to {EXTRAPOLATE_TO} dashboards: {format_ns(legacy_per_message * EXTRAPOLATE_TO * TILES)} (rebuild) vs {format_ns(cached_per_message * EXTRAPOLATE_TO * TILES)} (snapshot)")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,80 @@
+"""Benchmarks the on-disk snapshot of the registry (warm restart of the controller).
+
+Measures the longest time saving blocks the event loop (collecting the changed tiles, in chunks)
+against the time the whole save takes (the write runs in a worker thread), for a full save and for a save after 10% of the tiles changed,
+and how long loading the snapshot at startup takes."""
+import os
+import json
+import time
+import asyncio
+import tempfile
+from benchutil import print_table
+from registry import TileRegistry
+from snapshot import RegistrySnapshot
+from tile import Tile, StateType
+from bench_snapshot import create_fleet
+
+TILES: int = 1000
+GROUPS: int = 20
+
+def create_registry() -> TileRegistry:
+  registry = TileRegistry()
+  for tile in create_fleet():
+    registry.add(tile)
+  for i in range(GROUPS):
+    registry.set_group(f"group{i}", {f"TILE{j+1}" for j in range(i * 10, i * 10 + 10)})
+  return registry
+
+async def save(snapshot: RegistrySnapshot, registry: TileRegistry) -> tuple[float, float]:
+  """Saves and returns the longest time the event loop was blocked and the time the save took (in seconds)."""
+  loop = asyncio.get_running_loop()
+  longest = 0.0
+  saving = True
+  async def watch() -> None:
+    # Measures the time between two turns of the event loop
+    nonlocal longest
+    previous = loop.time()
+    while saving:
+      await asyncio.sleep(0)
+      now = loop.time()
+      longest = max(longest, now - previous)
+      previous = now
+  watcher = asyncio.create_task(watch())
+  await asyncio.sleep(0)
+  started = time.perf_counter()
+  await snapshot.save(registry)
+  duration = time.perf_counter() - started
+  saving = False
+  await watcher
+  return longest, duration
+
+def main() -> None:
+  registry = create_registry()
+  rows = []
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "snapshot.db")
+    snapshot = RegistrySnapshot(path)
+    snapshot.open()
+    blocked, written = asyncio.run(save(snapshot, registry))
+    rows.append([f"Save all {TILES} tiles", f"{blocked * 1000:.2f} ms", f"{written * 1000:.2f} ms"])
+    # Change the presence of 10% of the tiles
+    for tile in registry.tiles[:TILES // 10]:
+      tile.update_state(StateType.PRESENCE, json.dumps({"detected": not tile.detected}))
+    blocked, written = asyncio.run(save(snapshot, registry))
+    rows.append([f"Save {TILES // 10} changed tiles", f"{blocked * 1000:.2f} ms", f"{written * 1000:.2f} ms"])
+    blocked, written = asyncio.run(save(snapshot, registry))
+    rows.append(["Save without changes", f"{blocked * 1000:.2f} ms", f"{written * 1000:.2f} ms"])
+    snapshot.close()
+    size = os.path.getsize(path) # (closing checkpoints the write ahead log into the database)
+    # Load into an empty registry (like a restarted controller)
+    snapshot = RegistrySnapshot(path)
+    snapshot.open()
+    started = time.perf_counter()
+    loaded = snapshot.load(TileRegistry())
+    load_time = time.perf_counter() - started
+    snapshot.close()
+  print_table(["Operation", "Longest event loop block", "Save"], rows)
+  print(f"\nLoading {len(loaded)} tiles and {GROUPS} groups at startup: {load_time * 1000:.2f} ms, database size {size / 1024:.0f} KiB")
+
+if __name__ == "__main__":
+  main()
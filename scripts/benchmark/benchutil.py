@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import logging
+
+# --- Paths ---
+# The controller modules are imported flat (like main.py does), so add its folder to the path
+ROOT_DIR: str = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+CONTROL_DIR: str = os.path.join(ROOT_DIR, "server", "control")
+if CONTROL_DIR not in sys.path:
+  sys.path.insert(0, CONTROL_DIR)
+
+# --- Configure logging ---
+# Measure the hot paths, not the (info) log messages
+logging.disable(logging.INFO)
+
+# --- MQTT broker ---
+_broker_thread = None # In-process broker of the benchmarks (started on first use)
+
+def get_broker_address() -> tuple[str, str]:
+  """Returns the host and port of the MQTT broker the benchmarks use: MQTT_SERVER and MQTT_PORT if set, else an
+  in-process broker (broker.py of the controller) on a free port, so the results don't depend on the broker
+  that happens to be around and the benchmarks run offline."""
+  global _broker_thread
+  if os.getenv("MQTT_SERVER") is not None:
+    return os.getenv("MQTT_SERVER"), os.getenv("MQTT_PORT", "1883")
+  if _broker_thread is None:
+    from broker import Broker, BrokerThread
+    _broker_thread = BrokerThread(Broker("127.0.0.1", 0))
+    _broker_thread.start()
+  return _broker_thread.broker.host, str(_broker_thread.broker.port)
+
+def get_broker():
+  """Returns the in-process broker (for its statistics), None if the benchmarks use an external broker."""
+  return _broker_thread.broker if _broker_thread is not None else None
+
+# --- Functions ---
+def measure(function, repeat: int = 5, min_time: float = 0.05) -> float:
+  """Runs the function repeatedly and returns the best time per call in nanoseconds."""
+  # Find the amount of calls needed to run for at least min_time seconds
+  number = 1
+  while True:
+    start = time.perf_counter_ns()
+    for _ in range(number):
+      function()
+    elapsed = time.perf_counter_ns() - start
+    if elapsed >= min_time * 1e9:
+      break
+    number *= 2
+  # Take the best of `repeat` runs (the least disturbed by other processes)
+  best = elapsed / number
+  for _ in range(repeat - 1):
+    start = time.perf_counter_ns()
+    for _ in range(number):
+      function()
+    best = min(best, (time.perf_counter_ns() - start) / number)
+  return best
+
+def format_ns(value: float) -> str:
+  """Formats a duration in nanoseconds to a human readable string."""
+  if value >= 1e9:
+    return f"{value / 1e9:.2f} s"
+  if value >= 1e6:
+    return f"{value / 1e6:.2f} ms"
+  if value >= 1e3:
+    return f"{value / 1e3:.2f} us"
+  return f"{value:.0f} ns"
+
+def print_table(headers: list[str], rows: list[list], file=None) -> None:
+  """Prints the rows as an aligned table (to stdout, or the given file)."""
+  widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+  print(" | ".join(str(header).ljust(width) for header, width in zip(headers, widths)), file=file)
+  print("-+-".join("-" * width for width in widths), file=file)
+  for row in rows:
+    print(" | ".join(str(cell).ljust(width) for cell, width in zip(row, widths)), file=file)
+
+class NullTransport:
+  """Transport that throws away everything written to it (counts the bytes)."""
+  def __init__(self):
+    self.bytes_written: int = 0
+
+  def write(self, data: bytes) -> None:
+    self.bytes_written += len(data)
+
+  def get_write_buffer_size(self) -> int:
+    return 0
+
+  def set_write_buffer_limits(self, high: int = None, low: int = None) -> None:
+    pass
+
+  def is_closing(self) -> bool:
+    return False
+
+  def can_write_eof(self) -> bool:
+    return False
+
+  def get_extra_info(self, name: str, default=None):
+    return default
+
+  def close(self) -> None:
+    pass
+
+  def abort(self) -> None:
+    pass
+
+def create_websocket():
+  """Creates an open server side websocket connection that writes to a NullTransport.
+
+  Must be called from a running event loop."""
+  from websockets.legacy.protocol import WebSocketCommonProtocol
+  websocket = WebSocketCommonProtocol()
+  websocket.is_client = False
+  websocket.connection_made(NullTransport())
+  websocket.connection_open()
+  return websocket
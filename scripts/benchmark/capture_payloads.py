@@ -0,0 +1,97 @@
+"""Captures the state messages the emulator publishes, as realistic payloads for the micro-benchmarks.
+
+Starts the emulator (once with JSON light states and once with binary light frames), sends it light,
+audio and system commands like the controller does, and saves the distinct payloads of every state
+subtopic to payloads.json (binary payloads as base64).
+
+Uses the MQTT broker at MQTT_SERVER and MQTT_PORT (an in-process broker if not set)."""
+import os
+import json
+import time
+import base64
+import random
+import threading
+import paho.mqtt.client as mqtt
+from bench_discovery import MQTT_SERVER, MQTT_PORT, start_emulator, stop
+from lightframe import FRAME_SUBTOPIC
+from pixel import PixelBuffer
+from tile import create_light_command, create_audio_command, create_system_command
+
+TILES: int = 4
+COMMANDS: int = 20 # Commands per tile (light, audio and system)
+SAMPLES: int = 16 # Maximum distinct payloads kept per subtopic
+PAYLOADS_FILE: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads.json")
+
+def create_commands() -> list[tuple[str, str]]:
+  """Creates the commands (subtopic, payload) a dashboard would make the controller send."""
+  commands = []
+  for i in range(COMMANDS):
+    pixels = PixelBuffer.from_dicts([{"r": random.randint(0, 255), "g": random.randint(0, 255), "b": random.randint(0, 255), "w": random.choice([0, 0, 255])} for _ in range(12)])
+    commands.append(("light", create_light_command(random.randint(0, 100), pixels)))
+    if i % 4 == 0:
+      commands.append(("audio", create_audio_command(random.choice([1, 2, 3, 4]), random.choice([False, True]), f"Sound {random.randint(1, 52)}", random.randint(0, 30))))
+    if i % 8 == 0:
+      commands.append(("system", create_system_command(False, i % 16 == 0)))
+  return commands
+
+def capture(light_frames: bool) -> dict[str, dict]:
+  """Runs the emulator, sends it commands and returns the distinct payloads it published per subtopic (in order)."""
+  # Unique root topic, so retained messages of earlier runs don't count
+  root_topic = "capture" + str(time.time_ns())
+  payloads: dict[str, dict] = {} # Subtopic -> payloads (a dict keeps the order)
+  lock = threading.Lock()
+
+  def on_message(client, userdata, message):
+    topic_parts = message.topic.split("/")
+    subtopic = "online" if topic_parts[-1] == "self" else topic_parts[-1]
+    payload = message.payload if subtopic == FRAME_SUBTOPIC else message.payload.decode("utf-8")
+    # Retained messages are cleared with empty payloads
+    if len(payload) > 0:
+      with lock:
+        payloads.setdefault(subtopic, {})[payload] = None
+
+  client = mqtt.Client()
+  client.on_message = on_message
+  client.connect(MQTT_SERVER, int(MQTT_PORT))
+  client.subscribe(root_topic + "/+/self")
+  client.subscribe(root_topic + "/+/self/state/#")
+  client.loop_start()
+  os.environ["LIGHT_FRAMES"] = "true" if light_frames else "false"
+  os.environ["RANDOM_PRESENCE"] = "true"
+  emulator = start_emulator(root_topic, TILES)
+  try:
+    time.sleep(2)
+    for subtopic, payload in create_commands():
+      for i in range(TILES):
+        client.publish(f"{root_topic}/TILE{i+1}/self/command/{subtopic}", payload)
+      # Give the tiles time to publish their new state (they publish changes, not every command)
+      time.sleep(0.05)
+    time.sleep(1)
+  finally:
+    stop(emulator)
+    time.sleep(0.5)
+    # Clear the retained messages of the emulator
+    for i in range(TILES):
+      client.publish(f"{root_topic}/TILE{i+1}/self", "", retain=True)
+      for subtopic in ["system", "audio", "light", FRAME_SUBTOPIC, "presence"]:
+        client.publish(f"{root_topic}/TILE{i+1}/self/state/{subtopic}", "", retain=True)
+    client.loop_stop()
+    client.disconnect()
+  return payloads
+
+def main() -> None:
+  payloads = capture(False)
+  for subtopic, values in capture(True).items():
+    payloads.setdefault(subtopic, {}).update(values)
+  states = {}
+  for subtopic, values in sorted(payloads.items()):
+    # The last payloads, after the commands changed the states
+    values = list(values)[-SAMPLES:]
+    states[subtopic] = [base64.b64encode(value).decode("ascii") for value in values] if subtopic == FRAME_SUBTOPIC else values
+  with open(PAYLOADS_FILE, "w") as file:
+    json.dump({"captured": time.strftime("%Y-%m-%d"), "states": states}, file, indent=2)
+    file.write("\n")
+  print("Captured " + ", ".join(f"{len(values)} {subtopic}" for subtopic, values in states.items()) + " payloads to " + PAYLOADS_FILE)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,127 @@
+"""Runs the micro-benchmarks (bench_model.py) and compares them with a saved baseline.
+
+  python run.py                                  # prints the results
+  python run.py --save-baseline baseline.json    # saves the results as baseline
+  python run.py --baseline baseline.json         # compares with the baseline, exits with 1 on a regression
+  python run.py --json results.json --filter "^tile\\."
+
+Baselines are only comparable on the same machine and Python version (a warning is printed
+when they differ), so save one on the machine the comparison runs on."""
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+from benchutil import measure, format_ns, print_table
+from bench_model import PAYLOADS_FILE, get_benchmarks, load_payloads
+
+FORMAT_VERSION: int = 1 # Version of the JSON results (baselines with another version aren't compared)
+
+def get_environment() -> dict:
+  """Returns what the results depend on, besides the code."""
+  return {
+    "python": platform.python_implementation() + " " + platform.python_version(),
+    "machine": platform.machine(),
+    "processor": platform.processor(),
+    "system": platform.system() + " " + platform.release()
+  }
+
+def get_selected_benchmarks(pattern: str | None) -> dict:
+  """Returns the benchmarks whose name matches the pattern (all without pattern)."""
+  benchmarks = get_benchmarks(load_payloads())
+  if pattern is None:
+    return benchmarks
+  return {name: function for name, function in benchmarks.items() if re.search(pattern, name)}
+
+def compare(results: dict[str, float], baseline: dict, threshold: float, remeasure) -> tuple[list[list], list[str]]:
+  """Compares the results with the baseline, returns the table rows and the names of the regressed benchmarks.
+
+  A benchmark that looks slower than the threshold is measured again (remeasure(name) -> time), and only
+  counts as regression if it is still slower, so a single disturbed measurement doesn't fail the run."""
+  rows = []
+  regressions = []
+  baseline_results = baseline["results"]
+  for name, value in results.items():
+    if name not in baseline_results:
+      rows.append([name, format_ns(value), "-", "-", "new"])
+      continue
+    if value > baseline_results[name] * (1 + threshold):
+      value = results[name] = min(value, remeasure(name))
+    ratio = value / baseline_results[name]
+    if ratio > 1 + threshold:
+      status = "SLOWER"
+      regressions.append(name)
+    elif ratio < 1 / (1 + threshold):
+      status = "faster"
+    else:
+      status = "ok"
+    rows.append([name, format_ns(value), format_ns(baseline_results[name]), f"{(ratio - 1) * 100:+.1f}%", status])
+  return rows, regressions
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description="Runs the micro-benchmarks of the controller's data model and codecs.")
+  parser.add_argument("--filter", help="only run the benchmarks whose name matches this regular expression")
+  parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the best run counts (default: 5)")
+  parser.add_argument("--min-time", type=float, default=0.05, help="minimum seconds per run (default: 0.05)")
+  parser.add_argument("--json", help="writes the results as JSON to this file (- for stdout)")
+  parser.add_argument("--save-baseline", help="writes the results as baseline to this file")
+  parser.add_argument("--baseline", help="compares the results with this baseline")
+  parser.add_argument("--threshold", type=float, default=0.25, help="fraction a benchmark may be slower than the baseline (default: 0.25)")
+  args = parser.parse_args()
+
+  started = time.monotonic()
+  benchmarks = get_selected_benchmarks(args.filter)
+  results = {name: measure(function, args.repeat, args.min_time) for name, function in benchmarks.items()}
+  with open(PAYLOADS_FILE) as file:
+    captured = json.load(file).get("captured")
+  output = {
+    "version": FORMAT_VERSION,
+    "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "environment": get_environment(),
+    "payloads": captured,
+    "settings": {"repeat": args.repeat, "min_time": args.min_time},
+    "unit": "ns",
+    "results": results
+  }
+
+  regressions = []
+  # Human readable output goes to stderr when the JSON goes to stdout
+  out = sys.stderr if args.json == "-" else sys.stdout
+  if args.baseline is not None:
+    with open(args.baseline) as file:
+      baseline = json.load(file)
+    if baseline.get("version") != FORMAT_VERSION:
+      print("Baseline " + args.baseline + " has another format version, run with --save-baseline to replace it", file=sys.stderr)
+      return 2
+    if baseline.get("environment") != output["environment"]:
+      print("Warning: the baseline was made in another environment (" + str(baseline.get("environment")) + "), the times may not be comparable", file=sys.stderr)
+    remeasure = lambda name: measure(benchmarks[name], args.repeat, args.min_time)
+    rows, regressions = compare(results, baseline, args.threshold, remeasure)
+    missing = [name for name in baseline["results"] if name not in results and (args.filter is None or re.search(args.filter, name))]
+    print_table(["Benchmark", "Time", "Baseline", "Change", "Status"], rows, out)
+    if len(missing) > 0:
+      print("\nNot in this run (removed or renamed): " + ", ".join(missing), file=out)
+    if len(regressions) > 0:
+      print(f"\n{len(regressions)} benchmarks are more than {args.threshold * 100:.0f}% slower than the baseline: " + ", ".join(regressions), file=out)
+    else:
+      print(f"\nNo regressions (threshold {args.threshold * 100:.0f}%)", file=out)
+  else:
+    print_table(["Benchmark", "Time"], [[name, format_ns(value)] for name, value in results.items()], out)
+  print(f"{len(results)} benchmarks in {time.monotonic() - started:.1f} s", file=out)
+
+  if args.json is not None:
+    text = json.dumps(output, indent=2)
+    if args.json == "-":
+      print(text)
+    else:
+      with open(args.json, "w") as file:
+        file.write(text + "\n")
+  if args.save_baseline is not None:
+    with open(args.save_baseline, "w") as file:
+      file.write(json.dumps(output, indent=2) + "\n")
+    print("Saved the baseline to " + args.save_baseline, file=out)
+  return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
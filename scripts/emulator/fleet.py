@@ -0,0 +1,216 @@
+from tile import Tile
+from mqtt_async import AsyncMqttClient
+from typing import Callable
+import multiprocessing
+import threading
+import asyncio
+import logging
+import random
+import time
+import os
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows (no file descriptor limit to raise, no peak memory)
+  resource = None
+
+# The tiles (re)connect on their own, a warning per tile drowns the report of the fleet
+logging.getLogger("mqtt_async").setLevel(logging.ERROR)
+
+CONNECT_BATCH: int = 100 # Tiles that connect at the same time (brokers have a small listen backlog)
+CONNECT_TIMEOUT: float = 10.0 # Seconds to wait for a batch to connect before starting the next batch
+
+class AsyncTile(Tile):
+  """Tile that runs as a coroutine, so thousands of tiles fit in one process.
+
+  Uses the state logic and timers of Tile, with an MQTT client that runs on the event loop (see mqtt_async.py)."""
+  def _create_mqtt_client(self) -> AsyncMqttClient:
+    return AsyncMqttClient()
+
+  def _reboot_tile(self, device_name: str) -> None:
+    super()._reboot_tile(device_name)
+    self._wake: asyncio.Event = asyncio.Event() # Set when the states have to be updated before the next timer (only set from the event loop)
+    self.connected: asyncio.Event = asyncio.Event() # Set when the tile is connected (the first time)
+
+  def _on_mqtt_connect(self, client, userdata, flags, rc):
+    super()._on_mqtt_connect(client, userdata, flags, rc)
+    self.connected.set()
+
+  async def run(self, stop_event: asyncio.Event) -> None:
+    """Runs the tile until the stop_event is set (call wake after setting it, to stop right away)."""
+    # Connect to MQTT (keeps reconnecting until cancelled)
+    self._configure_mqtt()
+    connection = asyncio.create_task(self._mqtt_client.run(self._MQTT_HOST, self._MQTT_PORT))
+    try:
+      while not stop_event.is_set():
+        # Wait for a command, presence change or timer
+        try:
+          await asyncio.wait_for(self._wake.wait(), self._get_timeout())
+        except asyncio.TimeoutError:
+          pass
+        self._wake.clear()
+        if stop_event.is_set():
+          break
+
+        # Check if reboot is requested
+        if self._reboot:
+          await self._disconnect_from_mqtt_async(connection)
+          # Reboot (creates a new MQTT client) and connect again
+          self._reboot_tile(self._device_name)
+          self._configure_mqtt()
+          connection = asyncio.create_task(self._mqtt_client.run(self._MQTT_HOST, self._MQTT_PORT))
+          continue
+
+        # Update the states and publish the ones that changed
+        if self._mqtt_client.is_connected():
+          self._publish_changes()
+    finally:
+      # Graceful exit
+      await self._disconnect_from_mqtt_async(connection)
+
+  async def _disconnect_from_mqtt_async(self, connection: asyncio.Task) -> None:
+    """Publishes the offline message, disconnects from MQTT and stops reconnecting."""
+    connection.cancel()
+    if self._mqtt_client.is_connected():
+      self._mqtt_client.publish(f"{self._ROOT_TOPIC}/{self._device_name}/self", "OFFLINE", 1, retain=True)
+    try:
+      await asyncio.wait_for(self._mqtt_client.disconnect(), 5)
+    except asyncio.TimeoutError:
+      pass
+
+async def random_presence_detection(tile: AsyncTile, stop_event: asyncio.Event) -> None:
+  """Simulates random presence detection (like random_presence_detection in main.py, as a coroutine)."""
+  MIN = 1
+  MAX = 10
+  while not stop_event.is_set():
+    gen = random.randint(MIN, MAX)
+    tile.set_presence(gen > MAX / 2)
+    try:
+      await asyncio.wait_for(stop_event.wait(), gen)
+    except asyncio.TimeoutError:
+      pass
+
+def get_memory() -> int | None:
+  """Returns the resident memory of this process in bytes (None if unknown)."""
+  try:
+    with open("/proc/self/statm") as file:
+      return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    pass
+  if resource is not None:
+    # Peak memory, in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+  return None
+
+def raise_file_limit(amount: int) -> None:
+  """Raises the limit of open files (one socket per tile) as far as allowed, warns if it's too low."""
+  if resource is None:
+    return
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft != resource.RLIM_INFINITY and soft < hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    soft = hard
+  if soft != resource.RLIM_INFINITY and soft < amount + 64:
+    print(f"Warning: at most {soft} open files are allowed, not enough for {amount} tiles (raise the limit with ulimit -n)")
+
+async def run_fleet(names: list[str], stop_event: threading.Event, random_presence: bool = False, on_started: Callable[[dict], None] = None) -> list[float]:
+  """Runs the tiles with the given names as coroutines until the stop_event (of a thread or process) is set.
+
+  on_started is called with the startup report when all tiles are connected (or failed to connect in time).
+  Returns the command to state publish latencies of all tiles."""
+  raise_file_limit(len(names))
+  memory_before = get_memory()
+  started = time.monotonic()
+  stop = asyncio.Event()
+  tiles = [AsyncTile(name) for name in names]
+  created = time.monotonic() - started
+
+  # Connect the tiles in batches
+  tasks = []
+  for i in range(0, len(tiles), CONNECT_BATCH):
+    if stop_event.is_set():
+      break
+    batch = tiles[i:i + CONNECT_BATCH]
+    for tile in batch:
+      tasks.append(asyncio.create_task(tile.run(stop)))
+      if random_presence:
+        tasks.append(asyncio.create_task(random_presence_detection(tile, stop)))
+    try:
+      await asyncio.wait_for(asyncio.gather(*(tile.connected.wait() for tile in batch)), CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+      pass
+  connected = time.monotonic() - started
+  memory_after = get_memory()
+  report = {
+    "tiles": len(tiles),
+    "connected": sum(1 for tile in tiles if tile.connected.is_set()),
+    "created_s": created,
+    "connected_s": connected,
+    "memory_bytes": memory_after,
+    "memory_per_tile_bytes": (memory_after - memory_before) / len(tiles) if memory_before is not None and memory_after is not None and len(tiles) > 0 else None
+  }
+  if on_started is not None:
+    on_started(report)
+
+  # Run till the stop event of the thread or process is set
+  await asyncio.to_thread(stop_event.wait)
+  stop.set()
+  for tile in tiles:
+    tile.wake()
+  await asyncio.gather(*tasks, return_exceptions=True)
+  return [latency for tile in tiles for latency in tile.latencies]
+
+def run_worker(names: list[str], stop_event: threading.Event, random_presence: bool, reports: multiprocessing.Queue, latencies: multiprocessing.Queue) -> None:
+  """Runs a shard of the fleet in its own event loop (in a thread or in a worker process)."""
+  latencies.put(asyncio.run(run_fleet(names, stop_event, random_presence, reports.put)))
+
+def format_report(report: dict) -> str:
+  memory = ""
+  if report["memory_per_tile_bytes"] is not None:
+    memory = f", {report['memory_bytes'] / 1e6:.0f} MB ({report['memory_per_tile_bytes'] / 1e3:.1f} KB per tile)"
+  return f"{report['connected']} of {report['tiles']} tiles connected in {report['connected_s']:.1f} s (created in {report['created_s']:.2f} s){memory}"
+
+def print_reports(workers: int, reports: multiprocessing.Queue) -> None:
+  """Prints the startup report of every worker, and the total of the fleet."""
+  collected = []
+  for i in range(workers):
+    report = reports.get()
+    collected.append(report)
+    if workers > 1:
+      print(f"Worker {i+1}: " + format_report(report))
+  per_tile = [report["memory_per_tile_bytes"] for report in collected]
+  total = {
+    "tiles": sum(report["tiles"] for report in collected),
+    "connected": sum(report["connected"] for report in collected),
+    "created_s": max(report["created_s"] for report in collected),
+    "connected_s": max(report["connected_s"] for report in collected),
+    "memory_bytes": sum(report["memory_bytes"] for report in collected) if None not in per_tile else None,
+    "memory_per_tile_bytes": sum(value * report["tiles"] for value, report in zip(per_tile, collected)) / max(sum(report["tiles"] for report in collected), 1) if None not in per_tile else None
+  }
+  print("Fleet: " + format_report(total))
+
+def start(names: list[str], workers: int, stop_event: multiprocessing.Event, latencies: multiprocessing.Queue, random_presence: bool = False) -> list:
+  """Starts the fleet: one event loop in a thread of this process, or sharded over worker processes.
+
+  Returns the threads or processes, they finish after the stop_event is set. Every thread or process
+  puts the command to state publish latencies of its tiles in the latencies queue when it stops."""
+  workers = max(1, min(workers, len(names)))
+  reports = multiprocessing.Queue()
+  runners = []
+  if workers == 1:
+    runners.append(threading.Thread(target=run_worker, args=(names, stop_event, random_presence, reports, latencies)))
+  else:
+    # Contiguous shards of (almost) the same size
+    size, rest = divmod(len(names), workers)
+    first = 0
+    for i in range(workers):
+      end = first + size + (1 if i < rest else 0)
+      runners.append(multiprocessing.Process(target=run_worker, args=(names[first:end], stop_event, random_presence, reports, latencies)))
+      first = end
+  for runner in runners:
+    runner.start()
+  reporter = threading.Thread(target=print_reports, args=(len(runners), reports), daemon=True)
+  reporter.start()
+  return runners
@@ -1,9 +1,12 @@
-from tile import Tile
+from tile import Tile, format_latencies
 import multiprocessing
+import fleet
 import threading
+import queue
 import dotenv
 import random
 import time
+import sys
 import os
 
 def random_presence_detection(tile: Tile, stop_event: multiprocessing.Event) -> None:
@@ -22,8 +25,17 @@ def random_presence_detection(tile: Tile, stop_event: multiprocessing.Event) ->
     # Sleep for gen seconds
     time.sleep(gen)
 
-def create_and_run_tile(name: str, stop_event: multiprocessing.Event, random_presence: bool = False) -> None:
-  """Creates a tile and runs it until the stop_event is set."""
+def start_embedded_broker(host: str, port: int):
+  """Starts the MQTT broker of the controller (server/control/broker.py) in a thread of this process, returns the thread."""
+  # Appended, so the modules of the emulator (like tile.py) aren't replaced by the ones of the controller
+  sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "server", "control"))
+  from broker import Broker, BrokerThread
+  thread = BrokerThread(Broker(host, port))
+  thread.start()
+  return thread
+
+def create_and_run_tile(name: str, stop_event: multiprocessing.Event, latencies: multiprocessing.Queue, random_presence: bool = False) -> None:
+  """Creates a tile and runs it until the stop_event is set, then puts its command to state publish latencies in the queue."""
   tile = Tile(name)
 
   if random_presence:
@@ -38,6 +50,7 @@ def create_and_run_tile(name: str, stop_event: multiprocessing.Event, random_pre
     thread2.join()
   else:
     tile.run(stop_event)
+  latencies.put(list(tile.latencies))
 
 if __name__ == '__main__':
   # Get environment variables
@@ -45,23 +58,43 @@ if __name__ == '__main__':
   # Get the RANDOM_PRESENCE environment variable casted to a bool (default: False)
   RANDOM_PRESENCE: bool = os.getenv("RANDOM_PRESENCE", "false").lower() == "true"
 
+  # Get the EMULATOR_MODE environment variable (default: process)
+  # process = one process per tile, async = the tiles run as coroutines (thousands of tiles per process)
+  EMULATOR_MODE: str = os.getenv("EMULATOR_MODE", "process").lower()
+  # Get the WORKERS environment variable (async mode, default: 1 = all tiles in this process, 0 = one worker process per core)
+  WORKERS: int = int(os.getenv("WORKERS", "1")) or os.cpu_count() or 1
+  # Get the EMBEDDED_BROKER environment variable casted to a bool (default: False)
+  # true = run an MQTT broker in this process on MQTT_HOST:MQTT_PORT (no external broker needed)
+  EMBEDDED_BROKER: bool = os.getenv("EMBEDDED_BROKER", "false").lower() == "true"
+
   if RANDOM_PRESENCE:
     print("Random presence detection enabled")
   else:
     print("Random presence detection disabled")
 
+  # Start the embedded broker (before the tiles connect to it)
+  broker_thread = None
+  if EMBEDDED_BROKER:
+    broker_thread = start_embedded_broker(os.getenv("MQTT_HOST"), int(os.getenv("MQTT_PORT")))
+    print(f"Embedded MQTT broker listening on {broker_thread.broker.host}:{broker_thread.broker.port}")
+
   # Request user input
   amount = int(input("How many tiles do you want to simulate?\n"))
 
   # Create a stop event to signal child processes to exit
   stop_event = multiprocessing.Event()
+  # Queue for the command to state publish latencies (one list per process or thread)
+  latencies = multiprocessing.Queue()
 
-  # Create a list of processes and start them
+  # Create a list of processes (or threads, in async mode) and start them
   processes: list[multiprocessing.Process] = []
-  for i in range(amount):
-    process = multiprocessing.Process(target=create_and_run_tile, args=(f"TILE{i+1}", stop_event, RANDOM_PRESENCE))
-    processes.append(process)
-    process.start()
+  if EMULATOR_MODE == "async":
+    processes = fleet.start([f"TILE{i+1}" for i in range(amount)], WORKERS, stop_event, latencies, RANDOM_PRESENCE)
+  else:
+    for i in range(amount):
+      process = multiprocessing.Process(target=create_and_run_tile, args=(f"TILE{i+1}", stop_event, latencies, RANDOM_PRESENCE))
+      processes.append(process)
+      process.start()
 
   # Wait for user input (Enter key) to stop the program
   try:
@@ -75,9 +108,22 @@ if __name__ == '__main__':
     # Set the stop_event to signal child processes to exit
     stop_event.set()
 
+  # Collect the latencies before joining (a process doesn't exit before its queued data is read)
+  samples = []
+  for _ in processes:
+    try:
+      samples.extend(latencies.get(timeout=10))
+    except queue.Empty:
+      break
+  print("Command to state publish latency: " + format_latencies(samples))
+
   # Join all processes to ensure they have finished
   for process in processes:
     process.join()
 
+  # Stop the embedded broker (after the tiles published their offline message)
+  if broker_thread is not None:
+    broker_thread.stop()
+
   # Print a message to indicate the program has stopped
   print("Program stopped")
@@ -0,0 +1,157 @@
+import socket
+import asyncio
+import logging
+import paho.mqtt.client as mqtt
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+class _LoopClient(mqtt.Client):
+  """paho client that uses a socket that was connected by the event loop.
+
+  paho connects its socket with a blocking call, so the socket is connected
+  by the event loop first and handed over to paho right before it is used."""
+  # Constructor
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._connected_socket: socket.socket = None
+
+  def _create_socket_connection(self):
+    # Use the socket connected by the event loop (if there is one)
+    sock = self._connected_socket
+    self._connected_socket = None
+    if sock is None:
+      return super()._create_socket_connection()
+    return sock
+
+class AsyncMqttClient:
+  """MQTT client that runs on the asyncio event loop, without a background thread.
+
+  The socket is watched by the event loop (add_reader/add_writer), so all paho
+  callbacks (on_connect, on_message, ...) run on the event loop, and publish and
+  subscribe never block (they only queue the packet)."""
+  # Constructor
+  def __init__(self, client_id: str = "", clean_session: bool = True, keepalive: int = 60):
+    self._client: _LoopClient = _LoopClient(client_id=client_id, clean_session=clean_session)
+    self._keepalive: int = keepalive
+    self._loop: asyncio.AbstractEventLoop = None
+    self._misc_task: asyncio.Task = None
+    self._closed: asyncio.Event = asyncio.Event()
+    # Let the event loop watch the socket
+    self._client.on_socket_open = self._on_socket_open
+    self._client.on_socket_close = self._on_socket_close
+    self._client.on_socket_register_write = self._on_socket_register_write
+    self._client.on_socket_unregister_write = self._on_socket_unregister_write
+
+  # Properties
+  @property
+  def on_connect(self):
+    return self._client.on_connect
+
+  @on_connect.setter
+  def on_connect(self, callback) -> None:
+    self._client.on_connect = callback
+
+  @property
+  def on_message(self):
+    return self._client.on_message
+
+  @on_message.setter
+  def on_message(self, callback) -> None:
+    self._client.on_message = callback
+
+  @property
+  def on_disconnect(self):
+    return self._client.on_disconnect
+
+  @on_disconnect.setter
+  def on_disconnect(self, callback) -> None:
+    self._client.on_disconnect = callback
+
+  # Methods
+  def username_pw_set(self, username: str, password: str = None) -> None:
+    self._client.username_pw_set(username, password)
+
+  def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False) -> None:
+    self._client.will_set(topic, payload, qos, retain)
+
+  def is_connected(self) -> bool:
+    return self._client.is_connected()
+
+  def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False) -> mqtt.MQTTMessageInfo:
+    """Queues a message to be published, the event loop writes it when the socket is writable."""
+    return self._client.publish(topic, payload, qos, retain)
+
+  def subscribe(self, topic: str, qos: int = 0) -> tuple[int, int]:
+    """Queues a subscribe request, the event loop writes it when the socket is writable."""
+    return self._client.subscribe(topic, qos)
+
+  def unsubscribe(self, topic: str) -> tuple[int, int]:
+    return self._client.unsubscribe(topic)
+
+  async def connect(self, host: str, port: int = 1883, timeout: float = 5.0) -> None:
+    """Connects the socket on the event loop and sends the MQTT CONNECT packet."""
+    self._loop = asyncio.get_running_loop()
+    # Resolve the host and connect the socket without blocking the event loop
+    address_info = await self._loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    family, type, proto, _, address = address_info[0]
+    sock = socket.socket(family, type, proto)
+    sock.setblocking(False)
+    try:
+      await asyncio.wait_for(self._loop.sock_connect(sock, address), timeout)
+    except BaseException:
+      sock.close()
+      raise
+    # Hand the socket over to paho (this sends the CONNECT packet)
+    self._closed.clear()
+    self._client._connected_socket = sock
+    self._client.connect(host, port, self._keepalive)
+
+  async def run(self, host: str, port: int = 1883, min_delay: float = 1.0, max_delay: float = 60.0) -> None:
+    """Connects to the broker and keeps reconnecting (with exponential backoff) until cancelled."""
+    delay = min_delay
+    while True:
+      try:
+        await self.connect(host, port)
+      except OSError as e:
+        logger.warning("Could not connect to MQTT broker " + host + ":" + str(port) + ": " + str(e))
+      else:
+        # Connected, wait till the connection is closed
+        delay = min_delay
+        await self._closed.wait()
+        logger.warning("Connection to MQTT broker lost")
+      # Wait before reconnecting
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, max_delay)
+
+  async def disconnect(self) -> None:
+    """Disconnects from the broker and waits till the socket is closed."""
+    if self._client.socket() is None:
+      return
+    self._client.disconnect()
+    await self._closed.wait()
+
+  # Socket callbacks (called by paho)
+  def _on_socket_open(self, client: mqtt.Client, userdata, sock: socket.socket) -> None:
+    self._loop.add_reader(sock, self._client.loop_read)
+    self._misc_task = self._loop.create_task(self._misc_loop())
+
+  def _on_socket_close(self, client: mqtt.Client, userdata, sock: socket.socket) -> None:
+    self._loop.remove_reader(sock)
+    self._loop.remove_writer(sock)
+    if self._misc_task is not None:
+      self._misc_task.cancel()
+      self._misc_task = None
+    self._closed.set()
+
+  def _on_socket_register_write(self, client: mqtt.Client, userdata, sock: socket.socket) -> None:
+    self._loop.add_writer(sock, self._client.loop_write)
+
+  def _on_socket_unregister_write(self, client: mqtt.Client, userdata, sock: socket.socket) -> None:
+    self._loop.remove_writer(sock)
+
+  async def _misc_loop(self) -> None:
+    """Lets paho handle keepalive pings and retries (every second, like its own loop does)."""
+    while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+      await asyncio.sleep(1)
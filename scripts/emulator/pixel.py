@@ -76,3 +76,181 @@ class Pixel:
   # Not equal
   def __ne__(self, other) -> bool:
     return not self.__eq__(other)
+
+class PixelView:
+  """Pixel compatible accessor of one pixel in a PixelBuffer (reads and writes go to the buffer)."""
+  __slots__ = ("_data", "_offset")
+
+  def __init__(self, data: bytearray, offset: int):
+    self._data: bytearray = data
+    self._offset: int = offset
+
+  # Properties
+  @property
+  def red(self) -> int:
+    return self._data[self._offset]
+
+  @red.setter
+  def red(self, value: int):
+    if value < 0 or value > 255:
+      raise ValueError("The value of red must be between 0 and 255")
+    self._data[self._offset] = value
+
+  @property
+  def green(self) -> int:
+    return self._data[self._offset + 1]
+
+  @green.setter
+  def green(self, value: int):
+    if value < 0 or value > 255:
+      raise ValueError("The value of green must be between 0 and 255")
+    self._data[self._offset + 1] = value
+
+  @property
+  def blue(self) -> int:
+    return self._data[self._offset + 2]
+
+  @blue.setter
+  def blue(self, value: int):
+    if value < 0 or value > 255:
+      raise ValueError("The value of blue must be between 0 and 255")
+    self._data[self._offset + 2] = value
+
+  @property
+  def white(self) -> int:
+    return self._data[self._offset + 3]
+
+  @white.setter
+  def white(self, value: int):
+    if value < 0 or value > 255:
+      raise ValueError("The value of white must be between 0 and 255")
+    self._data[self._offset + 3] = value
+
+  # Methods
+  # Dict to Pixel
+  def from_dict(self, data: dict) -> None:
+    if "r" in data:
+      self._data[self._offset] = data["r"]
+    if "g" in data:
+      self._data[self._offset + 1] = data["g"]
+    if "b" in data:
+      self._data[self._offset + 2] = data["b"]
+    if "w" in data:
+      self._data[self._offset + 3] = data["w"]
+
+  # Pixel to Dict
+  def to_dict(self) -> dict:
+    red, green, blue, white = self._data[self._offset:self._offset + 4]
+    return {
+      "r": red,
+      "g": green,
+      "b": blue,
+      "w": white
+    }
+
+  # Equal
+  def __eq__(self, other) -> bool:
+    return (self.red, self.green, self.blue, self.white) == (other.red, other.green, other.blue, other.white)
+
+class PixelBuffer:
+  """The pixels of a tile in one contiguous bytearray (r, g, b, w per pixel).
+
+  Operations work on the whole buffer at once, indexing returns a Pixel compatible
+  view, so code that uses pixel.red, pixel.to_dict(), ... keeps working."""
+  __slots__ = ("_data",)
+  BYTES_PER_PIXEL: int = 4
+
+  # Constructor
+  def __init__(self, amount_of_pixels: int = 0, data: bytes | bytearray | memoryview = None):
+    if data is not None:
+      if len(data) % self.BYTES_PER_PIXEL != 0:
+        raise ValueError("The length of the data must be a multiple of " + str(self.BYTES_PER_PIXEL))
+      self._data: bytearray = bytearray(data)
+    else:
+      self._data: bytearray = bytearray(amount_of_pixels * self.BYTES_PER_PIXEL)
+
+  @classmethod
+  def from_pixels(cls, pixels: list[Pixel]) -> "PixelBuffer":
+    """Creates a buffer with the values of the given pixels."""
+    data = bytearray()
+    for pixel in pixels:
+      data.extend((pixel.red, pixel.green, pixel.blue, pixel.white))
+    return cls(data=data)
+
+  @classmethod
+  def from_dicts(cls, pixels: list[dict]) -> "PixelBuffer":
+    """Creates a buffer from a list of {"r", "g", "b", "w"} dictionaries (missing values are 0)."""
+    buffer = cls(len(pixels))
+    for i in range(len(pixels)):
+      buffer[i].from_dict(pixels[i])
+    return buffer
+
+  # Sequence
+  def __len__(self) -> int:
+    return len(self._data) // self.BYTES_PER_PIXEL
+
+  def __getitem__(self, index: int) -> PixelView:
+    if index < 0:
+      index += len(self)
+    if index < 0 or index >= len(self):
+      raise IndexError("Pixel index out of range")
+    return PixelView(self._data, index * self.BYTES_PER_PIXEL)
+
+  def __iter__(self):
+    for offset in range(0, len(self._data), self.BYTES_PER_PIXEL):
+      yield PixelView(self._data, offset)
+
+  def __eq__(self, other) -> bool:
+    if isinstance(other, PixelBuffer):
+      return self._data == other._data
+    return NotImplemented
+
+  __hash__ = None
+
+  def __repr__(self) -> str:
+    return "PixelBuffer(" + str(self.to_dicts()) + ")"
+
+  # Methods
+  def view(self) -> memoryview:
+    """Returns a view on the bytes of the buffer (r, g, b, w per pixel), without copying them."""
+    return memoryview(self._data)
+
+  def copy(self) -> "PixelBuffer":
+    return PixelBuffer(data=self._data)
+
+  def resize(self, amount_of_pixels: int) -> None:
+    """Adds (black) pixels or removes pixels at the end, so the buffer has the given amount of pixels."""
+    size = amount_of_pixels * self.BYTES_PER_PIXEL
+    if size < len(self._data):
+      del self._data[size:]
+    else:
+      self._data.extend(bytes(size - len(self._data)))
+
+  def fill(self, red: int, green: int, blue: int, white: int, start: int = 0, end: int = None) -> None:
+    """Sets the pixels from start up to end (default: all pixels) to the given color."""
+    if end is None:
+      end = len(self)
+    self._data[start * self.BYTES_PER_PIXEL:end * self.BYTES_PER_PIXEL] = bytes((red, green, blue, white)) * (end - start)
+
+  def scale(self, factor: float) -> None:
+    """Multiplies every value by the factor (clamped to 0 - 255)."""
+    table = bytes(min(255, max(0, int(value * factor))) for value in range(256))
+    self._data[:] = self._data.translate(table)
+
+  def diff(self, other: "PixelBuffer") -> list[int]:
+    """Returns the indices of the pixels of the other buffer that differ from this buffer.
+
+    Pixels that this buffer doesn't have (if the other buffer is longer) are different too."""
+    if self._data == other._data:
+      return []
+    # Compare one 32 bit integer per pixel instead of four bytes
+    own = memoryview(self._data).cast("I")
+    others = memoryview(other._data).cast("I")
+    changed = [i for i, (a, b) in enumerate(zip(own, others)) if a != b]
+    changed.extend(range(len(own), len(others)))
+    return changed
+
+  def to_dicts(self) -> list[dict]:
+    """Returns the pixels as a list of {"r", "g", "b", "w"} dictionaries."""
+    data = self._data
+    return [{"r": data[i], "g": data[i + 1], "b": data[i + 2], "w": data[i + 3]} for i in range(0, len(data), self.BYTES_PER_PIXEL)]
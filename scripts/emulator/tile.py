@@ -1,12 +1,25 @@
-from pixel import Pixel
+from pixel import PixelBuffer
+from lightframe import FRAME_SUBTOPIC, FRAME_FEATURE, encode_light_frame, decode_light_frame, decode_frame_trace
+from collections import deque
 from enum import Enum
 import multiprocessing
+import threading
 import paho.mqtt.client as mqtt
 import dotenv
 import os
 import time
 import json
 
+LATENCY_SAMPLES: int = 1000 # Command to state publish latencies kept per tile (the most recent)
+
+def format_latencies(latencies: list[float]) -> str:
+  """Returns a summary (count and percentiles in milliseconds) of command to state publish latencies."""
+  if len(latencies) == 0:
+    return "no commands"
+  latencies = sorted(latencies)
+  percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+  return f"{len(latencies)} commands, p50 {percentile(0.5):.2f} ms, p95 {percentile(0.95):.2f} ms, p99 {percentile(0.99):.2f} ms, max {latencies[-1] * 1000:.2f} ms"
+
 class AudioAction(Enum):
   IDLE_PLAY = 1
   IDLE_PAUSE = 2
@@ -24,65 +37,133 @@ class AudioAction(Enum):
 class Tile:
   def __init__(self, device_name: str):
     """Initializes the tile. (Constructor)"""
+    self.latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES) # Seconds from command to state publish (kept over reboots)
     self._reboot_tile(device_name)
 
-  def _connect_to_mqtt(self):
-    """Connects the tile to MQTT."""
-    # Configure MQTT
+  def _create_mqtt_client(self) -> mqtt.Client:
+    """Creates the MQTT client of the tile."""
+    return mqtt.Client()
+
+  def _configure_mqtt(self) -> None:
+    """Sets the callbacks, credentials and last will of the MQTT client."""
     self._mqtt_client.on_connect = self._on_mqtt_connect
     self._mqtt_client.on_message = self._on_mqtt_message
     if self._MQTT_USER != None and self._MQTT_PASS != None:
       self._mqtt_client.username_pw_set(self._MQTT_USER, self._MQTT_PASS)
     self._mqtt_client.will_set(f"{self._ROOT_TOPIC}/{self._device_name}/self", "OFFLINE", 1, retain=True)
+
+  def _connect_to_mqtt(self):
+    """Connects the tile to MQTT (in the background, paho's network thread reconnects when the connection is lost)."""
+    # Configure MQTT
+    self._configure_mqtt()
     # Connect to MQTT
-    self._mqtt_client.connect(self._MQTT_HOST, self._MQTT_PORT, 60)
+    self._mqtt_client.connect_async(self._MQTT_HOST, self._MQTT_PORT, 60)
+    self._mqtt_client.loop_start()
 
   def _on_mqtt_connect(self, client, userdata, flags, rc):
     """Handles the MQTT connection."""
+    with self._lock:
+      self._publish_initial_state()
+
+  def _publish_initial_state(self) -> None:
+    """Publishes the online message and the state, and subscribes to the command topics."""
     # Publish online message
     self._mqtt_client.publish(f"{self._ROOT_TOPIC}/{self._device_name}/self", "ONLINE", 1, retain=True)
-    # Publish initial state
-    self._mqtt_client.publish(self._state_topic + "/system", self._get_system_state())
-    self._mqtt_client.publish(self._state_topic + "/audio", self._get_audio_state())
-    self._mqtt_client.publish(self._state_topic + "/light", self._get_light_state())
-    self._mqtt_client.publish(self._state_topic + "/presence", self._get_presence_state())
+    # Publish initial state (retained, so a controller that (re)starts later gets the state of the tile right away)
+    self._mqtt_client.publish(self._state_topic + "/system", self._get_system_state(), retain=True)
+    self._mqtt_client.publish(self._state_topic + "/audio", self._get_audio_state(), retain=True)
+    self._publish_light_state()
+    self._mqtt_client.publish(self._state_topic + "/presence", self._get_presence_state(), retain=True)
     # Subscribe to command topic
     self._mqtt_client.subscribe(self._command_topic + "/#")
+    # Subscribe to the command topics of all tiles and of the groups this tile is in
+    for group_id in ["all"] + sorted(self._groups):
+      self._mqtt_client.subscribe(f"{self._group_topic}/{group_id}/command/#")
 
   def _on_mqtt_message(self, client, userdata, message):
+    """Handles incoming MQTT messages and wakes the loop of the tile."""
+    with self._lock:
+      self._handle_mqtt_message(message)
+    self.wake()
+
+  def _handle_mqtt_message(self, message: mqtt.MQTTMessage) -> None:
     """Handles, parses and processes incoming MQTT messages."""
     # Get topic
     topic: str = message.topic
-    # Get payload
-    payload: str = message.payload.decode("utf-8")
+
+    # Get the command (the last part of the topic) of this tile's command topic or of a group's command topic
+    command: str = self._get_command(topic)
 
     # Parse payload for each topic
     try:
-      if topic == self._command_topic + "/system":
+      if command == FRAME_SUBTOPIC:
+        # Parse binary light frame (no JSON, no intermediate dicts)
+        brightness, pixel_bytes = decode_light_frame(message.payload)
+        trace = decode_frame_trace(message.payload)
+        self._receive_command("light", trace[0] if trace is not None else None)
+        # Set variables (without brightness the brightness doesn't change)
+        if brightness is not None:
+          self._set_brightness(int(brightness / 100 * 255))
+        # Set pixels (copy the bytes of the pixels that exist straight into the buffer, if they differ)
+        size = min(len(pixel_bytes), len(self._pixels.view()))
+        pixels = self._pixels.view()[:size]
+        if pixels != pixel_bytes[:size]:
+          pixels[:] = pixel_bytes[:size]
+          self._light_dirty = True
+        return
+      # Get payload
+      payload: str = message.payload.decode("utf-8")
+      if command == "system":
         # Parse payload
         system_command = json.loads(payload)
         # Set variables
         self._reboot = bool(system_command["reboot"])
-        self._ping = bool(system_command["ping"])
-      elif topic == self._command_topic + "/audio":
+        ping = bool(system_command["ping"])
+        if ping != self._ping:
+          self._ping = ping
+          self._system_dirty = True
+        self._receive_command("system", system_command.get("id"))
+      elif command == "audio":
         # Parse payload
         audio_command = json.loads(payload)
         # Set variables
-        self._audio_mode = int(audio_command["mode"])
-        self._audio_loop = bool(audio_command["loop"])
-        self._audio_sound = str(audio_command["sound"])
-        self._volume = int((audio_command["volume"] / 100) * 30)
-      elif topic == self._command_topic + "/light":
+        audio_mode = int(audio_command["mode"])
+        audio_loop = bool(audio_command["loop"])
+        audio_sound = str(audio_command["sound"])
+        volume = int((audio_command["volume"] / 100) * 30)
+        if audio_mode != self._audio_mode or audio_loop != self._audio_loop or audio_sound != self._audio_sound or volume != self._volume:
+          self._audio_mode = audio_mode
+          self._audio_loop = audio_loop
+          self._audio_sound = audio_sound
+          self._volume = volume
+          self._audio_dirty = True
+        self._receive_command("audio", audio_command.get("id"))
+      elif command == "light":
         # Parse payload
         light_command = json.loads(payload)
-        # Set variables
-        self._brightness = int(light_command["brightness"] / 100 * 255)
+        # Set variables (brightness is optional, without it the brightness doesn't change)
+        if "brightness" in light_command:
+          self._set_brightness(int(light_command["brightness"] / 100 * 255))
         # Set pixels
+        before: bytes = bytes(self._pixels.view())
         for i in range(0, self._AMOUNT_OF_PIXELS):
           # If pixel exists
           if i < len(light_command["pixels"]):
             # Set pixel
             self._pixels[i].from_dict(light_command["pixels"][i])
+        if self._pixels.view() != before:
+          self._light_dirty = True
+        self._receive_command("light", light_command.get("id"))
+      elif command == "groups":
+        # Parse payload
+        groups_command = json.loads(payload)
+        groups: set[str] = set(map(str, groups_command["groups"]))
+        # Subscribe to the groups this tile joined, unsubscribe from the groups it left
+        for group_id in groups - self._groups:
+          self._mqtt_client.subscribe(f"{self._group_topic}/{group_id}/command/#")
+        for group_id in self._groups - groups:
+          self._mqtt_client.unsubscribe(f"{self._group_topic}/{group_id}/command/#")
+        self._groups = groups
       else:
         # Not a valid topic
         pass
@@ -90,22 +171,58 @@ class Tile:
       # Invalid payload
       pass
 
+  def _set_brightness(self, brightness: int) -> None:
+    """Sets the brightness, marks the light state dirty if it changed."""
+    if brightness != self._brightness:
+      self._brightness = brightness
+      self._light_dirty = True
+
+  def _receive_command(self, state: str, trace_id: int | None = None) -> None:
+    """Remembers when the first command since the last publish of the state was received (for the latency), and
+    the id of a traced command, it's echoed in the next publish of the state (with the time it took)."""
+    now = time.monotonic()
+    self._command_times.setdefault(state, now)
+    if trace_id is not None:
+      self._traces[state] = (int(trace_id), now)
+
+  def _add_trace(self, state: str, state_json: dict) -> dict:
+    """Adds the id of the traced command of the state (if any) and the seconds since it was received to the state."""
+    trace = self._traces.pop(state, None)
+    if trace is not None:
+      state_json["id"] = trace[0]
+      state_json["tile_time"] = time.monotonic() - trace[1]
+    return state_json
+
+  def _get_command(self, topic: str) -> str | None:
+    """Returns the command of a command topic of this tile (or of one of its groups), or None."""
+    if topic.startswith(self._command_topic + "/"):
+      return topic[len(self._command_topic) + 1:]
+    # Group command topic: <root>/group/<group id>/command/<command>
+    if topic.startswith(self._group_topic + "/"):
+      topic_parts = topic[len(self._group_topic) + 1:].split("/")
+      if len(topic_parts) == 3 and topic_parts[1] == "command" and (topic_parts[0] == "all" or topic_parts[0] in self._groups):
+        # Group membership is set by the controller only, never by a group topic
+        if topic_parts[2] != "groups":
+          return topic_parts[2]
+    return None
+
   def _disconnect_from_mqtt(self):
     """Disconnects the tile from MQTT."""
     # Publish offline message
     self._mqtt_client.publish(f"{self._ROOT_TOPIC}/{self._device_name}/self", "OFFLINE", 1, retain=True)
-    # Disconnect from MQTT
+    # Disconnect from MQTT (after the offline message) and stop the network thread
     self._mqtt_client.disconnect()
+    self._mqtt_client.loop_stop()
 
   def _update_system(self) -> bool:
     """Updates the necessary system variables. 
     
     Returns true if the system state has changed."""
-    if (self._ping != self._previous_ping):
+    if self._system_dirty:
       # Ping changed
       self._update_uptime()
-      # Update previous ping
-      self._previous_ping = self._ping
+      # Reset dirty flag
+      self._system_dirty = False
       # Return true
       return True
     elif (self._ping):
@@ -117,22 +234,29 @@ class Tile:
       return False
 
   def _update_uptime(self) -> bool:
-    """Updates the uptime.
+    """Updates the uptime (seconds since boot).
     
     Returns true if the uptime has changed."""
-    # Get current time
-    current_time: int = time.time()
-    # Check if uptime interval has passed
-    if current_time - self._last_time >= self._UPTIME_INTERVAL:
-      # Update uptime
-      self._uptime += 1
-      # Update last time
-      self._last_time = current_time
-      # Return true
+    uptime: int = int((time.monotonic() - self._boot_time) / self._UPTIME_INTERVAL)
+    if uptime != self._uptime:
+      self._uptime = uptime
       return True
     else:
       return False
 
+  def _get_timeout(self) -> float | None:
+    """Returns the seconds till the next timer (None if there is no timer): the next uptime tick while pinging
+    (the system state is published every tick) and the automatic stop of the audio player."""
+    deadlines: list[float] = []
+    if self._ping:
+      deadlines.append(self._boot_time + (self._uptime + 1) * self._UPTIME_INTERVAL)
+    if self._audio_state == 1 and not self._audio_loop:
+      deadlines.append(self._boot_time + (self._audio_play_time + 10) * self._UPTIME_INTERVAL)
+    if len(deadlines) == 0:
+      return None
+    # A millisecond after the deadline, so the uptime has ticked
+    return max(min(deadlines) - time.monotonic(), 0.0) + 0.001
+
   def _get_system_state(self) -> str:
     """Formats the system state to a JSON string and returns it."""
     # Create system state json
@@ -142,7 +266,9 @@ class Tile:
       "ping": self._ping,
       "uptime": self._uptime,
       "sounds": self._SOUNDS,
+      "features": self._FEATURES,
     }
+    self._add_trace("system", system_state)
     # Convert system state json to string
     system_state_string: str = json.dumps(system_state)
     # Return system state string
@@ -153,7 +279,7 @@ class Tile:
     
     Returns true if the audio state has changed."""
     # Check if audio mode, sound, volume or loop have changed
-    if (self._audio_mode != self._previous_audio_mode or self._audio_sound != self._previous_audio_sound or self._volume != self._previous_volume or self._audio_loop != self._previous_audio_loop):
+    if self._audio_dirty:
       # Create audio action
       audio_action: AudioAction = AudioAction(self._audio_state * 10 + self._audio_mode)
       # Case audio action
@@ -193,11 +319,8 @@ class Tile:
           # No action needed
           pass
 
-      # Update previous variables
-      self._previous_audio_mode = self._audio_mode
-      self._previous_audio_sound = self._audio_sound
-      self._previous_volume = self._volume
-      self._previous_audio_loop = self._audio_loop
+      # Reset dirty flag
+      self._audio_dirty = False
 
       # Return true
       return True
@@ -215,7 +338,7 @@ class Tile:
       if self._uptime - self._audio_play_time >= 10:
         # Set audio state to idle
         self._audio_state = 0
-        # Set audio mode to stop
+        # Set audio mode to stop (not a command, so the audio state isn't marked dirty)
         self._audio_mode = 4
         # Reset audio play time
         self._audio_play_time = 0
@@ -239,6 +362,7 @@ class Tile:
       "sound": self._audio_sound,
       "volume": (self._volume / 30) * 100,
     }
+    self._add_trace("audio", audio_state)
     # Convert audio state json to string
     audio_state_string: str = json.dumps(audio_state)
     # Return audio state string
@@ -249,11 +373,9 @@ class Tile:
 
     Returns true if the light state has changed."""
     # Check if brightness or pixel values have changed
-    if self._previous_brightness != self._brightness or self._previous_pixels != self._pixels:
-      # Update previous brightness
-      self._previous_brightness = self._brightness
-      # Update previous pixels with values from current pixels
-      self._previous_pixels = [Pixel(pixel.red, pixel.green, pixel.blue, pixel.white) for pixel in self._pixels]
+    if self._light_dirty:
+      # Reset dirty flag
+      self._light_dirty = False
       # Return true
       return True
     else:
@@ -262,28 +384,38 @@ class Tile:
 
   def _get_light_state(self) -> str:
     """Formats the light state to a JSON string and returns it."""
-    # Convert pixels to dicts
-    pixels_dict: list[dict] = []
-    for pixel in self._pixels:
-      pixels_dict.append(pixel.to_dict())
     # Create light state json
     light_state = {
       "brightness": (self._brightness / 255) * 100,
-      "pixels": pixels_dict,
+      "pixels": self._pixels.to_dicts(),
     }
+    self._add_trace("light", light_state)
     # Convert light state json to string
     light_state_string: str = json.dumps(light_state)
     # Return light state string
     return light_state_string
 
+  def _get_light_frame(self) -> bytes:
+    """Formats the light state to a binary light frame and returns it."""
+    # Same brightness (0 - 100) as the JSON light state
+    trace = self._traces.pop("light", None)
+    return encode_light_frame(int((self._brightness / 255) * 100), self._pixels, (trace[0], time.monotonic() - trace[1]) if trace is not None else None)
+
+  def _publish_light_state(self) -> None:
+    """Publishes the light state (as light frame if enabled, else as JSON)."""
+    if self._LIGHT_FRAMES:
+      self._mqtt_client.publish(self._state_topic + "/" + FRAME_SUBTOPIC, self._get_light_frame(), retain=True)
+    else:
+      self._mqtt_client.publish(self._state_topic + "/light", self._get_light_state(), retain=True)
+
   def _update_presence(self) -> bool:
     """Checks if the presence has changed.
 
     Returns true if the presence state has changed."""
     # Check if presence changed
-    if self._previous_presence != self._presence:
-      # Update previous presence
-      self._previous_presence = self._presence
+    if self._presence_dirty:
+      # Reset dirty flag
+      self._presence_dirty = False
       # Return true
       return True
     else:
@@ -302,63 +434,96 @@ class Tile:
     return presence_state_string
 
   def run(self, stop_event: multiprocessing.Event) -> None:
-    """Runs the tile until the stop_event is set."""
+    """Runs the tile until the stop_event is set.
+
+    The loop sleeps till a command arrives, the presence changes or a timer expires (see _get_timeout),
+    so an idle tile uses no CPU."""
     # Setup
     # Connect to MQTT
     self._connect_to_mqtt()
+    # Wake the loop when the stop event is set
+    threading.Thread(target=self._wake_on_stop, args=(stop_event,), daemon=True).start()
 
     # Loop
     while not stop_event.is_set():
-      # Check if mqtt is connected
-      if not self._mqtt_client.is_connected():
-        # Connect to MQTT
-        self._connect_to_mqtt()
-
-      # Keep connection alive
-      self._mqtt_client.loop()
+      # Wait for a command, presence change or timer
+      self._wake.wait(self._get_timeout())
+      self._wake.clear()
+      if stop_event.is_set():
+        break
 
       # Check if reboot is requested
       if self._reboot:
         # Disconnect from MQTT
         self._disconnect_from_mqtt()
 
-        # Reboot
+        # Reboot and connect again
         self._reboot_tile(self._device_name)
+        self._connect_to_mqtt()
+        continue
 
-      # Update system
-      if self._update_system():
-        # Publish system state
-        self._mqtt_client.publish(self._state_topic + "/system", self._get_system_state())
-
-      # Update audio
-      if self._update_audio() or self._audio_player_state_changed():
-        # Publish audio state
-        self._mqtt_client.publish(self._state_topic + "/audio", self._get_audio_state())
-
-      # Update light
-      if self._update_light():
-        # Publish light state
-        self._mqtt_client.publish(self._state_topic + "/light", self._get_light_state())
-
-      # Update presence
-      if self._update_presence():
-        # Publish presence state
-        self._mqtt_client.publish(self._state_topic + "/presence", self._get_presence_state())
-
-      # Sleep for 0.0000125ms (to simulate the 80MHz clock speed of the ESP32)
-      time.sleep(0.0000125)
+      # Update the states and publish the ones that changed
+      if self._mqtt_client.is_connected():
+        with self._lock:
+          self._publish_changes()
 
     # Graceful exit
     # Disconnect from MQTT
     self._disconnect_from_mqtt()
 
+  def _wake_on_stop(self, stop_event: multiprocessing.Event) -> None:
+    stop_event.wait()
+    self.wake()
+
+  def wake(self) -> None:
+    """Lets the loop of the tile update the states right away (thread safe)."""
+    self._wake.set()
+
+  def _publish_changes(self) -> None:
+    """Updates the states and publishes the ones that changed."""
+    # Update system (a traced command is always answered, also if nothing changed)
+    if self._update_system() or "system" in self._traces:
+      # Publish system state
+      self._mqtt_client.publish(self._state_topic + "/system", self._get_system_state(), retain=True)
+      self._record_latency("system")
+
+    # Update audio
+    if self._update_audio() or self._audio_player_state_changed() or "audio" in self._traces:
+      # Publish audio state
+      self._mqtt_client.publish(self._state_topic + "/audio", self._get_audio_state(), retain=True)
+      self._record_latency("audio")
+
+    # Update light
+    if self._update_light() or "light" in self._traces:
+      # Publish light state
+      self._publish_light_state()
+      self._record_latency("light")
+
+    # Update presence
+    if self._update_presence():
+      # Publish presence state
+      self._mqtt_client.publish(self._state_topic + "/presence", self._get_presence_state(), retain=True)
+
+    # Commands that didn't change their state aren't answered
+    self._command_times.clear()
+
+  def _record_latency(self, state: str) -> None:
+    """Records the time from the first command since the last publish of the state till this publish."""
+    received = self._command_times.pop(state, None)
+    if received is not None:
+      self.latencies.append(time.monotonic() - received)
+
   def set_presence(self, presence: bool) -> None:
     """Sets the presence of the tile. Because this is a simulation, this method is used to simulate the presence sensor.
 
     Args:
       presence (bool): The presence of the tile. (True = detected, False = not detected)
     """
-    self._presence = presence
+    with self._lock:
+      if presence != self._presence:
+        self._presence = presence
+        self._presence_dirty = True
+    self.wake()
 
   def _reboot_tile(self, device_name: str) -> None:
     """Sets all variables to their default values, to simulate a reboot."""
@@ -422,6 +587,7 @@ class Tile:
       "Obi-Wan Kenobi - Hello there"
       ]
     self._AMOUNT_OF_SOUNDS: int = len(self._SOUNDS)
+    self._FEATURES: list[str] = ["groups", "trace"] # Protocol features this tile supports
     # Environment variables
     dotenv.load_dotenv()
     self._MQTT_HOST: str = os.getenv("MQTT_HOST")
@@ -429,32 +595,39 @@ class Tile:
     self._MQTT_USER: str | None = os.getenv("MQTT_USER")
     self._MQTT_PASS: str | None = os.getenv("MQTT_PASS")
     self._ROOT_TOPIC: str = os.getenv("ROOT_TOPIC")
+    self._LIGHT_FRAMES: bool = os.getenv("LIGHT_FRAMES", "false").lower() == "true" # Publish the light state as binary light frame
+    if self._LIGHT_FRAMES:
+      self._FEATURES.append(FRAME_FEATURE)
     # Variables
     self._device_name: str = device_name
     self._reboot: bool = False
     self._ping: bool = True
-    self._previous_ping: bool = self._ping
     self._uptime: int = 0
-    self._last_time: int = 0
+    self._boot_time: float = time.monotonic()
     self._presence: bool = False
-    self._previous_presence: bool = False
     self._audio_mode: int = 4 # 1 = play, 2 = pause, 3 = resume, 4 = stop
-    self._previous_audio_mode: int = 4
     self._audio_state: int = 0 # 0 = idle, 1 = playing, 2 = paused
     self._audio_loop: bool = False
-    self._previous_audio_loop: bool = False
     self._audio_sound: str = self._SOUNDS[0]
-    self._previous_audio_sound: str = self._SOUNDS[0]
     self._volume: int = 0 # 0 - 30
-    self._previous_volume: int = 0
     self._brightness: int = 0 # 0 - 255
-    self._previous_brightness: int = 0
-    self._pixels: list[Pixel] = [Pixel(0, 0, 0, 0) for i in range(0, self._AMOUNT_OF_PIXELS)]
-    self._previous_pixels: list[Pixel] = [Pixel(0, 0, 0, 0) for i in range(0, self._AMOUNT_OF_PIXELS)]
+    self._pixels: PixelBuffer = PixelBuffer(self._AMOUNT_OF_PIXELS)
+    # Dirty flags, set by the command handlers and set_presence when a value changes (the initial state is published on connect)
+    self._system_dirty: bool = False
+    self._audio_dirty: bool = False
+    self._light_dirty: bool = False
+    self._presence_dirty: bool = False
     # MQTT
     self._state_topic: str = f"{self._ROOT_TOPIC}/{self._device_name}/self/state"
     self._command_topic: str = f"{self._ROOT_TOPIC}/{self._device_name}/self/command"
-    self._mqtt_client: mqtt.Client = mqtt.Client()
+    self._group_topic: str = f"{self._ROOT_TOPIC}/group"
+    self._groups: set[str] = set() # Groups this tile is in (set by the controller)
+    self._traces: dict[str, tuple[int, float]] = {} # State (system, audio, light) -> id and receive time of the traced command it answers next
+    self._mqtt_client: mqtt.Client = self._create_mqtt_client()
+    # Loop
+    self._lock: threading.Lock = threading.Lock() # Guards the state (commands are handled in the network thread of the MQTT client)
+    self._wake: threading.Event = threading.Event() # Set when the states have to be updated before the next timer
+    self._command_times: dict[str, float] = {} # State (system, audio, light) -> receive time of the first command since its last publish
     # Extra variables
     self._audio_play_time: int = 0
     self._audio_pause_time: int = 0
@@ -0,0 +1,43 @@
+import struct
+from pixel import Pixel, PixelBuffer
+
+# --- Binary light frame ---
+# Compact alternative for the JSON light command and light state, published on the "light_bin" subtopic:
+# a header (version, flags, brightness, amount of pixels) followed by 4 bytes (r, g, b, w) per pixel.
+# Brightness has the same meaning as in the JSON messages of the tile (e.g. 0 - 100 for the emulator).
+FRAME_VERSION: int = 1
+FRAME_SUBTOPIC: str = "light_bin"
+FRAME_FEATURE: str = "light_frames" # Feature a tile announces (in its system state) when it understands light frames
+FLAG_BRIGHTNESS: int = 0x01 # Brightness is set (a command without it keeps the current brightness)
+HEADER: struct.Struct = struct.Struct("<BBBH") # version, flags, brightness, amount of pixels
+BYTES_PER_PIXEL: int = 4
+
+def encode_light_frame(brightness: int | None, pixels: PixelBuffer | list[Pixel]) -> bytes:
+  """Encodes the brightness (None = keep current) and pixels to a light frame."""
+  flags = FLAG_BRIGHTNESS if brightness is not None else 0
+  header = HEADER.pack(FRAME_VERSION, flags, brightness or 0, len(pixels))
+  if isinstance(pixels, PixelBuffer):
+    # The buffer already has the layout of the frame
+    return header + pixels.view()
+  frame = bytearray(header)
+  for pixel in pixels:
+    frame.extend((pixel.red, pixel.green, pixel.blue, pixel.white))
+  return bytes(frame)
+
+def decode_light_frame(frame: bytes) -> tuple[int | None, memoryview]:
+  """Decodes a light frame to the brightness (None if not set) and the pixel bytes (r, g, b, w per pixel).
+
+  The pixel bytes are a view on the frame (not a copy), e.g. for PixelBuffer(data=...).
+  Raises a ValueError if the frame is invalid."""
+  view = memoryview(frame)
+  if len(view) < HEADER.size:
+    raise ValueError("Light frame is too short")
+  version, flags, brightness, amount_of_pixels = HEADER.unpack_from(view)
+  if version != FRAME_VERSION:
+    raise ValueError("Unsupported light frame version: " + str(version))
+  end = HEADER.size + amount_of_pixels * BYTES_PER_PIXEL
+  if len(view) < end:
+    raise ValueError("Light frame is missing pixels")
+  if not flags & FLAG_BRIGHTNESS:
+    brightness = None
+  return brightness, view[HEADER.size:end]
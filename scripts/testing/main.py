@@ -1,9 +1,11 @@
 import paho.mqtt.client as mqtt
 import dotenv
 import time
+import sys
 import os
 from tile import Tile, StateType, CmdType
 from pixel import Pixel
+from lightframe import FRAME_SUBTOPIC
 
 # Load environment variables
 dotenv.load_dotenv()
@@ -12,6 +14,8 @@ MQTT_PORT = int(os.getenv("MQTT_PORT"))
 MQTT_USER = os.getenv("MQTT_USERNAME")
 MQTT_PASS = os.getenv("MQTT_PASSWORD")
 BASE_TOPIC = os.getenv("MQTT_BASE_TOPIC")
+LIGHT_FRAMES = os.getenv("MQTT_LIGHT_FRAMES", "false").lower() == "true" # Test the binary light frames instead of JSON
+EMBEDDED_BROKER = os.getenv("MQTT_EMBEDDED_BROKER", "false").lower() == "true" # Run an MQTT broker in the tester on MQTT_HOST:MQTT_PORT (the tiles connect to the tester)
 
 # --- Global Variables ---
 tiles: list[Tile] = []
@@ -24,6 +28,15 @@ testing_light: bool = False
 testing_presence: bool = False
 
 # --- Functions ---
+def start_embedded_broker(host: str, port: int):
+  """Starts the MQTT broker of the controller (server/control/broker.py) in a thread of this process, returns the thread."""
+  # Appended, so the modules of the tester (like tile.py) aren't replaced by the ones of the controller
+  sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "server", "control"))
+  from broker import Broker, BrokerThread
+  thread = BrokerThread(Broker(host, port))
+  thread.start()
+  return thread
+
 def get_tile_by_name(client, name: str) -> Tile:
   for tile in tiles:
     # If tile exists, return it
@@ -48,7 +61,13 @@ def get_online_tiles() -> list[Tile]:
       available_tiles.append(tile)
   return available_tiles
 
-def send_command(client: mqtt.Client, tile: Tile, type: CmdType, command: str) -> None:
+def create_light_command(tile: Tile, brightness: int = None, pixels: list[Pixel] = None) -> str | bytes:
+  """Creates a light command for the tile (a binary light frame if LIGHT_FRAMES is set)."""
+  if LIGHT_FRAMES:
+    return tile.create_light_frame(brightness, pixels)
+  return tile.create_light_command(brightness, pixels)
+
+def send_command(client: mqtt.Client, tile: Tile, type: CmdType, command: str | bytes) -> None:
   """Sends a command to the tile."""
   # Prevent sending commands to offline tiles
   if tile.online == False:
@@ -60,7 +79,10 @@ def send_command(client: mqtt.Client, tile: Tile, type: CmdType, command: str) -
   elif type == CmdType.AUDIO:
     client.publish(BASE_TOPIC+"/"+tile.device_name+"/self/command/audio", command)
   elif type == CmdType.LIGHT:
-    client.publish(BASE_TOPIC+"/"+tile.device_name+"/self/command/light", command)
+    if isinstance(command, bytes):
+      client.publish(BASE_TOPIC+"/"+tile.device_name+"/self/command/"+FRAME_SUBTOPIC, command)
+    else:
+      client.publish(BASE_TOPIC+"/"+tile.device_name+"/self/command/light", command)
 
 def print_title(title: str) -> None:
   """Prints a title to the console."""
@@ -112,13 +134,17 @@ def on_connect(client, userdata, flags, rc):
   client.subscribe(BASE_TOPIC+"/+/self")
   
 def on_message(client, userdata, msg):
-  #convert topic and payload to string
+  #convert topic to string
   topic = msg.topic
-  payload = msg.payload.decode("utf-8")  
   # Remove base topic from topic
   topic = topic.replace(BASE_TOPIC+"/", "")
   # Split the topic into parts (for easier processing)
   topic_parts = topic.split("/")
+  # Convert payload to string (light frames are binary, keep the bytes)
+  if topic_parts[-1] == FRAME_SUBTOPIC:
+    payload = msg.payload
+  else:
+    payload = msg.payload.decode("utf-8")
   # Check if tile already exists
   tile = get_tile_by_name(client, topic_parts[0])
     
@@ -130,7 +156,7 @@ def on_message(client, userdata, msg):
     state_type = StateType.SYSTEM
   elif topic_parts[-1] == "audio" and testing_audio:
     state_type = StateType.AUDIO
-  elif topic_parts[-1] == "light" and testing_light:
+  elif (topic_parts[-1] == "light" or topic_parts[-1] == FRAME_SUBTOPIC) and testing_light:
     state_type = StateType.LIGHT
   elif topic_parts[-1] == "presence" and testing_presence:
     state_type = StateType.PRESENCE
@@ -290,7 +316,7 @@ def main():
   # Set testing flag
   testing_light = True
   # Send empty light command to get current light state
-  send_command(mqtt_client, selected_tile, CmdType.LIGHT, selected_tile.create_light_command(255, []))
+  send_command(mqtt_client, selected_tile, CmdType.LIGHT, create_light_command(selected_tile, 255, []))
   # Wait for response or timeout
   print("Getting current light state (5s)...")
   time.sleep(5)
@@ -306,7 +332,7 @@ def main():
     for pixel in pixels:
       pixel.from_dict({"r": 255, "g": 0, "b": 0, "w": 0})
     # Send light command
-    send_command(mqtt_client, selected_tile, CmdType.LIGHT, selected_tile.create_light_command(100, pixels))
+    send_command(mqtt_client, selected_tile, CmdType.LIGHT, create_light_command(selected_tile, 100, pixels))
     # Wait for response or timeout
     print("Turning LEDs to red (5s)...")
     time.sleep(5)
@@ -338,7 +364,7 @@ def main():
     for pixel in pixels:
       pixel.from_dict({"r": 0, "g": 255, "b": 0, "w": 0})
     # Send light command
-    send_command(mqtt_client, selected_tile, CmdType.LIGHT, selected_tile.create_light_command(100, pixels))
+    send_command(mqtt_client, selected_tile, CmdType.LIGHT, create_light_command(selected_tile, 100, pixels))
     # Wait for response or timeout
     print("Turning LEDs to green (5s)...")
     time.sleep(5)
@@ -370,7 +396,7 @@ def main():
     for pixel in pixels:
       pixel.from_dict({"r": 0, "g": 0, "b": 255, "w": 0})
     # Send light command
-    send_command(mqtt_client, selected_tile, CmdType.LIGHT, selected_tile.create_light_command(100, pixels))
+    send_command(mqtt_client, selected_tile, CmdType.LIGHT, create_light_command(selected_tile, 100, pixels))
     # Wait for response or timeout
     print("Turning LEDs to blue (5s)...")
     time.sleep(5)
@@ -402,7 +428,7 @@ def main():
     for pixel in pixels:
       pixel.from_dict({"r": 0, "g": 0, "b": 0, "w": 255})
     # Send light command
-    send_command(mqtt_client, selected_tile, CmdType.LIGHT, selected_tile.create_light_command(100, pixels))
+    send_command(mqtt_client, selected_tile, CmdType.LIGHT, create_light_command(selected_tile, 100, pixels))
     # Wait for response or timeout
     print("Turning LEDs to white (5s)...")
     time.sleep(5)
@@ -497,6 +523,11 @@ def main():
 
 # --- Run Main ---
 if __name__ == "__main__":
+  # Start the embedded broker
+  broker_thread = None
+  if EMBEDDED_BROKER:
+    broker_thread = start_embedded_broker(MQTT_HOST, MQTT_PORT)
+    print(f"Embedded MQTT broker listening on {MQTT_HOST}:{MQTT_PORT}")
   # Connect to mqtt broker
   print("Connecting to MQTT broker...")
   # Configure MQTT client
@@ -531,4 +562,7 @@ if __name__ == "__main__":
   # Stop the MQTT client loop
   mqtt_client.loop_stop()
   # Disconnect from MQTT server
-  mqtt_client.disconnect()
\ No newline at end of file
+  mqtt_client.disconnect()
+  # Stop the embedded broker
+  if broker_thread is not None:
+    broker_thread.stop()
\ No newline at end of file
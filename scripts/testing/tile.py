@@ -1,6 +1,8 @@
 from pixel import Pixel
 from enum import Enum
+from lightframe import encode_light_frame, decode_light_frame
 import json
+import struct
 
 class CmdType(Enum):
   SYSTEM = "system"
@@ -90,8 +92,8 @@ class Tile:
     return self._detected
   
   # Methods
-  def update_state(self, state_type: StateType, state: str) -> None:
-    """Set the state of the tile from a JSON string"""
+  def update_state(self, state_type: StateType, state: str | bytes) -> None:
+    """Set the state of the tile from a JSON string (or a binary light frame)"""
     match state_type:
       case StateType.ONLINE:
         self.update_online_state(state)
@@ -100,7 +102,10 @@ class Tile:
       case StateType.AUDIO:
         self.update_audio_state(state)
       case StateType.LIGHT:
-        self.update_light_state(state)
+        if isinstance(state, str):
+          self.update_light_state(state)
+        else:
+          self.update_light_frame(state)
       case StateType.PRESENCE:
         self.update_presence_state(state)
       case _:
@@ -170,6 +175,19 @@ class Tile:
       self.invalid_light_state = True
       return
 
+  def update_light_frame(self, frame: bytes) -> None:
+    """Set the light state of the tile from a binary light frame"""
+    try:
+      brightness, pixel_bytes = decode_light_frame(frame)
+      # Light
+      if brightness is not None:
+        self._brightness = brightness
+      self._pixels = [Pixel(*values) for values in struct.iter_unpack("4B", pixel_bytes)]
+    except ValueError:
+      # Invalid light frame, set invalid flag
+      self.invalid_light_state = True
+      return
+
   def update_presence_state(self, state: str) -> None:
     """Set the presence state of the tile from a JSON string"""
     try:
@@ -245,3 +263,12 @@ class Tile:
     # Convert the dictionary to a JSON string
     command_json: str = json.dumps(command)
     return command_json
+
+  def create_light_frame(self, brightness: int = None, pixels: list[Pixel] = None) -> bytes:
+    """Create a binary light frame to send to the tile to change the light state"""
+    # Replace None values with the current state
+    if brightness is None:
+      brightness = self._brightness
+    if pixels is None:
+      pixels = self._pixels
+    return encode_light_frame(brightness, pixels)
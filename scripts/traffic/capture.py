@@ -0,0 +1,201 @@
+"""Capture files of MQTT traffic (written by record.py, read by replay.py).
+
+A capture is append-only: a file header, then chunks of messages. A chunk holds the messages of about a
+second, zlib compressed (the topics and JSON states repeat a lot). Its header holds the time of the first
+and last message, the amount of messages and a checksum, so the chunk headers are the index: a reader
+finds a time or message by skipping from header to header, without decompressing the chunks before it.
+A chunk is written at once, a capture that was cut off (e.g. the recorder was killed) ends at its last
+complete chunk, and recording can continue in the same file."""
+import os
+import zlib
+import struct
+from typing import Iterator
+
+# --- Constants ---
+MAGIC: bytes = b"MLTCAP"
+VERSION: int = 1
+FILE_HEADER: struct.Struct = struct.Struct("<6sH") # magic, version
+CHUNK_MAGIC: bytes = b"CHNK"
+CHUNK_HEADER: struct.Struct = struct.Struct("<4sqqIII") # magic, time of the first and last message (ns since epoch), amount of messages, size of the compressed messages, crc32 of the compressed messages
+MESSAGE_HEADER: struct.Struct = struct.Struct("<qBHI") # time (ns since epoch), flags (qos | retain << 2), topic length, payload length
+CHUNK_MESSAGES: int = 1000 # Messages after which a chunk is written (also written after CHUNK_SECONDS)
+CHUNK_SECONDS: float = 1.0
+COMPRESSION_LEVEL: int = 6
+
+# --- Functions ---
+def topic_matches(topic_filter: str, topic: str) -> bool:
+  """Returns true if the topic matches the topic filter (with + and # wildcards, like broker.py)."""
+  filter_levels = topic_filter.split("/")
+  topic_levels = topic.split("/")
+  if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+    return False
+  for i, level in enumerate(filter_levels):
+    if level == "#":
+      return True
+    if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+      return False
+  return len(filter_levels) == len(topic_levels)
+
+# --- Messages ---
+class CapturedMessage:
+  """A recorded MQTT message."""
+  __slots__ = ("time_ns", "topic", "payload", "qos", "retain")
+
+  def __init__(self, time_ns: int, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+    self.time_ns: int = time_ns # Time the message was received (ns since epoch)
+    self.topic: str = topic
+    self.payload: bytes = payload
+    self.qos: int = qos
+    self.retain: bool = retain # Retained message, as received by the recorder (the retained states at the start of a recording)
+
+class ChunkInfo:
+  """Header of a chunk (an entry of the index)."""
+  __slots__ = ("offset", "first_ns", "last_ns", "count", "size", "crc")
+
+  def __init__(self, offset: int, first_ns: int, last_ns: int, count: int, size: int, crc: int):
+    self.offset: int = offset # Position of the chunk header in the file
+    self.first_ns: int = first_ns
+    self.last_ns: int = last_ns
+    self.count: int = count
+    self.size: int = size # Size of the compressed messages
+    self.crc: int = crc
+
+# --- Writer ---
+class CaptureWriter:
+  """Appends messages to a capture file, a chunk at a time."""
+  # Constructor
+  def __init__(self, path: str, chunk_messages: int = CHUNK_MESSAGES, chunk_seconds: float = CHUNK_SECONDS):
+    self.path: str = path
+    self.chunk_messages: int = chunk_messages
+    self.chunk_seconds: float = chunk_seconds
+    self.messages: int = 0 # Messages written (and buffered) since opened
+    self.bytes: int = 0 # Compressed bytes written since opened
+    self._buffer: bytearray = bytearray() # Encoded messages of the next chunk
+    self._count: int = 0 # Messages in the buffer
+    self._first_ns: int = 0
+    self._last_ns: int = 0
+    self._file = None
+
+  def open(self) -> None:
+    """Opens the capture, a new file or an existing capture to continue (after its last complete chunk)."""
+    if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+      # Cut off an incomplete last chunk, so the new chunks follow the complete ones
+      end = CaptureReader(self.path).end
+      self._file = open(self.path, "r+b")
+      self._file.truncate(end)
+      self._file.seek(end)
+    else:
+      self._file = open(self.path, "wb")
+      self._file.write(FILE_HEADER.pack(MAGIC, VERSION))
+      self._file.flush()
+
+  def write(self, message: CapturedMessage) -> None:
+    """Adds a message to the chunk that is being built (written when full or after chunk_seconds)."""
+    topic = message.topic.encode("utf-8")
+    if self._count == 0:
+      self._first_ns = message.time_ns
+    self._buffer += MESSAGE_HEADER.pack(message.time_ns, message.qos | message.retain << 2, len(topic), len(message.payload))
+    self._buffer += topic
+    self._buffer += message.payload
+    self._count += 1
+    self._last_ns = max(self._last_ns, message.time_ns)
+    self.messages += 1
+    if self._count >= self.chunk_messages or self._last_ns - self._first_ns >= self.chunk_seconds * 1e9:
+      self.flush()
+
+  def flush_if_due(self, now_ns: int) -> None:
+    """Writes the chunk if its first message is older than chunk_seconds (call regularly, for quiet periods)."""
+    if self._count > 0 and now_ns - self._first_ns >= self.chunk_seconds * 1e9:
+      self.flush()
+
+  def flush(self) -> None:
+    """Writes the chunk that is being built (with a single write, so a chunk is never half written by the writer itself)."""
+    if self._count == 0:
+      return
+    data = zlib.compress(self._buffer, COMPRESSION_LEVEL)
+    self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self._first_ns, self._last_ns, self._count, len(data), zlib.crc32(data)) + data)
+    self._file.flush()
+    self.bytes += CHUNK_HEADER.size + len(data)
+    self._buffer = bytearray()
+    self._count = 0
+    self._last_ns = 0
+
+  def close(self) -> None:
+    if self._file is not None:
+      self.flush()
+      self._file.close()
+      self._file = None
+
+# --- Reader ---
+class CaptureReader:
+  """Reads a capture file. The index (the chunk headers) is read when opened."""
+  # Constructor
+  def __init__(self, path: str):
+    self.path: str = path
+    self.chunks: list[ChunkInfo] = [] # The index
+    self.end: int = FILE_HEADER.size # Position after the last complete chunk
+    self._read_index()
+
+  # Properties
+  @property
+  def messages(self) -> int:
+    return sum(chunk.count for chunk in self.chunks)
+
+  @property
+  def first_ns(self) -> int:
+    return self.chunks[0].first_ns if len(self.chunks) > 0 else 0
+
+  @property
+  def last_ns(self) -> int:
+    return max((chunk.last_ns for chunk in self.chunks), default=0)
+
+  # Methods
+  def _read_index(self) -> None:
+    size = os.path.getsize(self.path)
+    with open(self.path, "rb") as file:
+      header = file.read(FILE_HEADER.size)
+      if len(header) < FILE_HEADER.size:
+        raise ValueError(self.path + " is not a capture file")
+      magic, version = FILE_HEADER.unpack(header)
+      if magic != MAGIC:
+        raise ValueError(self.path + " is not a capture file")
+      if version != VERSION:
+        raise ValueError(self.path + " is a capture of version " + str(version) + ", expected version " + str(VERSION))
+      offset = FILE_HEADER.size
+      while offset + CHUNK_HEADER.size <= size:
+        file.seek(offset)
+        magic, first_ns, last_ns, count, length, crc = CHUNK_HEADER.unpack(file.read(CHUNK_HEADER.size))
+        # Stop at a chunk that isn't complete (the recorder was stopped while writing it)
+        if magic != CHUNK_MAGIC or offset + CHUNK_HEADER.size + length > size:
+          break
+        self.chunks.append(ChunkInfo(offset, first_ns, last_ns, count, length, crc))
+        offset += CHUNK_HEADER.size + length
+      self.end = offset
+
+  def read(self, start_ns: int = None, end_ns: int = None) -> Iterator[CapturedMessage]:
+    """Returns the messages (in the order they were recorded), only the ones between start_ns and end_ns if given.
+
+    Chunks outside of the range are skipped without reading them."""
+    with open(self.path, "rb") as file:
+      for chunk in self.chunks:
+        if (start_ns is not None and chunk.last_ns < start_ns) or (end_ns is not None and chunk.first_ns > end_ns):
+          continue
+        file.seek(chunk.offset + CHUNK_HEADER.size)
+        data = file.read(chunk.size)
+        if zlib.crc32(data) != chunk.crc:
+          raise ValueError("Chunk at " + str(chunk.offset) + " of " + self.path + " is damaged")
+        for message in self._decode_chunk(zlib.decompress(data)):
+          if (start_ns is None or message.time_ns >= start_ns) and (end_ns is None or message.time_ns <= end_ns):
+            yield message
+
+  @staticmethod
+  def _decode_chunk(data: bytes) -> Iterator[CapturedMessage]:
+    position = 0
+    while position < len(data):
+      time_ns, flags, topic_length, payload_length = MESSAGE_HEADER.unpack_from(data, position)
+      position += MESSAGE_HEADER.size
+      topic = data[position:position + topic_length].decode("utf-8")
+      position += topic_length
+      payload = data[position:position + payload_length]
+      position += payload_length
+      yield CapturedMessage(time_ns, topic, payload, flags & 0x03, bool(flags & 0x04))
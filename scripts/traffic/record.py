@@ -0,0 +1,82 @@
+"""Records the MQTT traffic under ROOT_TOPIC/# to a capture file (see capture.py), till enter (or Ctrl+C) is pressed.
+
+  python record.py show.cap                  # broker and root topic from the environment (.env), everything without ROOT_TOPIC
+  python record.py show.cap --topic "#"      # everything on the broker
+
+The retained messages the broker sends when subscribing are recorded first (with retain set), they are the state
+of the floor at the start of the recording. An existing capture is continued, not overwritten."""
+import os
+import sys
+import time
+import dotenv
+import argparse
+import threading
+import paho.mqtt.client as mqtt
+from capture import CaptureWriter, CapturedMessage
+
+STATUS_INTERVAL: float = 10.0 # Seconds between the status lines
+
+def main() -> int:
+  dotenv.load_dotenv()
+  parser = argparse.ArgumentParser(description="Records MQTT traffic to a capture file.")
+  parser.add_argument("capture", help="capture file to write (continued if it exists)")
+  parser.add_argument("--host", default=os.getenv("MQTT_HOST", "127.0.0.1"), help="MQTT broker (default: MQTT_HOST)")
+  parser.add_argument("--port", type=int, default=int(os.getenv("MQTT_PORT", "1883")), help="MQTT port (default: MQTT_PORT)")
+  parser.add_argument("--topic", default=os.getenv("ROOT_TOPIC") + "/#" if os.getenv("ROOT_TOPIC") else "#", help="topic filter to record (default: ROOT_TOPIC/#, # without ROOT_TOPIC)")
+  args = parser.parse_args()
+
+  writer = CaptureWriter(args.capture)
+  writer.open()
+  lock = threading.Lock() # The writer is used by the network thread of the client and by the main thread
+  stop_event = threading.Event()
+
+  def on_connect(client, userdata, flags, rc):
+    if rc != 0:
+      print("Could not connect to " + args.host + ":" + str(args.port) + ", result code " + str(rc), file=sys.stderr)
+      return
+    # Subscribe on every (re)connect, QoS 1 to record the QoS of the publisher (0 or 1)
+    client.subscribe(args.topic, 1)
+
+  def on_message(client, userdata, message):
+    with lock:
+      writer.write(CapturedMessage(time.time_ns(), message.topic, message.payload, message.qos, bool(message.retain)))
+
+  def wait_for_enter():
+    try:
+      input()
+    except EOFError:
+      pass
+    stop_event.set()
+
+  client = mqtt.Client(clean_session=True)
+  client.on_connect = on_connect
+  client.on_message = on_message
+  if os.getenv("MQTT_USER") and os.getenv("MQTT_PASS"):
+    client.username_pw_set(os.getenv("MQTT_USER"), os.getenv("MQTT_PASS"))
+  client.connect_async(args.host, args.port, 60)
+  client.loop_start()
+  print("Recording " + args.topic + " from " + args.host + ":" + str(args.port) + " to " + args.capture + ", press enter to stop")
+  threading.Thread(target=wait_for_enter, daemon=True).start()
+
+  started = time.monotonic()
+  last_status = started
+  try:
+    while not stop_event.wait(1):
+      # Write the last chunk in quiet periods too
+      with lock:
+        writer.flush_if_due(time.time_ns())
+      if time.monotonic() - last_status >= STATUS_INTERVAL:
+        last_status = time.monotonic()
+        print(f"{writer.messages} messages, {writer.bytes / 1e6:.2f} MB written in {last_status - started:.0f} s")
+  except KeyboardInterrupt:
+    pass
+  finally:
+    client.loop_stop()
+    client.disconnect()
+    with lock:
+      writer.close()
+  print(f"Recorded {writer.messages} messages ({writer.bytes / 1e6:.2f} MB) in {time.monotonic() - started:.0f} s to {args.capture}")
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
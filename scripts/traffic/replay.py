@@ -0,0 +1,118 @@
+"""Replays a capture (see capture.py) into an MQTT broker, at the recorded pace, faster or as fast as possible.
+
+  python replay.py show.cap                                # at the recorded pace
+  python replay.py show.cap --speed 10                     # 10 times faster
+  python replay.py show.cap --speed 0                      # as fast as possible
+  python replay.py show.cap --filter "+/+/self/#"          # only what the tiles published (not the commands)
+  python replay.py show.cap --remap TILE1=TILE7 --root-topic test
+  python replay.py show.cap --keep-retain                  # publish the recorded retained states as retained
+
+With a controller connected to the broker (e.g. the embedded broker of the controller, MQTT_EMBEDDED_BROKER),
+the replay puts the load of the recorded show on its mqtt_on_message pipeline, to profile it or compare versions.
+Filters match the recorded topics, the root topic and the tile names are replaced after filtering.
+The retained states at the start of a recording are replayed as normal messages, unless --keep-retain is given
+(a retained replay replaces the live retained states of the tiles on the broker)."""
+import os
+import sys
+import time
+import dotenv
+import argparse
+import threading
+import paho.mqtt.client as mqtt
+from capture import CaptureReader, topic_matches
+
+WINDOW: int = 1000 # Messages that may wait in the client before the replay waits for them to be sent
+
+def rewrite_topic(topic: str, root_topic: str | None, remap: dict[str, str]) -> str:
+  """Replaces the root topic (first level) and the tile name (second level) of a topic."""
+  levels = topic.split("/")
+  if root_topic is not None:
+    levels[0] = root_topic
+  if len(levels) > 1 and levels[1] in remap:
+    levels[1] = remap[levels[1]]
+  return "/".join(levels)
+
+def parse_remap(pairs: list[str]) -> dict[str, str]:
+  """Parses OLD=NEW pairs."""
+  remap = {}
+  for pair in pairs:
+    old, separator, new = pair.partition("=")
+    if separator == "" or old == "" or new == "":
+      raise argparse.ArgumentTypeError("Expected OLD=NEW, got " + pair)
+    remap[old] = new
+  return remap
+
+def main() -> int:
+  dotenv.load_dotenv()
+  parser = argparse.ArgumentParser(description="Replays a capture file into an MQTT broker.")
+  parser.add_argument("capture", help="capture file to replay")
+  parser.add_argument("--host", default=os.getenv("MQTT_HOST", "127.0.0.1"), help="MQTT broker (default: MQTT_HOST)")
+  parser.add_argument("--port", type=int, default=int(os.getenv("MQTT_PORT", "1883")), help="MQTT port (default: MQTT_PORT)")
+  parser.add_argument("--speed", type=float, default=1.0, help="times faster than recorded (default: 1, 0 = as fast as possible)")
+  parser.add_argument("--filter", action="append", default=[], help="only replay the topics that match this filter (can be repeated)")
+  parser.add_argument("--remap", action="append", default=[], help="replaces a tile name, OLD=NEW (can be repeated)")
+  parser.add_argument("--root-topic", help="replaces the root topic")
+  parser.add_argument("--start", type=float, default=0.0, help="seconds into the capture to start at (default: 0)")
+  parser.add_argument("--duration", type=float, help="seconds of the capture to replay (default: till the end)")
+  parser.add_argument("--keep-retain", action="store_true", help="publish the recorded retained messages as retained (replaces the retained states on the broker)")
+  args = parser.parse_args()
+  remap = parse_remap(args.remap)
+
+  reader = CaptureReader(args.capture)
+  if len(reader.chunks) == 0:
+    print(args.capture + " has no messages", file=sys.stderr)
+    return 1
+  start_ns = reader.first_ns + int(args.start * 1e9)
+  end_ns = start_ns + int(args.duration * 1e9) if args.duration is not None else None
+  print(f"{args.capture}: {reader.messages} messages in {(reader.last_ns - reader.first_ns) / 1e9:.0f} s ({len(reader.chunks)} chunks)")
+
+  # Connect
+  connected = threading.Event()
+  client = mqtt.Client(clean_session=True)
+  client.on_connect = lambda client, userdata, flags, rc: connected.set() if rc == 0 else None
+  if os.getenv("MQTT_USER") and os.getenv("MQTT_PASS"):
+    client.username_pw_set(os.getenv("MQTT_USER"), os.getenv("MQTT_PASS"))
+  client.max_inflight_messages_set(WINDOW)
+  client.connect(args.host, args.port, 60)
+  client.loop_start()
+  if not connected.wait(10):
+    print("Could not connect to " + args.host + ":" + str(args.port), file=sys.stderr)
+    return 1
+
+  # Replay (the times are relative to the first replayed message)
+  replayed = 0
+  payload_bytes = 0
+  max_lag = 0.0
+  first_ns = None
+  info = None
+  started = time.monotonic()
+  try:
+    for message in reader.read(start_ns, end_ns):
+      if len(args.filter) > 0 and not any(topic_matches(topic_filter, message.topic) for topic_filter in args.filter):
+        continue
+      if first_ns is None:
+        first_ns = message.time_ns
+      if args.speed > 0:
+        delay = started + (message.time_ns - first_ns) / 1e9 / args.speed - time.monotonic()
+        if delay > 0:
+          time.sleep(delay)
+        else:
+          max_lag = max(max_lag, -delay)
+      info = client.publish(rewrite_topic(message.topic, args.root_topic, remap), message.payload, message.qos, message.retain and args.keep_retain)
+      replayed += 1
+      payload_bytes += len(message.payload)
+      # Don't let the messages pile up in the client (as fast as possible is as fast as the broker takes them)
+      if replayed % WINDOW == 0:
+        info.wait_for_publish()
+  except KeyboardInterrupt:
+    pass
+  if info is not None:
+    info.wait_for_publish()
+  seconds = time.monotonic() - started
+  client.loop_stop()
+  client.disconnect()
+  print(f"Replayed {replayed} messages ({payload_bytes / 1e6:.2f} MB) in {seconds:.2f} s, {replayed / max(seconds, 1e-9):,.0f} msg/s, at most {max_lag * 1000:.1f} ms behind")
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
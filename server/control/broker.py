@@ -0,0 +1,699 @@
+"""Lightweight MQTT 3.1.1 broker, for tests and benchmarks that shouldn't depend on an external broker.
+
+Supports what the controller, the emulator and the test runner use: wildcard subscriptions (+ and #),
+retained messages, last will and QoS 0 and 1 (QoS 2 messages are received, and delivered with QoS 1 at most).
+Sessions are never persisted (clean_session=False is accepted, but the session starts empty) and QoS 1
+messages to clients aren't retransmitted.
+
+Runs on the event loop (Broker.run or start/stop), in a thread of its own (BrokerThread, for scripts
+without an event loop) or on its own on localhost:
+
+  python broker.py --port 1883 --stats 10
+
+BrokerStats counts the messages and bytes (in total and per topic), on_publish is called with every
+message the broker receives, and latency delays everything the broker sends (to simulate a network)."""
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from collections import deque
+from typing import Callable
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+# Packet types (MQTT 3.1.1, section 2.2.1)
+CONNECT: int = 1
+CONNACK: int = 2
+PUBLISH: int = 3
+PUBACK: int = 4
+PUBREC: int = 5
+PUBREL: int = 6
+PUBCOMP: int = 7
+SUBSCRIBE: int = 8
+SUBACK: int = 9
+UNSUBSCRIBE: int = 10
+UNSUBACK: int = 11
+PINGREQ: int = 12
+PINGRESP: int = 13
+DISCONNECT: int = 14
+PROTOCOLS: dict[str, int] = {"MQTT": 4, "MQIsdp": 3} # Protocol name -> level (3.1.1 and 3.1)
+CONNECT_TIMEOUT: float = 10.0 # Seconds a new connection has to send its CONNECT
+MAX_WRITE_BUFFER: int = 8 * 1024 * 1024 # Bytes waiting to be sent to a (slow) client before its QoS 0 messages are dropped
+
+# --- Functions ---
+def topic_matches(topic_filter: str, topic: str) -> bool:
+  """Returns true if the topic matches the topic filter (with + and # wildcards)."""
+  filter_levels = topic_filter.split("/")
+  topic_levels = topic.split("/")
+  # Wildcards at the first level don't match topics that start with $ (like $SYS)
+  if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+    return False
+  for i, level in enumerate(filter_levels):
+    if level == "#":
+      return True
+    if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+      return False
+  return len(filter_levels) == len(topic_levels)
+
+def is_valid_filter(topic_filter: str) -> bool:
+  """Returns true if the topic filter is valid (# only as the last level, wildcards only as a whole level)."""
+  if len(topic_filter) == 0:
+    return False
+  levels = topic_filter.split("/")
+  for i, level in enumerate(levels):
+    if "#" in level and (level != "#" or i != len(levels) - 1):
+      return False
+    if "+" in level and level != "+":
+      return False
+  return True
+
+def _encode_length(length: int) -> bytes:
+  """Encodes the remaining length of a packet (1 to 4 bytes, 7 bits per byte)."""
+  encoded = bytearray()
+  while True:
+    byte = length % 128
+    length //= 128
+    if length > 0:
+      byte |= 0x80
+    encoded.append(byte)
+    if length == 0:
+      return bytes(encoded)
+
+def _encode_packet(packet_type: int, flags: int, body: bytes) -> bytes:
+  return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+def _encode_publish(topic: bytes, payload: bytes, qos: int, retain: bool, packet_id: int = 0) -> bytes:
+  variable = len(topic).to_bytes(2, "big") + topic
+  if qos > 0:
+    variable += packet_id.to_bytes(2, "big")
+  return bytes([PUBLISH << 4 | qos << 1 | retain]) + _encode_length(len(variable) + len(payload)) + variable + payload
+
+def _read_string(data: bytes, position: int) -> tuple[bytes, int]:
+  """Reads a length prefixed string (as bytes), returns it and the position after it."""
+  length = int.from_bytes(data[position:position + 2], "big")
+  end = position + 2 + length
+  if end > len(data):
+    raise ValueError("String runs past the end of the packet")
+  return bytes(data[position + 2:end]), end
+
+# --- Topic trees ---
+class _Node:
+  """Level of a topic tree."""
+  __slots__ = ("children", "value")
+
+  def __init__(self):
+    self.children: dict[str, _Node] = {}
+    self.value = None
+
+class _SubscriptionTree:
+  """Subscriptions by topic filter level, so matching a topic only visits the levels it can match."""
+  def __init__(self):
+    self._root: _Node = _Node()
+
+  def add(self, topic_filter: str, session: "_Session", qos: int) -> None:
+    node = self._root
+    for level in topic_filter.split("/"):
+      child = node.children.get(level)
+      if child is None:
+        child = node.children[level] = _Node()
+      node = child
+    if node.value is None:
+      node.value = {}
+    node.value[session] = qos
+
+  def remove(self, topic_filter: str, session: "_Session") -> None:
+    # Remember the path, to remove the levels nobody is subscribed to anymore
+    path = [self._root]
+    for level in topic_filter.split("/"):
+      node = path[-1].children.get(level)
+      if node is None:
+        return
+      path.append(node)
+    node = path[-1]
+    if node.value is not None:
+      node.value.pop(session, None)
+      if len(node.value) == 0:
+        node.value = None
+    for level, parent, node in zip(reversed(topic_filter.split("/")), reversed(path[:-1]), reversed(path[1:])):
+      if node.value is not None or len(node.children) > 0:
+        break
+      del parent.children[level]
+
+  def match(self, topic: str) -> dict["_Session", int]:
+    """Returns the sessions subscribed to the topic, with the highest QoS of their matching subscriptions."""
+    result: dict[_Session, int] = {}
+    self._match(self._root, topic.split("/"), 0, result, topic.startswith("$"))
+    return result
+
+  def _match(self, node: _Node, levels: list[str], index: int, result: dict, system: bool) -> None:
+    wildcards = not (index == 0 and system)
+    if wildcards:
+      # "a/#" also matches "a"
+      child = node.children.get("#")
+      if child is not None:
+        self._merge(child.value, result)
+    if index == len(levels):
+      self._merge(node.value, result)
+      return
+    if wildcards:
+      child = node.children.get("+")
+      if child is not None:
+        self._match(child, levels, index + 1, result, system)
+    child = node.children.get(levels[index])
+    if child is not None:
+      self._match(child, levels, index + 1, result, system)
+
+  @staticmethod
+  def _merge(subscribers: dict | None, result: dict) -> None:
+    if subscribers is None:
+      return
+    for session, qos in subscribers.items():
+      if result.get(session, -1) < qos:
+        result[session] = qos
+
+class _RetainedTree:
+  """Retained messages by topic level, so a subscription only visits the topics its filter can match."""
+  def __init__(self):
+    self._root: _Node = _Node()
+    self.count: int = 0
+
+  def set(self, topic: str, payload: bytes, qos: int) -> None:
+    """Retains the message of the topic, an empty payload removes it."""
+    if len(payload) == 0:
+      self._remove(topic)
+      return
+    node = self._root
+    for level in topic.split("/"):
+      child = node.children.get(level)
+      if child is None:
+        child = node.children[level] = _Node()
+      node = child
+    if node.value is None:
+      self.count += 1
+    node.value = (topic, payload, qos)
+
+  def _remove(self, topic: str) -> None:
+    levels = topic.split("/")
+    path = [self._root]
+    for level in levels:
+      node = path[-1].children.get(level)
+      if node is None:
+        return
+      path.append(node)
+    if path[-1].value is None:
+      return
+    path[-1].value = None
+    self.count -= 1
+    for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+      if node.value is not None or len(node.children) > 0:
+        break
+      del parent.children[level]
+
+  def match(self, topic_filter: str) -> list[tuple[str, bytes, int]]:
+    """Returns the retained messages (topic, payload, qos) that match the topic filter."""
+    result = []
+    self._match(self._root, topic_filter.split("/"), 0, result)
+    return result
+
+  def _match(self, node: _Node, levels: list[str], index: int, result: list) -> None:
+    if index == len(levels):
+      if node.value is not None:
+        result.append(node.value)
+      return
+    level = levels[index]
+    if level == "#":
+      # Everything below this level, and this level itself ("a/#" also matches "a")
+      stack = [node]
+      while len(stack) > 0:
+        current = stack.pop()
+        if current.value is not None and not (index == 0 and current.value[0].startswith("$")):
+          result.append(current.value)
+        stack.extend(current.children.values())
+      return
+    if level == "+":
+      for name, child in node.children.items():
+        if not (index == 0 and name.startswith("$")):
+          self._match(child, levels, index + 1, result)
+      return
+    child = node.children.get(level)
+    if child is not None:
+      self._match(child, levels, index + 1, result)
+
+# --- Statistics ---
+class BrokerStats:
+  """Counters of the broker, to compare runs of a benchmark (reset between runs)."""
+  def __init__(self):
+    self.connects: int = 0 # Accepted CONNECTs
+    self.messages_in: int = 0 # PUBLISH packets received (and messages published in-process)
+    self.bytes_in: int = 0 # Payload bytes received
+    self.messages_out: int = 0 # PUBLISH packets sent to subscribers
+    self.bytes_out: int = 0 # Payload bytes sent to subscribers
+    self.dropped: int = 0 # QoS 0 messages dropped because a client didn't keep up
+    self.wills: int = 0 # Last wills published
+    self.topic_messages: dict[str, int] = {} # Topic -> messages received
+    self.topic_bytes: dict[str, int] = {} # Topic -> payload bytes received
+
+  def reset(self) -> None:
+    self.__init__()
+
+  def to_dict(self, topics: int = 10) -> dict:
+    """Returns the counters, with the topics that received the most bytes."""
+    busiest = sorted(self.topic_bytes.items(), key=lambda item: item[1], reverse=True)[:topics]
+    return {
+      "connects": self.connects,
+      "messages_in": self.messages_in,
+      "bytes_in": self.bytes_in,
+      "messages_out": self.messages_out,
+      "bytes_out": self.bytes_out,
+      "dropped": self.dropped,
+      "wills": self.wills,
+      "topics": len(self.topic_bytes),
+      "busiest_topics": {topic: {"messages": self.topic_messages[topic], "bytes": size} for topic, size in busiest}
+    }
+
+# --- Broker ---
+class _Session(asyncio.Protocol):
+  """Connection of one client."""
+  def __init__(self, broker: "Broker"):
+    self._broker: Broker = broker
+    self._transport: asyncio.Transport = None
+    self._buffer: bytearray = bytearray()
+    self._delayed: deque[tuple[float, bytes]] = deque() # Packets held back by the injected latency (send time, packet)
+    self._next_packet_id: int = 0
+    self._qos2_ids: set[int] = set() # Ids of QoS 2 messages that were received but not released yet
+    self.client_id: str = None
+    self.connected: bool = False # CONNECT accepted
+    self.keepalive: int = 0 # Seconds
+    self.last_seen: float = time.monotonic()
+    self.subscriptions: dict[str, int] = {} # Topic filter -> granted QoS
+    self.will: tuple[str, bytes, int, bool] = None # Topic, payload, QoS and retain of the last will
+
+  # asyncio.Protocol
+  def connection_made(self, transport: asyncio.Transport) -> None:
+    self._transport = transport
+    self._broker._sessions.add(self)
+
+  def connection_lost(self, exc: Exception | None) -> None:
+    self._broker._remove_session(self)
+
+  def data_received(self, data: bytes) -> None:
+    self.last_seen = time.monotonic()
+    buffer = self._buffer
+    buffer += data
+    position = 0
+    try:
+      while True:
+        # Fixed header: type and flags, then the remaining length (1 to 4 bytes)
+        if len(buffer) - position < 2:
+          break
+        length = 0
+        multiplier = 1
+        index = position + 1
+        while True:
+          if index >= len(buffer):
+            length = -1
+            break
+          byte = buffer[index]
+          length += (byte & 0x7F) * multiplier
+          multiplier *= 128
+          index += 1
+          if byte & 0x80 == 0:
+            break
+          if multiplier > 128 ** 3:
+            raise ValueError("Malformed remaining length")
+        if length < 0 or len(buffer) - index < length:
+          break
+        header = buffer[position]
+        body = bytes(buffer[index:index + length])
+        position = index + length
+        self._handle(header >> 4, header & 0x0F, body)
+        if self._transport.is_closing():
+          return
+    except (ValueError, IndexError, UnicodeDecodeError) as error:
+      logger.warning("Closing " + str(self.client_id) + ": " + str(error))
+      self._transport.close()
+      return
+    del buffer[:position]
+
+  # Packets
+  def _handle(self, packet_type: int, flags: int, body: bytes) -> None:
+    if not self.connected and packet_type != CONNECT:
+      raise ValueError("Expected CONNECT, got packet type " + str(packet_type))
+    if packet_type == PUBLISH:
+      self._handle_publish(flags, body)
+    elif packet_type == PUBACK or packet_type == PUBCOMP:
+      # QoS 1 and 2 messages to the client aren't retransmitted, nothing to do
+      pass
+    elif packet_type == PUBREC:
+      self.send(_encode_packet(PUBREL, 0b0010, body[:2]))
+    elif packet_type == PUBREL:
+      self._qos2_ids.discard(int.from_bytes(body[:2], "big"))
+      self.send(_encode_packet(PUBCOMP, 0, body[:2]))
+    elif packet_type == SUBSCRIBE:
+      self._handle_subscribe(body)
+    elif packet_type == UNSUBSCRIBE:
+      self._handle_unsubscribe(body)
+    elif packet_type == PINGREQ:
+      self.send(bytes([PINGRESP << 4, 0]))
+    elif packet_type == DISCONNECT:
+      # Clean disconnect, the last will is discarded
+      self.will = None
+      self._transport.close()
+    elif packet_type == CONNECT:
+      if self.connected:
+        raise ValueError("Second CONNECT")
+      self._handle_connect(body)
+    else:
+      raise ValueError("Unexpected packet type " + str(packet_type))
+
+  def _handle_connect(self, body: bytes) -> None:
+    protocol, position = _read_string(body, 0)
+    level = body[position]
+    flags = body[position + 1]
+    self.keepalive = int.from_bytes(body[position + 2:position + 4], "big")
+    position += 4
+    if PROTOCOLS.get(protocol.decode("utf-8")) != level:
+      self._refuse(1) # Unacceptable protocol version
+      return
+    client_id, position = _read_string(body, position)
+    self.client_id = client_id.decode("utf-8")
+    if flags & 0x04:
+      # Last will (topic, message, QoS and retain from the flags)
+      will_topic, position = _read_string(body, position)
+      will_payload, position = _read_string(body, position)
+      self.will = (will_topic.decode("utf-8"), will_payload, min((flags >> 3) & 0x03, 1), bool(flags & 0x20))
+    username = password = None
+    if flags & 0x80:
+      username, position = _read_string(body, position)
+      username = username.decode("utf-8")
+    if flags & 0x40:
+      password, position = _read_string(body, position)
+      password = password.decode("utf-8")
+    if len(self.client_id) == 0:
+      if not flags & 0x02:
+        self._refuse(2) # Identifier rejected (a session without id can't be resumed)
+        return
+      self.client_id = self._broker._create_client_id()
+    if self._broker.users is not None and (username is None or self._broker.users.get(username) != password):
+      self._refuse(4) # Bad user name or password
+      return
+    self.connected = True
+    self._broker._add_client(self)
+    # Session present = 0 (sessions aren't persisted), return code 0 (accepted)
+    self.send(bytes([CONNACK << 4, 2, 0, 0]))
+
+  def _refuse(self, return_code: int) -> None:
+    self.will = None
+    self.send(bytes([CONNACK << 4, 2, 0, return_code]))
+    self._transport.close()
+
+  def _handle_publish(self, flags: int, body: bytes) -> None:
+    qos = (flags >> 1) & 0x03
+    topic, position = _read_string(body, 0)
+    topic = topic.decode("utf-8")
+    if len(topic) == 0 or "+" in topic or "#" in topic:
+      raise ValueError("Invalid topic to publish to: " + topic)
+    packet_id = 0
+    if qos > 0:
+      packet_id = int.from_bytes(body[position:position + 2], "big")
+      position += 2
+    payload = body[position:]
+    if qos == 2:
+      # Exactly once: a retransmission (with an id that wasn't released yet) isn't delivered again
+      duplicate = packet_id in self._qos2_ids
+      self._qos2_ids.add(packet_id)
+      self.send(_encode_packet(PUBREC, 0, packet_id.to_bytes(2, "big")))
+      if duplicate:
+        return
+    self._broker._route(topic, payload, min(qos, 1), bool(flags & 0x01), self.client_id)
+    if qos == 1:
+      self.send(_encode_packet(PUBACK, 0, packet_id.to_bytes(2, "big")))
+
+  def _handle_subscribe(self, body: bytes) -> None:
+    packet_id = body[:2]
+    position = 2
+    granted = bytearray()
+    subscribed = []
+    while position < len(body):
+      topic_filter, position = _read_string(body, position)
+      topic_filter = topic_filter.decode("utf-8")
+      qos = min(body[position] & 0x03, 1)
+      position += 1
+      if not is_valid_filter(topic_filter):
+        granted.append(0x80) # Failure
+        continue
+      self.subscriptions[topic_filter] = qos
+      self._broker._subscriptions.add(topic_filter, self, qos)
+      granted.append(qos)
+      subscribed.append((topic_filter, qos))
+    self.send(_encode_packet(SUBACK, 0, packet_id + bytes(granted)))
+    # Retained messages of the new subscriptions (after the SUBACK)
+    for topic_filter, qos in subscribed:
+      for topic, payload, retained_qos in self._broker._retained.match(topic_filter):
+        self.deliver(topic.encode("utf-8"), payload, min(qos, retained_qos), True)
+
+  def _handle_unsubscribe(self, body: bytes) -> None:
+    position = 2
+    while position < len(body):
+      topic_filter, position = _read_string(body, position)
+      topic_filter = topic_filter.decode("utf-8")
+      if self.subscriptions.pop(topic_filter, None) is not None:
+        self._broker._subscriptions.remove(topic_filter, self)
+    self.send(_encode_packet(UNSUBACK, 0, body[:2]))
+
+  # Sending
+  def deliver(self, topic: bytes, payload: bytes, qos: int, retain: bool, packet: bytes = None) -> None:
+    """Sends a message to the client (packet is the encoded QoS 0 message, shared by all subscribers)."""
+    if qos == 0:
+      if self._transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+        self._broker.stats.dropped += 1
+        return
+      if packet is None:
+        packet = _encode_publish(topic, payload, 0, retain)
+    else:
+      self._next_packet_id = self._next_packet_id % 65535 + 1
+      packet = _encode_publish(topic, payload, qos, retain, self._next_packet_id)
+    self._broker.stats.messages_out += 1
+    self._broker.stats.bytes_out += len(payload)
+    self.send(packet)
+
+  def send(self, packet: bytes) -> None:
+    latency = self._broker.latency
+    if latency <= 0 and len(self._delayed) == 0:
+      self._transport.write(packet)
+      return
+    # Hold the packet back (in order) till the latency has passed
+    loop = asyncio.get_running_loop()
+    self._delayed.append((loop.time() + latency, packet))
+    if len(self._delayed) == 1:
+      loop.call_at(self._delayed[0][0], self._send_delayed)
+
+  def _send_delayed(self) -> None:
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    while len(self._delayed) > 0 and self._delayed[0][0] <= now:
+      packet = self._delayed.popleft()[1]
+      if not self._transport.is_closing():
+        self._transport.write(packet)
+    if len(self._delayed) > 0:
+      loop.call_at(self._delayed[0][0], self._send_delayed)
+
+  def close(self) -> None:
+    self._transport.close()
+
+class Broker:
+  """MQTT 3.1.1 broker on the event loop (see the module docstring for what it supports)."""
+  # Constructor
+  def __init__(self, host: str = "127.0.0.1", port: int = 1883, users: dict[str, str] = None, latency: float = 0.0):
+    self.host: str = host
+    self.port: int = port # 0 = a free port, set when started
+    self.users: dict[str, str] = users # User name -> password (None = everybody may connect)
+    self.latency: float = latency # Seconds everything the broker sends is held back (can be changed while running)
+    self.stats: BrokerStats = BrokerStats()
+    self.on_publish: Callable[[str, str, bytes, int, bool], None] = None # Called with client id, topic, payload, QoS and retain of every received message
+    self._server: asyncio.AbstractServer = None
+    self._sweeper: asyncio.Task = None
+    self._sessions: set[_Session] = set() # All connections (also the ones that didn't send CONNECT yet)
+    self._clients: dict[str, _Session] = {} # Client id -> connected session
+    self._subscriptions: _SubscriptionTree = _SubscriptionTree()
+    self._retained: _RetainedTree = _RetainedTree()
+    self._client_ids: int = 0
+
+  # Properties
+  @property
+  def clients(self) -> list[str]:
+    """Ids of the connected clients."""
+    return list(self._clients)
+
+  @property
+  def retained(self) -> int:
+    """Amount of retained messages."""
+    return self._retained.count
+
+  # Methods
+  async def start(self) -> None:
+    """Starts listening (on a free port if port is 0, see port)."""
+    loop = asyncio.get_running_loop()
+    self._server = await loop.create_server(lambda: _Session(self), self.host, self.port)
+    self.port = self._server.sockets[0].getsockname()[1]
+    self._sweeper = asyncio.create_task(self._sweep())
+    logger.info("MQTT broker listening on " + self.host + ":" + str(self.port))
+
+  async def stop(self) -> None:
+    """Stops listening and closes all connections (their last wills are published)."""
+    if self._server is None:
+      return
+    self._server.close()
+    self._sweeper.cancel()
+    for session in list(self._sessions):
+      session.close()
+    await self._server.wait_closed()
+    self._server = None
+
+  async def run(self) -> None:
+    """Runs the broker till cancelled."""
+    await self.start()
+    try:
+      await asyncio.Future()
+    finally:
+      await self.stop()
+
+  def publish(self, topic: str, payload: bytes | str, qos: int = 0, retain: bool = False) -> None:
+    """Publishes a message from within the process (like a client would, without a connection)."""
+    if isinstance(payload, str):
+      payload = payload.encode("utf-8")
+    self._route(topic, payload, min(qos, 1), retain, "")
+
+  def _route(self, topic: str, payload: bytes, qos: int, retain: bool, client_id: str) -> None:
+    """Counts, retains and delivers a received message to the matching subscriptions."""
+    stats = self.stats
+    stats.messages_in += 1
+    stats.bytes_in += len(payload)
+    stats.topic_messages[topic] = stats.topic_messages.get(topic, 0) + 1
+    stats.topic_bytes[topic] = stats.topic_bytes.get(topic, 0) + len(payload)
+    if retain:
+      self._retained.set(topic, payload, qos)
+    if self.on_publish is not None:
+      self.on_publish(client_id, topic, payload, qos, retain)
+    subscribers = self._subscriptions.match(topic)
+    if len(subscribers) == 0:
+      return
+    # The retain flag is only set on retained messages sent for a new subscription
+    encoded_topic = topic.encode("utf-8")
+    packet = None
+    for session, granted in subscribers.items():
+      if qos == 0 or granted == 0:
+        # The same QoS 0 packet for every subscriber
+        if packet is None:
+          packet = _encode_publish(encoded_topic, payload, 0, False)
+        session.deliver(encoded_topic, payload, 0, False, packet)
+      else:
+        session.deliver(encoded_topic, payload, 1, False)
+
+  def _create_client_id(self) -> str:
+    self._client_ids += 1
+    return "auto-" + str(self._client_ids)
+
+  def _add_client(self, session: _Session) -> None:
+    # A client that connects with the id of a connected client takes over (the old connection is closed)
+    previous = self._clients.get(session.client_id)
+    if previous is not None:
+      previous.close()
+    self._clients[session.client_id] = session
+    self.stats.connects += 1
+
+  def _remove_session(self, session: _Session) -> None:
+    self._sessions.discard(session)
+    if not session.connected:
+      return
+    if self._clients.get(session.client_id) is session:
+      del self._clients[session.client_id]
+    for topic_filter in session.subscriptions:
+      self._subscriptions.remove(topic_filter, session)
+    session.subscriptions = {}
+    if session.will is not None:
+      # Connection lost without DISCONNECT, publish the last will
+      topic, payload, qos, retain = session.will
+      session.will = None
+      self.stats.wills += 1
+      self._route(topic, payload, qos, retain, session.client_id)
+
+  async def _sweep(self) -> None:
+    """Closes connections that were silent longer than 1.5 times their keepalive (or didn't send CONNECT in time)."""
+    while True:
+      await asyncio.sleep(1)
+      now = time.monotonic()
+      for session in list(self._sessions):
+        limit = session.keepalive * 1.5 if session.connected else CONNECT_TIMEOUT
+        if limit > 0 and now - session.last_seen > limit:
+          logger.info("Closing " + str(session.client_id) + ": keepalive expired")
+          session.close()
+
+class BrokerThread(threading.Thread):
+  """Runs a broker on an event loop of its own, for scripts that don't run an event loop."""
+  def __init__(self, broker: Broker):
+    super().__init__(name="mqtt-broker", daemon=True)
+    self.broker: Broker = broker
+    self._ready: threading.Event = threading.Event()
+    self._loop: asyncio.AbstractEventLoop = None
+    self._stopped: asyncio.Event = None
+    self._error: Exception = None
+
+  def start(self) -> None:
+    """Starts the thread, returns when the broker listens (raises the error if it couldn't start)."""
+    super().start()
+    self._ready.wait()
+    if self._error is not None:
+      raise self._error
+
+  def stop(self) -> None:
+    """Stops the broker and waits for the thread to finish."""
+    if self._loop is not None and self.is_alive():
+      self._loop.call_soon_threadsafe(self._stopped.set)
+      self.join()
+
+  def run(self) -> None:
+    asyncio.run(self._run())
+
+  async def _run(self) -> None:
+    self._loop = asyncio.get_running_loop()
+    self._stopped = asyncio.Event()
+    try:
+      await self.broker.start()
+    except Exception as error:
+      self._error = error
+      return
+    finally:
+      self._ready.set()
+    await self._stopped.wait()
+    await self.broker.stop()
+
+async def main() -> None:
+  parser = argparse.ArgumentParser(description="Runs a lightweight MQTT 3.1.1 broker (for tests and benchmarks).")
+  parser.add_argument("--host", default="127.0.0.1", help="host to listen on (default: 127.0.0.1)")
+  parser.add_argument("--port", type=int, default=1883, help="port to listen on (default: 1883)")
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds everything the broker sends is held back (default: 0)")
+  parser.add_argument("--stats", type=float, default=0.0, help="prints the statistics every this many seconds (default: 0 = never)")
+  args = parser.parse_args()
+
+  broker = Broker(args.host, args.port, latency=args.latency)
+  await broker.start()
+  try:
+    while True:
+      await asyncio.sleep(args.stats if args.stats > 0 else 3600)
+      if args.stats > 0:
+        stats = broker.stats
+        logger.info(f"{len(broker.clients)} clients, {broker.retained} retained, {stats.messages_in} messages in ({stats.bytes_in} bytes), {stats.messages_out} out ({stats.bytes_out} bytes), {stats.dropped} dropped")
+  finally:
+    await broker.stop()
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+  try:
+    asyncio.run(main())
+  except KeyboardInterrupt:
+    pass
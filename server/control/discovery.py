@@ -0,0 +1,190 @@
+import random
+import asyncio
+import logging
+from enum import Enum
+from typing import Callable
+from tile import Tile, CmdType, StateType
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+class DiscoveryState(Enum):
+  """Where the discovery of a tile is."""
+  WAITING = "waiting" # Giving the tile time to connect and publish its state
+  QUEUED = "queued" # Waiting for a free discovery slot
+  SYSTEM = "system" # Getting the system values
+  AUDIO = "audio" # Getting the audio values
+  LIGHT = "light" # Getting the light values
+  DONE = "done" # All values are known
+  OFFLINE = "offline" # Stopped because the tile is offline (continues when it comes online)
+  FAILED = "failed" # Stopped because the tile didn't answer (retried when it comes online again)
+
+class TileDiscovery:
+  """The discovery of one tile."""
+  __slots__ = ("tile", "state", "started", "finished", "probes", "_event")
+
+  def __init__(self, tile: Tile, started: float):
+    self.tile: Tile = tile
+    self.state: DiscoveryState = DiscoveryState.WAITING
+    self.started: float = started # Time the discovery started (event loop time)
+    self.finished: float = None # Time the values were known (event loop time)
+    self.probes: int = 0 # Commands sent to get the values
+    self._event: asyncio.Event = asyncio.Event() # Set when a state of the tile came in
+
+class Discovery:
+  """Gets the system, audio and light values of new tiles (e.g. tiles that were already online before the controller started).
+
+  Every tile goes through the steps of DiscoveryState in a task. A step only sends a probe command
+  if its values are still missing (tiles publish their state retained, so after a restart of the controller
+  they are usually known right away) and then waits for the state of the tile to come in (notify),
+  a probe that isn't answered within the timeout is sent again with exponential backoff (and jitter).
+  At most `concurrency` tiles are probed at the same time, so a whole floor that powers up at once
+  doesn't flood the broker."""
+  # Constructor
+  def __init__(self, send_command: Callable[[Tile, CmdType, str], None], concurrency: int = 50, delay: float = 5.0, timeout: float = 2.0, max_timeout: float = 16.0, attempts: int = 5):
+    self._send_command: Callable[[Tile, CmdType, str], None] = send_command
+    self._slots: asyncio.Semaphore = None # Created on the event loop (see start)
+    self.concurrency: int = concurrency # Maximum amount of tiles that are probed at the same time
+    self.delay: float = delay # Seconds to give a new tile to publish its state before it is probed
+    self.timeout: float = timeout # Seconds to wait for the answer on the first probe (doubles every retry)
+    self.max_timeout: float = max_timeout # Maximum seconds to wait for an answer
+    self.attempts: int = attempts # Probes per step before the discovery fails
+    self._discoveries: dict[str, TileDiscovery] = {} # Tile name -> discovery
+    self._tasks: dict[str, asyncio.Task] = {} # Tile name -> running discovery task
+    self.probes: int = 0 # Commands sent to get values
+    self.timeouts: int = 0 # Probes that weren't answered in time
+    self.completed: int = 0 # Discoveries that got all values
+    self.failed: int = 0 # Discoveries that stopped because the tile didn't answer
+
+  def get(self, tile_name: str) -> TileDiscovery | None:
+    return self._discoveries.get(tile_name)
+
+  def start(self, tile: Tile) -> None:
+    """Starts (or continues) the discovery of the tile, if its values aren't known yet and it isn't running already."""
+    discovery = self._discoveries.get(tile.device_name)
+    if discovery is not None and (discovery.state == DiscoveryState.DONE or tile.device_name in self._tasks):
+      return
+    if self._slots is None:
+      self._slots = asyncio.Semaphore(self.concurrency)
+    if discovery is None:
+      discovery = TileDiscovery(tile, asyncio.get_running_loop().time())
+      self._discoveries[tile.device_name] = discovery
+    task = asyncio.create_task(self._run(discovery))
+    self._tasks[tile.device_name] = task
+    task.add_done_callback(lambda _: self._tasks.pop(tile.device_name, None))
+
+  def notify(self, tile: Tile, state_type: StateType) -> None:
+    """Passes a state update of the tile to its discovery (called after the tile processed the state)."""
+    discovery = self._discoveries.get(tile.device_name)
+    if discovery is None:
+      return
+    if tile.device_name in self._tasks:
+      # Wake up the discovery, it checks if the values it waits for are known now
+      discovery._event.set()
+    elif state_type == StateType.ONLINE and tile.online and discovery.state in (DiscoveryState.OFFLINE, DiscoveryState.FAILED):
+      # Tile came (back) online before its values were known
+      self.start(tile)
+
+  async def stop(self) -> None:
+    """Cancels the running discoveries."""
+    tasks = list(self._tasks.values())
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  def to_dict(self) -> dict:
+    states = {state.value: 0 for state in DiscoveryState}
+    for discovery in self._discoveries.values():
+      states[discovery.state.value] += 1
+    durations = [discovery.finished - discovery.started for discovery in self._discoveries.values() if discovery.finished is not None]
+    return {
+      "concurrency": self.concurrency,
+      "running": len(self._tasks),
+      "states": states,
+      "probes": self.probes,
+      "timeouts": self.timeouts,
+      "completed": self.completed,
+      "failed": self.failed,
+      # Time from finding a tile till all its values were known
+      "mean_s": sum(durations) / len(durations) if len(durations) > 0 else 0.0,
+      "max_s": max(durations, default=0.0)
+    }
+
+  async def _run(self, discovery: TileDiscovery) -> None:
+    tile = discovery.tile
+    loop = asyncio.get_running_loop()
+    # Give the tile time to connect or initialize (done early if it publishes all its values)
+    if discovery.state == DiscoveryState.WAITING:
+      await self._wait(discovery, self.delay, lambda: _system_known(tile) and _audio_known(tile) and _light_known(tile))
+    if not tile.online:
+      discovery.state = DiscoveryState.OFFLINE
+      return
+    discovery.state = DiscoveryState.QUEUED
+    async with self._slots:
+      steps = [
+        # Step, values known, probe, command that undoes the probe (sent after the values are known, if needed)
+        (DiscoveryState.SYSTEM, _system_known, lambda: (CmdType.SYSTEM, tile.create_system_command(False, True)),
+          # Turn off the ping state of the tile (to show that it's connected)
+          lambda: (CmdType.SYSTEM, tile.create_system_command(False, False)) if tile.pinging else None),
+        (DiscoveryState.AUDIO, _audio_known, lambda: (CmdType.AUDIO, tile.create_audio_command(1, False, tile.sounds[0], 0)),
+          # Set audio mode to 4 (stop audio)
+          lambda: (CmdType.AUDIO, tile.create_audio_command(4))),
+        (DiscoveryState.LIGHT, _light_known, lambda: (CmdType.LIGHT, tile.create_light_command(brightness=255)),
+          # Set brightness back to 0 (to turn off the lights)
+          lambda: (CmdType.LIGHT, tile.create_light_command(brightness=0)))
+      ]
+      for state, known, probe, undo in steps:
+        discovery.state = state
+        attempt = 0
+        while not known(tile):
+          if not tile.online:
+            discovery.state = DiscoveryState.OFFLINE
+            return
+          if attempt >= self.attempts:
+            discovery.state = DiscoveryState.FAILED
+            self.failed += 1
+            logger.warning("Tile " + tile.device_name + " didn't answer the " + state.value + " probe, discovery failed")
+            return
+          self._send_command(tile, *probe())
+          discovery.probes += 1
+          self.probes += 1
+          # Wait for the answer, longer after every unanswered probe (with jitter, so retries of many tiles spread out)
+          timeout = min(self.timeout * 2 ** attempt, self.max_timeout) * random.uniform(0.8, 1.2)
+          if not await self._wait(discovery, timeout, lambda: known(tile) or not tile.online):
+            self.timeouts += 1
+          attempt += 1
+        # Only undo what was probed, a tile that published its values (e.g. retained) isn't touched
+        command = undo() if attempt > 0 or state == DiscoveryState.SYSTEM else None
+        if command is not None:
+          self._send_command(tile, *command)
+        logger.info("Got " + state.value + " values from tile " + tile.device_name)
+    discovery.state = DiscoveryState.DONE
+    discovery.finished = loop.time()
+    self.completed += 1
+
+  async def _wait(self, discovery: TileDiscovery, timeout: float, condition: Callable[[], bool]) -> bool:
+    """Waits till the condition is true (checked on every state update of the tile) or the timeout passed.
+
+    Returns true if the condition is true."""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not condition():
+      remaining = end - loop.time()
+      if remaining <= 0:
+        return False
+      discovery._event.clear()
+      try:
+        await asyncio.wait_for(discovery._event.wait(), remaining)
+      except asyncio.TimeoutError:
+        return condition()
+    return True
+
+def _system_known(tile: Tile) -> bool:
+  return tile.firmware_version != "" and tile.hardware_version != "" and tile.sounds != []
+
+def _audio_known(tile: Tile) -> bool:
+  return tile.audio_sound != ""
+
+def _light_known(tile: Tile) -> bool:
+  return len(tile.pixels) > 0
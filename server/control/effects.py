@@ -0,0 +1,205 @@
+import abc
+import math
+import numpy as np
+
+# --- Effects ---
+# Every effect renders the pixels of all its tiles at once, as a (tiles, pixels, 4) matrix of
+# r, g, b, w values between 0 and 1, with array math instead of loops over tiles and pixels.
+class Effect(abc.ABC):
+  """Base class of the effects."""
+  # Constructor
+  def __init__(self, amount_of_tiles: int, amount_of_pixels: int, args: dict):
+    self.amount_of_tiles: int = amount_of_tiles
+    self.amount_of_pixels: int = amount_of_pixels
+    self.args: dict = args
+    self.speed: float = float(args.get("speed", 1.0)) # Cycles per second
+    self.color: np.ndarray = _parse_color(args.get("color", {"r": 255, "g": 255, "b": 255, "w": 0}))
+    self.brightness: int | None = int(args["brightness"]) if "brightness" in args else None # None = keep the brightness of the tiles
+    if self.brightness is not None and (self.brightness < 0 or self.brightness > 255):
+      raise ValueError("Brightness must be in range(0, 256)")
+    # Position of every tile and pixel (broadcastable to the (tiles, pixels) shape)
+    self.tile_index: np.ndarray = np.arange(amount_of_tiles, dtype=np.float32)[:, None]
+    self.pixel_index: np.ndarray = np.arange(amount_of_pixels, dtype=np.float32)[None, :]
+    # Tiles are laid out (in order) on a square grid
+    columns = max(1, math.ceil(math.sqrt(amount_of_tiles)))
+    self.tile_x: np.ndarray = self.tile_index % columns
+    self.tile_y: np.ndarray = self.tile_index // columns
+
+  @abc.abstractmethod
+  def render(self, t: float) -> np.ndarray:
+    """Returns the pixels of all tiles at t seconds after the start of the effect."""
+
+  def _colorize(self, intensity: np.ndarray) -> np.ndarray:
+    """Returns the color of the effect, scaled by the (tiles, pixels) intensity."""
+    intensity = np.broadcast_to(intensity, (self.amount_of_tiles, self.amount_of_pixels))
+    return intensity[:, :, None] * self.color
+
+class RainbowEffect(Effect):
+  """Every pixel cycles through the hues, shifted along the pixels and the tiles."""
+  def render(self, t: float) -> np.ndarray:
+    hue = (self.pixel_index / self.amount_of_pixels + self.tile_index * 0.05 + t * self.speed) % 1.0
+    # Hue to rgb (full saturation and value)
+    frame = np.zeros((self.amount_of_tiles, self.amount_of_pixels, 4), dtype=np.float32)
+    for channel, shift in enumerate((0.0, 4.0, 2.0)):
+      frame[:, :, channel] = np.clip(np.abs((hue * 6.0 + shift) % 6.0 - 3.0) - 1.0, 0.0, 1.0)
+    return frame
+
+class ChaseEffect(Effect):
+  """A lit pixel with a fading tail runs around every tile, every next tile a bit later."""
+  def __init__(self, amount_of_tiles: int, amount_of_pixels: int, args: dict):
+    super().__init__(amount_of_tiles, amount_of_pixels, args)
+    self.tail: float = max(1.0, float(args.get("tail", 3))) # Length of the tail in pixels
+
+  def render(self, t: float) -> np.ndarray:
+    head = (t * self.speed * self.amount_of_pixels + self.tile_index) % self.amount_of_pixels
+    distance = (head - self.pixel_index) % self.amount_of_pixels
+    return self._colorize(np.clip(1.0 - distance / self.tail, 0.0, 1.0))
+
+class PulseEffect(Effect):
+  """All pixels breathe in and out (a wave moves along the tiles if spread is set)."""
+  def __init__(self, amount_of_tiles: int, amount_of_pixels: int, args: dict):
+    super().__init__(amount_of_tiles, amount_of_pixels, args)
+    self.spread: float = float(args.get("spread", 0.0)) # Phase difference between neighbouring tiles (in cycles)
+
+  def render(self, t: float) -> np.ndarray:
+    intensity = 0.5 - 0.5 * np.cos(2.0 * np.pi * (t * self.speed - self.tile_index * self.spread))
+    return self._colorize(intensity)
+
+class FadeEffect(Effect):
+  """All pixels fade from one color to the next (and back to the first)."""
+  def __init__(self, amount_of_tiles: int, amount_of_pixels: int, args: dict):
+    super().__init__(amount_of_tiles, amount_of_pixels, args)
+    colors = args.get("colors", [{"r": 255, "g": 0, "b": 0, "w": 0}, {"r": 0, "g": 0, "b": 255, "w": 0}])
+    if len(colors) == 0:
+      raise ValueError("Fade needs at least one color")
+    self.colors: np.ndarray = np.array([_parse_color(color) for color in colors], dtype=np.float32)
+
+  def render(self, t: float) -> np.ndarray:
+    position = (t * self.speed) % len(self.colors)
+    index = int(position)
+    amount = position - index
+    color = self.colors[index] * (1.0 - amount) + self.colors[(index + 1) % len(self.colors)] * amount
+    return np.broadcast_to(color, (self.amount_of_tiles, self.amount_of_pixels, 4)).copy()
+
+class RippleEffect(Effect):
+  """Rings of light move outwards from the center of the floor."""
+  def __init__(self, amount_of_tiles: int, amount_of_pixels: int, args: dict):
+    super().__init__(amount_of_tiles, amount_of_pixels, args)
+    self.wavelength: float = max(0.1, float(args.get("wavelength", 3.0))) # Distance between the rings (in tiles)
+    center_x = float(self.tile_x.max()) / 2
+    center_y = float(self.tile_y.max()) / 2
+    self.distance: np.ndarray = np.sqrt((self.tile_x - center_x) ** 2 + (self.tile_y - center_y) ** 2)
+
+  def render(self, t: float) -> np.ndarray:
+    wave = np.cos(2.0 * np.pi * (self.distance / self.wavelength - t * self.speed))
+    return self._colorize(np.clip(wave, 0.0, 1.0) ** 2)
+
+EFFECTS: dict[str, type[Effect]] = {
+  "rainbow": RainbowEffect,
+  "chase": ChaseEffect,
+  "pulse": PulseEffect,
+  "fade": FadeEffect,
+  "ripple": RippleEffect
+}
+
+def _parse_color(color: dict) -> np.ndarray:
+  """Converts a {"r", "g", "b", "w"} dictionary (0 - 255) to an array of r, g, b, w (0 - 1)."""
+  return np.array([int(color.get(key, 0)) for key in ("r", "g", "b", "w")], dtype=np.float32) / 255.0
+
+# --- Engine ---
+class RunningEffect:
+  """An effect that is running on a set of tiles."""
+  __slots__ = ("name", "tile_names", "effect", "rows", "started")
+
+  def __init__(self, name: str, tile_names: list[str], effect: Effect, started: float):
+    self.name: str = name
+    self.tile_names: list[str] = tile_names
+    self.effect: Effect = effect
+    self.rows: slice = None # Rows of the tiles in the fleet matrix
+    self.started: float = started # Time the effect started (in the time of render)
+
+class EffectsEngine:
+  """Renders the running effects into one fleet wide (tiles, pixels, 4) matrix of bytes.
+
+  Every tile runs at most one effect, starting an effect on a tile stops the effect
+  that was running on it. Only the tiles whose pixels changed since the previous frame are returned."""
+  # Constructor
+  def __init__(self, amount_of_pixels: int = 12):
+    self.amount_of_pixels: int = amount_of_pixels
+    self._effects: list[RunningEffect] = []
+    self._tile_names: list[str] = [] # Tile name of every row of the matrix
+    self._brightness: list[int | None] = [] # Brightness of every row of the matrix
+    self._matrix: np.ndarray = np.zeros((0, amount_of_pixels, 4), dtype=np.uint8)
+    self._previous: np.ndarray = self._matrix.copy()
+    self.frames: int = 0 # Amount of rendered frames
+
+  @property
+  def running(self) -> bool:
+    return len(self._effects) > 0
+
+  @property
+  def effects(self) -> list[RunningEffect]:
+    return self._effects
+
+  def start(self, name: str, tile_names: list[str], args: dict, now: float) -> None:
+    """Starts the effect on the given tiles (now is the time, in the time of render).
+
+    Raises a ValueError if the effect doesn't exist or the args are invalid."""
+    if name not in EFFECTS:
+      raise ValueError("Unknown effect: " + name)
+    tile_names = sorted(set(tile_names))
+    if len(tile_names) == 0:
+      return
+    effect = EFFECTS[name](len(tile_names), self.amount_of_pixels, args)
+    self.stop(tile_names)
+    self._effects.append(RunningEffect(name, tile_names, effect, now))
+    self._rebuild()
+
+  def stop(self, tile_names: list[str] = None) -> None:
+    """Stops the effects on the given tiles (None = all tiles)."""
+    if tile_names is None:
+      self._effects = []
+    else:
+      stopped = set(tile_names)
+      effects = []
+      for running in self._effects:
+        if stopped.isdisjoint(running.tile_names):
+          effects.append(running)
+          continue
+        # Keep the effect on the tiles that aren't stopped (rendered as a new effect on the remaining tiles)
+        remaining = [tile_name for tile_name in running.tile_names if tile_name not in stopped]
+        if len(remaining) > 0:
+          running.effect = type(running.effect)(len(remaining), self.amount_of_pixels, running.effect.args)
+          running.tile_names = remaining
+          effects.append(running)
+      self._effects = effects
+    self._rebuild()
+
+  def render(self, now: float) -> list[tuple[str, bytes, int | None]]:
+    """Renders the running effects at the given time.
+
+    Returns the name, pixel bytes (r, g, b, w per pixel) and brightness of every tile whose pixels changed."""
+    for running in self._effects:
+      frame = running.effect.render(now - running.started)
+      self._matrix[running.rows] = (np.clip(frame, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+    self.frames += 1
+    # Compare the whole fleet at once, only the changed tiles have to be sent
+    changed = np.flatnonzero(np.any(self._matrix != self._previous, axis=(1, 2)))
+    self._previous[changed] = self._matrix[changed]
+    return [(self._tile_names[row], self._matrix[row].tobytes(), self._brightness[row]) for row in changed]
+
+  def _rebuild(self) -> None:
+    """Assigns every tile of the running effects a row in the matrix (keeping the rendered pixels)."""
+    previous_rows = {tile_name: row for row, tile_name in enumerate(self._tile_names)}
+    self._tile_names = [tile_name for running in self._effects for tile_name in running.tile_names]
+    self._brightness = [running.effect.brightness for running in self._effects for _ in running.tile_names]
+    matrix = np.zeros((len(self._tile_names), self.amount_of_pixels, 4), dtype=np.uint8)
+    row = 0
+    for running in self._effects:
+      running.rows = slice(row, row + len(running.tile_names))
+      row += len(running.tile_names)
+    for row, tile_name in enumerate(self._tile_names):
+      if tile_name in previous_rows:
+        matrix[row] = self._previous[previous_rows[tile_name]]
+    self._matrix = matrix
+    self._previous = matrix.copy()
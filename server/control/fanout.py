@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+class MqttEvent:
+  """A MQTT message of which the topic has already been parsed."""
+  __slots__ = ("tile_name", "subtopic", "payload", "received")
+
+  def __init__(self, tile_name: str, subtopic: str, payload: str | bytes, received: float):
+    self.tile_name: str = tile_name # Name of the tile the message is about
+    self.subtopic: str = subtopic # Last part of the topic (self, system, audio, light, light_bin, presence, command, rgb, effect)
+    self.payload: str | bytes = payload # Decoded payload (bytes for binary light frames)
+    self.received: float = received # Time (time.monotonic()) the message was received
+
+class Dispatcher:
+  """Queues MQTT events for processing on the websocket event loop.
+
+  Events are put in a bounded queue that is drained by a task on the event loop,
+  so reading from the broker never waits on websocket I/O. When the queue is full,
+  new events are dropped (and counted) instead of blocking the MQTT client.
+  Events can be submitted from the event loop or (with submit_threadsafe) from another thread."""
+  # Constructor
+  def __init__(self, handler: Callable[[MqttEvent], Awaitable[None]], maxsize: int = 10000):
+    self._handler = handler # Coroutine that processes one event (on the event loop)
+    self._maxsize: int = maxsize
+    self._loop: asyncio.AbstractEventLoop = None
+    self._queue: asyncio.Queue = None
+    self._task: asyncio.Task = None
+    self.received: int = 0 # Amount of events handed over
+    self.dropped: int = 0 # Amount of events dropped because the queue was full
+    self.processed: int = 0 # Amount of events processed by the handler
+
+  @property
+  def queue_depth(self) -> int:
+    return self._queue.qsize() if self._queue is not None else 0
+
+  def start(self) -> None:
+    """Starts the dispatcher task on the running event loop."""
+    self._loop = asyncio.get_running_loop()
+    self._queue = asyncio.Queue(self._maxsize)
+    self._task = self._loop.create_task(self._run())
+
+  async def stop(self) -> None:
+    """Stops the dispatcher task."""
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+
+  def submit_threadsafe(self, event: MqttEvent) -> None:
+    """Hands an event over to the event loop. Safe to call from any thread."""
+    self._loop.call_soon_threadsafe(self.submit, event)
+
+  def submit(self, event: MqttEvent) -> None:
+    """Puts an event in the queue. Must be called from the event loop."""
+    self.received += 1
+    try:
+      self._queue.put_nowait(event)
+    except asyncio.QueueFull:
+      # Queue is full (event loop can't keep up), drop the event
+      self.dropped += 1
+      logger.warning("Dispatcher queue is full, dropped event for tile " + event.tile_name + " (" + event.subtopic + ")")
+
+  async def _run(self) -> None:
+    """Processes the events in the queue, one at a time and in order."""
+    while True:
+      event: MqttEvent = await self._queue.get()
+      try:
+        await self._handler(event)
+      except Exception as e:
+        # Never let one bad event stop the dispatcher
+        logger.error("Failed to process event for tile " + event.tile_name + ": " + str(e))
+      self.processed += 1
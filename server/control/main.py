@@ -1,14 +1,31 @@
 import os
+import hmac
 import json
 import time
+import struct
 import asyncio
 import logging
-import threading
 import paho.mqtt.client as mqtt
 from enum import Enum
-from pixel import Pixel
+from pixel import PixelBuffer
 from tile import StateType, CmdType
 from tile import Tile, CmdType, StateType
+from tile import create_system_command, create_audio_command, create_light_command
+from registry import TileRegistry
+from lightframe import FRAME_SUBTOPIC, FRAME_FEATURE, encode_light_frame, add_frame_trace
+from effects import EFFECTS, EffectsEngine
+from scheduler import FrameScheduler, LATENESS_BOUNDS
+from discovery import Discovery
+from snapshot import RegistrySnapshot
+from presence import PresenceStore
+from metrics import Metrics, serve_metrics
+from profiling import Profiler
+from tracing import CommandTracer, TRACE_FEATURE, add_trace_id
+from fanout import Dispatcher, MqttEvent
+from mqtt_async import AsyncMqttClient
+from broker import Broker
+from outbox import ClientOutbox, OutboxCounters
+from messages import TileListChange, encode, create_tile_state_message, create_tile_light_delta_message, create_tile_list_message
 from websockets.server import serve, WebSocketServerProtocol
 
 # --- Global constants ---
@@ -17,30 +34,80 @@ MQTT_PORT: int = int(os.getenv("MQTT_PORT"))
 MQTT_USER = os.getenv("MQTT_USERNAME")
 MQTT_PASS = os.getenv("MQTT_PASSWORD")
 ROOT_TOPIC = os.getenv("MQTT_ROOT_TOPIC")
+MQTT_EMBEDDED_BROKER: bool = os.getenv("MQTT_EMBEDDED_BROKER", "false").lower() == "true" # Run an MQTT broker in the controller on MQTT_SERVER:MQTT_PORT (tests and benchmarks without an external broker, see broker.py)
 LOGGING_LEVEL = logging.INFO
 WEBSOCKET_PORT: int = 3000
+WS_QUEUE_SIZE: int = int(os.getenv("WS_QUEUE_SIZE", "1000")) # Maximum amount of pending messages per websocket
+WS_MAX_RATE: float = float(os.getenv("WS_MAX_RATE", "0")) # Maximum amount of flushes of the send queue per second per websocket, a flush sends all pending messages (0 = no limit)
+GROUP_ALL: str = "all" # Group that every tile is in (tiles always subscribe to its topic)
+GROUP_FEATURE: str = "groups" # Feature a tile announces (in its system state) when it subscribes to group topics
+FRAME_FPS: float = float(os.getenv("FRAME_FPS", "30")) # Frames per second of the effects and streamed light commands
+DISCOVERY_CONCURRENCY: int = int(os.getenv("DISCOVERY_CONCURRENCY", "50")) # Maximum amount of new tiles that are probed for their values at the same time
+DISCOVERY_DELAY: float = float(os.getenv("DISCOVERY_DELAY", "5")) # Seconds to give a new tile to publish its state before it is probed
+DISCOVERY_TIMEOUT: float = float(os.getenv("DISCOVERY_TIMEOUT", "2")) # Seconds to wait for the answer on a probe (doubles every retry)
+DISCOVERY_ATTEMPTS: int = int(os.getenv("DISCOVERY_ATTEMPTS", "5")) # Probes per value before the discovery of a tile fails
+SNAPSHOT_FILE: str = os.getenv("SNAPSHOT_FILE", "snapshot.db") # Database the tiles and groups are saved to, for a warm restart ("" = don't save)
+SNAPSHOT_INTERVAL: float = float(os.getenv("SNAPSHOT_INTERVAL", "10")) # Seconds between saving the changes
+PRESENCE_DIR: str = os.getenv("PRESENCE_DIR", "presence") # Directory the presence history is written to ("" = don't keep history)
+PRESENCE_FLUSH_INTERVAL: float = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "300")) # Seconds between writing the rollups of today to disk
+METRICS_HOST: str = os.getenv("METRICS_HOST", "127.0.0.1") # Host the metrics endpoint listens on (local only by default)
+METRICS_PORT: int = int(os.getenv("METRICS_PORT", "9464")) # Port of the metrics endpoint, http://METRICS_HOST:METRICS_PORT/metrics (0 = no endpoint)
+ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "") # Token websockets need to send with admin actions, e.g. profile ("" = admin actions disabled)
+PROFILE_DIR: str = os.getenv("PROFILE_DIR", "profiles") # Directory profile files are written to
+TRACE_TIMEOUT: float = float(os.getenv("TRACE_TIMEOUT", "10")) # Seconds to wait for the tiles to echo a traced command
+PRESENCE_MINUTE_RETENTION: int = int(os.getenv("PRESENCE_MINUTE_RETENTION", "31")) # Days the per minute history is kept (the per hour history is kept forever)
 
 # --- Global variables ---
-tiles: list[Tile] = [] # List of tiles
-channel_tiles: list[WebSocketServerProtocol] = [] # List of websockets that are subscribed to changes in the tile list
-channel_states: dict[str, list[WebSocketServerProtocol]] = {} # List of websockets that are subscribed to changes in the state of a specific tile
-mqtt_client: mqtt.Client = None # The mqtt client
+registry: TileRegistry = TileRegistry() # Known tiles and the websockets that are subscribed to them
+outboxes: dict[WebSocketServerProtocol, ClientOutbox] = {} # Send queue of every connected websocket
+outbox_totals: OutboxCounters = OutboxCounters() # Counters of all send queues together
+mqtt_client: AsyncMqttClient = None # The mqtt client
+broker: Broker = None # The embedded MQTT broker (None = an external broker is used)
+dispatcher: Dispatcher = None # Queues MQTT messages for processing on the event loop
+discovery: Discovery = None # Gets the values from new tiles
+snapshot: RegistrySnapshot = None # Saves the tiles and groups to disk (None = disabled)
+presence_store: PresenceStore = None # History of the presence of the tiles (None = disabled)
+profiler: Profiler = Profiler(PROFILE_DIR) # Profiles the running controller on request of an admin
+effects: EffectsEngine = EffectsEngine() # Renders the running effects of all tiles
+pending_light_commands: dict = {} # Tiles (or group) -> light command that is sent on the next frame
+light_commands_coalesced: int = 0 # Light commands replaced by a newer command before they were sent
 
-# --- Global Enums ---
-class TileListChange(Enum):
-  LIST = "list"
-  ADD = "add"
-  REMOVE = "remove"
+# --- Metrics ---
+# Subtopics that are counted on their own (others are counted as "other", so a bad client can't create endless labels)
+METRIC_SUBTOPICS: set[str] = {"self", "system", "audio", "light", FRAME_SUBTOPIC, "presence", "command", "rgb", "effect"}
+metrics: Metrics = Metrics("mlt_") # Served on the metrics endpoint and in the websocket stats
+metric_mqtt_messages = metrics.counter("mqtt_messages_total", "MQTT messages received, per subtopic", ("subtopic",))
+metric_mqtt_on_message = metrics.histogram("mqtt_on_message_seconds", "Time to parse and queue a received MQTT message").labels()
+metric_mqtt_queue_delay = metrics.histogram("mqtt_queue_delay_seconds", "Time a received MQTT message waited in the dispatcher queue").labels()
+metric_update_state = metrics.histogram("update_state_seconds", "Time to parse and apply a state update of a tile, per state type", ("type",))
+metric_ws_broadcast_tile_state = metrics.histogram("ws_broadcast_tile_state_seconds", "Time to encode and queue a changed state for all subscribed websockets").labels()
+metric_ws_send_tile_state = metrics.histogram("ws_send_tile_state_seconds", "Time to encode and queue the state of a tile for one websocket").labels()
+metric_ws_command = metrics.histogram("ws_command_seconds", "Time to handle a command of a websocket, per command type", ("type",))
+metric_mqtt_send_command = metrics.histogram("mqtt_send_command_seconds", "Time to publish a command, per command type and target (tile or group)", ("type", "target"))
+metrics.counter("mqtt_dropped_total", "MQTT messages dropped because the dispatcher queue was full", function=lambda: dispatcher.dropped)
+metrics.gauge("mqtt_queue_depth", "MQTT messages waiting in the dispatcher queue", function=lambda: dispatcher.queue_depth)
+metrics.gauge("ws_clients", "Connected websockets", function=lambda: len(outboxes))
+metrics.gauge("ws_pending", "Messages waiting in the send queues of all websockets", function=lambda: sum(outbox.pending for outbox in outboxes.values()))
+metrics.counter("ws_sent_total", "Messages sent to websockets", function=lambda: outbox_totals.sent)
+metrics.counter("ws_dropped_total", "Messages dropped because the send queue of a websocket was full", function=lambda: outbox_totals.dropped)
+metrics.gauge("tiles", "Known tiles", function=lambda: len(registry))
+metrics.gauge("tiles_online", "Online tiles", function=lambda: sum(1 for tile in registry if tile.online))
+metric_command_stage = metrics.histogram("command_stage_seconds", "Time of every stage of traced commands (websocket to tile and back), per command type and stage", ("type", "stage"))
+tracer: CommandTracer = CommandTracer(TRACE_TIMEOUT, stage_metric=metric_command_stage) # Traces commands from the websockets to the tiles and back
+metric_frame_lateness = metrics.histogram("frame_lateness_seconds", "Time the frames were ticked after their deadline", bounds=LATENESS_BOUNDS).labels()
+scheduler: FrameScheduler = FrameScheduler(FRAME_FPS, lateness=metric_frame_lateness) # Ticks the frames of the effects and light commands
+metrics.gauge("frame_target_fps", "Frames per second the frame scheduler aims for", function=lambda: scheduler.fps)
+metrics.gauge("frame_achieved_fps", "Frames per second the frame scheduler ticked over the last seconds", function=lambda: scheduler.achieved_fps())
+metrics.counter("frame_ticks_total", "Frames ticked by the frame scheduler", function=lambda: scheduler.ticks)
+metrics.counter("frame_skipped_total", "Frames skipped because the frame scheduler was more than a frame behind", function=lambda: scheduler.skipped)
+metrics.counter("effects_frames_total", "Frames rendered by the effects engine", function=lambda: effects.frames)
+metrics.gauge("light_commands_pending", "Light commands waiting for the next frame", function=lambda: len(pending_light_commands))
+metrics.counter("light_commands_coalesced_total", "Light commands replaced by a newer command before they were sent", function=lambda: light_commands_coalesced)
 
 # --- Global functions ---
 def get_existing_tile(tile_name: str) -> Tile:
   """Returns the tile with the given name, or None if it doesn't exist."""
-  # Check if tile with name exists
-  for tile in tiles:
-    if tile.device_name == tile_name:
-      return tile
-  # Tile doesn't exist yet, return None
-  return None
+  return registry.get(tile_name)
 
 # --- Configure logging ---
 logging.basicConfig(level=LOGGING_LEVEL)
@@ -52,27 +119,20 @@ mqtt_client_set_event = asyncio.Event()
 
 # --- MQTT ---
 async def mqtt_controller(HOST: str, PORT: int, USER: str = None, PASS: str = None) -> None:
-  # Configure MQTT client
-  client = mqtt.Client(client_id="CONTROLLER", clean_session=True)
-  client = mqtt.Client(client_id="CONTROLLER", clean_session=True)
+  # Configure MQTT client (runs on the event loop, no background thread)
+  client = AsyncMqttClient(client_id="CONTROLLER", clean_session=True, keepalive=60)
   client.on_connect = mqtt_on_connect
   client.on_message = mqtt_on_message
   if USER != None and PASS != None:
     client.username_pw_set(USER, PASS)
 
-  # Connect to MQTT server
-  client.connect(HOST, PORT, 60)
-
-  # Start the MQTT client loop
-  client.loop_start()
-
   # Set global mqtt_client variable
   global mqtt_client
   mqtt_client = client
   mqtt_client_set_event.set()
 
-  # Wait for the mqtt client to finish
-  await asyncio.Future()  # run forever
+  # Connect to MQTT server and keep the connection alive (run forever)
+  await client.run(HOST, PORT)
 
 def mqtt_on_connect(client: mqtt.Client, userdata, flags, rc: mqtt.ReasonCodes) -> None:
   """The callback for when the client receives a CONNACK response from the server."""
@@ -85,12 +145,21 @@ def mqtt_on_connect(client: mqtt.Client, userdata, flags, rc: mqtt.ReasonCodes)
   # Subscribe to all the tiles (self topic)
   logging.info("Subscribing to all available tiles")
   client.subscribe(ROOT_TOPIC+"/+/self")
+  # Subscribe to the state subtopics of all tiles (the retained states of all tiles come in at once, to bootstrap the tiles)
+  client.subscribe(ROOT_TOPIC+"/+/self/state/+")
+  # Subscribe to the project master's command subtopics of every tile (and of all tiles, GROUP_ALL)
+  # (one wildcard instead of a subscription per tile, every subscription makes the broker match its retained messages)
+  client.subscribe(ROOT_TOPIC+"/+/command")
+  client.subscribe(ROOT_TOPIC+"/+/rgb")
+  client.subscribe(ROOT_TOPIC+"/+/effect")
 
 def mqtt_on_message(client: mqtt.Client, userdata, msg: mqtt.MQTTMessage) -> None:
-  """The callback for when a PUBLISH message is received from the server."""
-  #convert topic and payload to string
+  """The callback for when a PUBLISH message is received from the server.
+
+  Only parses the topic and queues the message, so reading from the broker never waits on websocket I/O."""
+  received = time.monotonic()
+  #convert topic to string
   topic = msg.topic
-  payload = msg.payload.decode("utf-8")
 
   # Remove root topic from topic
   topic = topic.replace(ROOT_TOPIC+"/", "")
@@ -98,62 +167,166 @@ def mqtt_on_message(client: mqtt.Client, userdata, msg: mqtt.MQTTMessage) -> Non
   # Split the topic into parts (for easier processing)
   topic_parts = topic.split("/")
 
-  # Check if tile with name exists
-  tile_name = topic_parts[0]
-  tile = get_tile(client, tile_name)
+  # Convert payload to string (light frames are binary, keep the bytes)
+  if topic_parts[-1] == FRAME_SUBTOPIC:
+    payload = msg.payload
+  else:
+    payload = msg.payload.decode("utf-8")
+
+  # Queue the message for the dispatcher
+  dispatcher.submit(MqttEvent(topic_parts[0], topic_parts[-1], payload, received))
+
+  # Count the message
+  metric_mqtt_messages.labels(topic_parts[-1] if topic_parts[-1] in METRIC_SUBTOPICS else "other").inc()
+  metric_mqtt_on_message.observe(time.monotonic() - received)
+
+async def mqtt_process_event(event: MqttEvent) -> None:
+  """Processes a MQTT message on the event loop (called by the dispatcher)."""
+  metric_mqtt_queue_delay.observe(time.monotonic() - event.received)
+  payload = event.payload
 
   # Set project master command type (if it's a pm command)
   pm_command_type = None
-  if topic_parts[-1] == "command":
+  if event.subtopic == "command":
     pm_command_type = PMCmdType.COMMAND
-  elif topic_parts[-1] == "rgb":
+  elif event.subtopic == "rgb":
     pm_command_type = PMCmdType.RGB
-  elif topic_parts[-1] == "effect":
+  elif event.subtopic == "effect":
     pm_command_type = PMCmdType.EFFECT
   
-  # Process project master command (if pm_command_type has been set)
+  # Process project master command for all tiles (this is not a tile)
+  if event.tile_name == GROUP_ALL:
+    if pm_command_type != None:
+      process_pm_group_command(pm_command_type, registry.tiles, GROUP_ALL, payload)
+    return
+
+  # Process project master command (if pm_command_type has been set), only for known tiles
   if pm_command_type != None:
-    process_pm_command(pm_command_type, tile, payload)
+    tile = get_existing_tile(event.tile_name)
+    if tile != None:
+      process_pm_command(pm_command_type, tile, payload)
     return
+
+  # Check if tile with name exists
+  tile = await get_tile(mqtt_client, event.tile_name)
   
   # Set state type (if it's a state update)
   state_type = None
-  if topic_parts[-1] == "self":
+  if event.subtopic == "self":
     state_type = StateType.ONLINE
-  elif topic_parts[-1] == "system":
+  elif event.subtopic == "system":
     state_type = StateType.SYSTEM
-  elif topic_parts[-1] == "audio":
+  elif event.subtopic == "audio":
     state_type = StateType.AUDIO
-  elif topic_parts[-1] == "light":
+  elif event.subtopic == "light" or event.subtopic == FRAME_SUBTOPIC:
     state_type = StateType.LIGHT
-  elif topic_parts[-1] == "presence":
+  elif event.subtopic == "presence":
     state_type = StateType.PRESENCE
 
   # Process state update (if state_type has been set)
   if state_type != None:
     # Pass the message to the tile
+    version = tile.version(state_type)
+    started = time.perf_counter()
     tile.update_state(state_type, payload)
-    # Send state update to all ws clients
-    loop = get_event_loop()
-    for ws in channel_states[tile.device_name]:
-      loop.run_until_complete(ws_send_tile_state(ws, tile, state_type))
+    metric_update_state.labels(state_type.value).observe(time.perf_counter() - started)
+    # Command the state is the answer to (if the tile echoed one)
+    trace = tile.take_trace()
+    # Let the discovery of the tile know (it waits for the state instead of polling)
+    discovery.notify(tile, state_type)
+    # Send state update to all ws clients (if the state changed)
+    if tile.version(state_type) != version:
+      started = time.perf_counter()
+      ws_broadcast_tile_state(tile, state_type)
+      metric_ws_broadcast_tile_state.observe(time.perf_counter() - started)
+      presence_record(tile, state_type)
+    # The state of a traced command is fanned out, the command is done
+    if trace is not None:
+      tracer.complete(tile.device_name, trace[0], trace[1], event.received, time.monotonic())
+    # Every system state counts as a heartbeat of the tile
+    if state_type == StateType.SYSTEM and presence_store is not None:
+      presence_store.record_heartbeat(tile.device_name, time.time())
 
-def mqtt_send_command(client: mqtt.Client, tile: Tile, type: CmdType, command: str) -> None:
-  """Sends a command to the tile."""
+def presence_record(tile: Tile, state_type: StateType) -> None:
+  """Records a changed presence (or online) state of the tile in the presence history."""
+  if presence_store is None:
+    return
+  if state_type == StateType.PRESENCE and tile.online:
+    presence_store.record_presence(tile.device_name, tile.detected, time.time())
+  elif state_type == StateType.ONLINE and tile.detected:
+    # Presence of an offline tile isn't known, it ends when the tile goes offline (and starts again when it comes back)
+    presence_store.record_presence(tile.device_name, tile.online, time.time())
+
+def mqtt_send_command(client: AsyncMqttClient, tile: Tile, type: CmdType, command: str, frame: bytes = None, trace_id: int = None) -> None:
+  """Sends a command to the tile (the light frame instead of the JSON light command if the tile supports it).
+
+  With a trace id, the id is sent along (if the tile supports tracing) for the tile to echo."""
   # Prevent sending commands to offline tiles
   if tile.online == False:
     logging.warning("Tile " + tile.device_name + " is offline, can't send command")
     return
+  if trace_id is not None and tile.supports(TRACE_FEATURE):
+    command = add_trace_id(command, trace_id) if command is not None else None
+    frame = add_frame_trace(frame, trace_id) if frame is not None else None
 
   # Send command to tile
+  started = time.perf_counter()
   if type == CmdType.SYSTEM:
     client.publish(ROOT_TOPIC+"/"+tile.device_name+"/self/command/system", command)
   elif type == CmdType.AUDIO:
     client.publish(ROOT_TOPIC+"/"+tile.device_name+"/self/command/audio", command)
   elif type == CmdType.LIGHT:
-    client.publish(ROOT_TOPIC+"/"+tile.device_name+"/self/command/light", command)
+    if frame is not None and tile.supports(FRAME_FEATURE):
+      client.publish(ROOT_TOPIC+"/"+tile.device_name+"/self/command/"+FRAME_SUBTOPIC, frame)
+    else:
+      client.publish(ROOT_TOPIC+"/"+tile.device_name+"/self/command/light", command)
+  metric_mqtt_send_command.labels(type.value, "tile").observe(time.perf_counter() - started)
+  if trace_id is not None:
+    tracer.published(trace_id, time.monotonic())
+
+def mqtt_send_light_command(client: AsyncMqttClient, tile: Tile, brightness: int | None, pixels: PixelBuffer) -> None:
+  """Sends a light command to the tile (brightness None = keep current), only encoded in the format the tile uses."""
+  if tile.supports(FRAME_FEATURE):
+    mqtt_send_command(client, tile, CmdType.LIGHT, None, encode_light_frame(brightness, pixels))
+  else:
+    mqtt_send_command(client, tile, CmdType.LIGHT, tile.create_light_command(brightness, pixels))
+
+def mqtt_send_group_command(client: AsyncMqttClient, group_id: str, type: CmdType, command: str, frame: bytes = None, trace_id: int = None) -> None:
+  """Sends a command to all tiles in the group, with one publish (the light frame instead of the JSON light command if given).
+
+  With a trace id, the id is sent along (tiles that don't support tracing ignore it)."""
+  started = time.perf_counter()
+  if trace_id is not None:
+    command = add_trace_id(command, trace_id)
+    frame = add_frame_trace(frame, trace_id) if frame is not None else None
+  if frame is not None and type == CmdType.LIGHT:
+    client.publish(ROOT_TOPIC+"/group/"+group_id+"/command/"+FRAME_SUBTOPIC, frame)
+  else:
+    client.publish(ROOT_TOPIC+"/group/"+group_id+"/command/"+type.value, command)
+  metric_mqtt_send_command.labels(type.value, "group").observe(time.perf_counter() - started)
+  if trace_id is not None:
+    tracer.published(trace_id, time.monotonic())
+
+def mqtt_send_command_to_tiles(client: AsyncMqttClient, tiles: list[Tile], type: CmdType, command: str, group_id: str = None, frame: bytes = None, trace_id: int = None) -> None:
+  """Sends the same command to the given tiles.
+
+  If the tiles are a group, the command is published once on the group topic, only tiles
+  that don't support group topics (older firmware) get the command on their own topic."""
+  if group_id is not None:
+    group_tiles = [tile for tile in tiles if tile.supports(GROUP_FEATURE)]
+    if len(group_tiles) > 0:
+      # Only publish the light frame if every tile in the group understands it
+      mqtt_send_group_command(client, group_id, type, command, frame if all(tile.supports(FRAME_FEATURE) for tile in group_tiles) else None, trace_id)
+    tiles = [tile for tile in tiles if not tile.supports(GROUP_FEATURE)]
+  for tile in tiles:
+    mqtt_send_command(client, tile, type, command, frame, trace_id)
+
+def mqtt_send_groups(client: AsyncMqttClient, tile_name: str) -> None:
+  """Sends the groups of the tile to the tile (retained, so the tile gets them every time it connects)."""
+  groups = sorted(registry.tile_groups(tile_name))
+  client.publish(ROOT_TOPIC+"/"+tile_name+"/self/command/groups", json.dumps({"groups": groups}), 1, retain=True)
 
-def get_tile(client: mqtt.Client, tile_name: str) -> Tile:
+async def get_tile(client: AsyncMqttClient, tile_name: str) -> Tile:
   """Returns the tile with the given name, or creates a new one if it doesn't exist."""
   # Check if tile with name exists
   tile = get_existing_tile(tile_name)
@@ -162,75 +335,25 @@ def get_tile(client: mqtt.Client, tile_name: str) -> Tile:
     return tile
   else:
     # Tile doesn't exist yet, create new one
-    return create_new_tile(client, tile_name)
+    return await create_new_tile(client, tile_name)
 
-def create_new_tile(client: mqtt.Client, tile_name: str) -> Tile:
+async def create_new_tile(client: AsyncMqttClient, tile_name: str) -> Tile:
   """Creates a new tile with the given name."""
   # Create new tile
+  # (this also creates an empty state channel for the tile, to put the subscribed websockets in)
   tile = Tile(tile_name)
-  tiles.append(tile)
-  # Subscribe to the tile's state subtopics
-  client.subscribe(ROOT_TOPIC+"/"+tile_name+"/self/state/+")
-  # Subscribe to the project master's command subtopics
-  client.subscribe(ROOT_TOPIC+"/"+tile_name+"/command")
-  client.subscribe(ROOT_TOPIC+"/"+tile_name+"/rgb")
-  client.subscribe(ROOT_TOPIC+"/"+tile_name+"/effect")
-  # Get values from new tile (after 5 seconds, to give the tile time to connect or initialize)
+  registry.add(tile)
+  # Get values from new tile (after DISCOVERY_DELAY seconds, to give the tile time to connect or initialize)
   # This is done so that the controller has accurate values for the tile, even if it was already online before the controller started.
-  threading.Timer(5.0, get_values_from_new_tile, [client, tile]).start()
-  # Add tile to the channel_states dict with an empty list (to put the subscribed websockets in)
-  channel_states[tile_name] = []
+  discovery.start(tile)
   # Send tile list changes to all ws clients
-  loop = get_event_loop()
-  for ws in channel_tiles:
-    # Run the task in the event loop
-    loop.run_until_complete(ws_send_tile_list_changes(ws, [tile], TileListChange.ADD))
+  ws_broadcast_tile_list_changes([tile], TileListChange.ADD)
   # Return the new tile
   return tile
 
-def get_event_loop() -> asyncio.AbstractEventLoop:
-  """Returns the event loop for the current thread."""
-  try:
-    loop = asyncio.get_event_loop()
-  except RuntimeError:
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-  return loop
-
-def get_values_from_new_tile(client: mqtt.Client, tile: Tile) -> None:
-  """Sends commands to the tile to get the current values.
-
-  Used to get missing values if a tile was already online before the controller started."""
-  if tile.online == False:
-    # Tile is offline, do nothing
-    return
-  # Get system values
-  while tile.firmware_version == "" or tile.hardware_version == "" or tile.sounds == []:
-    # Send command to tile to get system state
-    mqtt_send_command(mqtt_client, tile, CmdType.SYSTEM, tile.create_system_command(False, True))
-    # Wait for 2 second (because ping is every second)
-    time.sleep(2)
-  # Turn off the ping state of the tile (to show that it's connected)
-  mqtt_send_command(mqtt_client, tile, CmdType.SYSTEM, tile.create_system_command(False, False))
-  logging.info("Got system values from tile " + tile.device_name)
-  # Get audio values
-  while tile.audio_sound == "":
-    # Send command to tile to get audio state
-    mqtt_send_command(mqtt_client, tile, CmdType.AUDIO, tile.create_audio_command(1, False, tile.sounds[0], 0))
-    # Wait for 1 second
-    time.sleep(1)
-  # Set audio mode to 4 (stop audio)
-  mqtt_send_command(mqtt_client, tile, CmdType.AUDIO, tile.create_audio_command(4))
-  logging.info("Got audio values from tile " + tile.device_name)
-  # Get light values
-  while tile.pixels == []:
-    # Send command to tile to get light state
-    mqtt_send_command(mqtt_client, tile, CmdType.LIGHT, tile.create_light_command(brightness=255))
-    # Wait for 1 second
-    time.sleep(1)
-  # Set brightness back to 0 (to turn off the lights)
-  mqtt_send_command(mqtt_client, tile, CmdType.LIGHT, tile.create_light_command(brightness=0))
-  logging.info("Got light values from tile " + tile.device_name)
+def discovery_send_command(tile: Tile, type: CmdType, command: str) -> None:
+  """Sends a probe command of the discovery to the tile."""
+  mqtt_send_command(mqtt_client, tile, type, command)
 
 # --- Websocket ---
 async def ws_server(HOST: str = "0.0.0.0", PORT: int = WEBSOCKET_PORT) -> None:
@@ -244,7 +367,11 @@ async def ws_handler(websocket: WebSocketServerProtocol, path: str):
   try:
     # If new websocket connects, send welcome message
     logging.info("Websocket: " + str(websocket) + " connected")
-    await websocket.send(json.dumps({"action": "welcome"}, indent=4))
+    await websocket.send(encode({"action": "welcome"}))
+    # Create the send queue of the websocket
+    outbox = ClientOutbox(websocket, WS_QUEUE_SIZE, WS_MAX_RATE, outbox_totals)
+    outboxes[websocket] = outbox
+    outbox.start()
     # Handle incoming messages
     async for message in websocket:
       # Convert message to JSON
@@ -260,6 +387,20 @@ async def ws_handler(websocket: WebSocketServerProtocol, path: str):
         await ws_unsubscribe(websocket, message_json)
       elif action == "command":
         await ws_command(websocket, message_json)
+      elif action == "group":
+        ws_group(websocket, message_json)
+      elif action == "effect":
+        ws_effect(websocket, message_json)
+      elif action == "config":
+        ws_config(websocket, message_json)
+      elif action == "stats":
+        ws_stats(websocket)
+      elif action == "query":
+        await ws_query(websocket, message_json)
+      elif action == "profile":
+        ws_profile(websocket, message_json)
+      elif action == "latency":
+        ws_latency(websocket, message_json)
       else:
         # Unknown action, do nothing
         logging.warning("Unknown action: " + action)
@@ -269,11 +410,10 @@ async def ws_handler(websocket: WebSocketServerProtocol, path: str):
   finally:
     # Client disconnected, remove websocket from all channels
     logging.info("Websocket: " + str(websocket) + " disconnected")
-    if websocket in channel_tiles:
-      channel_tiles.remove(websocket)
-    for tile_name in channel_states:
-      if websocket in channel_states[tile_name]:
-        channel_states[tile_name].remove(websocket)
+    registry.remove_client(websocket)
+    outbox = outboxes.pop(websocket, None)
+    if outbox is not None:
+      await outbox.close()
 
 async def ws_subscribe(websocket: WebSocketServerProtocol, message_json: dict) -> None:
   """Subscribes the websocket to the given channels."""
@@ -281,11 +421,11 @@ async def ws_subscribe(websocket: WebSocketServerProtocol, message_json: dict) -
 
   if type == "tiles":
     # Check if websocket is not already in list
-    if websocket not in channel_tiles:
+    if websocket not in registry.tile_list_subscribers:
       # Send full list of tiles to client
-      await ws_send_tile_list_changes(websocket, tiles, TileListChange.LIST)
+      ws_send_tile_list_changes(websocket, registry.tiles, TileListChange.LIST)
       # Add websocket to 'tiles' channel
-      channel_tiles.append(websocket)
+      registry.subscribe_tile_list(websocket)
       logging.info("Websocket: " + str(websocket) + " subscribed to tile list")
     else:
       # Websocket is already in list, do nothing
@@ -293,6 +433,8 @@ async def ws_subscribe(websocket: WebSocketServerProtocol, message_json: dict) -
 
   elif type == "state":
     subscribe_tiles = list(map(str, message_json["tiles"]))
+    # Light deltas (only the changed pixels) instead of the full light state (optional)
+    delta = bool(message_json.get("delta", False))
     # Create formatted list of tiles (json)
     for tile_name in subscribe_tiles:
       # get tile from list
@@ -302,11 +444,11 @@ async def ws_subscribe(websocket: WebSocketServerProtocol, message_json: dict) -
         logging.warning("Websocket: " + str(websocket) + " tried to subscribe to state of tile " + tile_name + ", but it doesn't exist")
         continue
       # Check if websocket is not already in list
-      if websocket not in channel_states[tile_name]:
+      if not registry.is_subscribed_to_state(websocket, tile_name):
         # Send full state of tile to client
-        await ws_send_tile_state(websocket, tile, StateType.FULL)
+        ws_send_tile_state(websocket, tile, StateType.FULL)
         # Add websocket to tile_name's state channel
-        channel_states[tile_name].append(websocket)
+        registry.subscribe_state(websocket, tile_name, delta)
         logging.info("Websocket: " + str(websocket) + " subscribed to state of tile " + tile_name)
       else:
         # Websocket is already in list, do nothing
@@ -318,9 +460,8 @@ async def ws_unsubscribe(websocket: WebSocketServerProtocol, message_json: dict)
 
   if type == "tiles":
     # Check if websocket is in list
-    if websocket in channel_tiles:
-      # remove websocket from 'tiles' channel
-      channel_tiles.remove(websocket)
+    if registry.unsubscribe_tile_list(websocket):
+      # Websocket was removed from 'tiles' channel
       logging.info("Websocket: " + str(websocket) + " unsubscribed from tile list")
     else:
       # Websocket is not in list, do nothing
@@ -329,105 +470,322 @@ async def ws_unsubscribe(websocket: WebSocketServerProtocol, message_json: dict)
   elif type == "state":
     unsubscribe_tiles = list(map(str, message_json["tiles"]))
     for tile_name in unsubscribe_tiles:
-      try:
-        # Check if websocket is in list
-        if websocket in channel_states[tile_name]:
-          # remove websocket from tile_name's state channel
-          channel_states[tile_name].remove(websocket)
-          logging.info("Websocket: " + str(websocket) + " unsubscribed from state of tile " + tile_name)
-        else:
-          # Websocket is not in list, do nothing
-          logging.warning("Websocket: " + str(websocket) + " tried to unsubscribe from state of tile " + tile_name + ", but it wasn't subscribed")
-      except:
+      if tile_name not in registry:
         # Tile doesn't exist, do nothing
         logging.warning("Websocket: " + str(websocket) + " tried to unsubscribe from state of tile " + tile_name + ", but it doesn't exist")
         continue
+      # Remove websocket from tile_name's state channel
+      if registry.unsubscribe_state(websocket, tile_name):
+        logging.info("Websocket: " + str(websocket) + " unsubscribed from state of tile " + tile_name)
+      else:
+        # Websocket is not in list, do nothing
+        logging.warning("Websocket: " + str(websocket) + " tried to unsubscribe from state of tile " + tile_name + ", but it wasn't subscribed")
 
 async def ws_command(websocket: WebSocketServerProtocol, message_json: dict) -> None:
-  """Sends the given command to the given tiles."""
+  """Sends the given command to the given tiles (or to the given group of tiles)."""
+  received = time.monotonic()
+  started = time.perf_counter()
   type = str(message_json["type"])
-  tiles_to_command = list(map(str, message_json["tiles"]))
   args = dict(message_json["args"])
+  # Get the tiles to command (from the group if one is given)
+  tiles_to_command, group_id = get_tiles_to_command(message_json)
+
+  # Get tiles from list
+  tiles: list[Tile] = []
+  for tile_name in tiles_to_command:
+    tile = get_existing_tile(tile_name)
+    if tile is None:
+      # Tile doesn't exist, do nothing
+      logging.warning("Websocket: " + str(websocket) + " tried to send " + type + " command to tile " + tile_name + ", but it doesn't exist")
+      continue
+    tiles.append(tile)
 
   match type:
     case CmdType.SYSTEM.value:
       reboot = bool(args["reboot"])
       ping = bool(args["ping"])
-
-      for tile_name in tiles_to_command:
-        # get tile from list
-        tile = get_existing_tile(tile_name)
-        if tile is None:
-          # Tile doesn't exist, do nothing
-          logging.warning("Websocket: " + str(websocket) + " tried to send system command to tile " + tile_name + ", but it doesn't exist")
-          continue
-        # Send command to tile
-        mqtt_send_command(mqtt_client, tile, CmdType.SYSTEM, tile.create_system_command(reboot, ping))
+      # Send command to tiles
+      trace_id = trace_command(CmdType.SYSTEM, tiles, received)
+      mqtt_send_command_to_tiles(mqtt_client, tiles, CmdType.SYSTEM, create_system_command(reboot, ping), group_id, trace_id=trace_id)
 
     case CmdType.AUDIO.value:
       mode = int(args["mode"])
       loop = bool(args["loop"])
       sound = str(args["sound"])
       volume = int(args["volume"])
-
-      for tile_name in tiles_to_command:
-        # get tile from list
-        tile = get_existing_tile(tile_name)
-        if tile is None:
-          # Tile doesn't exist, do nothing
-          logging.warning("Websocket: " + str(websocket) + " tried to send audio command to tile " + tile_name + ", but it doesn't exist")
-          continue
-        # Send command to tile
-        mqtt_send_command(mqtt_client, tile, CmdType.AUDIO, tile.create_audio_command(mode, loop, sound, volume))
+      # Send command to tiles
+      trace_id = trace_command(CmdType.AUDIO, tiles, received)
+      mqtt_send_command_to_tiles(mqtt_client, tiles, CmdType.AUDIO, create_audio_command(mode, loop, sound, volume), group_id, trace_id=trace_id)
 
     case CmdType.LIGHT.value:
-      brightness = int(args["brightness"])
-      # Create list of pixels
-      pixels = [Pixel() for pixel in args["pixels"]]
-      # Add values to pixels
-      for i in range(len(pixels)):
-        pixels[i].from_dict(args["pixels"][i])
-      
-      for tile_name in tiles_to_command:
-        # get tile from list
-        tile = get_existing_tile(tile_name)
-        if tile is None:
-          # Tile doesn't exist, do nothing
-          logging.warning("Websocket: " + str(websocket) + " tried to send light command to tile " + tile_name + ", but it doesn't exist")
-          continue
-        # Send command to tile
-        mqtt_send_command(mqtt_client, tile, CmdType.LIGHT, tile.create_light_command(brightness, pixels))
+      # Get brightness and create pixels (values must be integers of 0 - 255)
+      try:
+        brightness = int(args["brightness"])
+        if brightness < 0 or brightness > 255:
+          raise ValueError("brightness must be in range(0, 256)")
+        pixels = PixelBuffer.from_dicts(list(map(dict, args["pixels"])))
+      except (ValueError, TypeError) as e:
+        logging.warning("Websocket: " + str(websocket) + " sent an invalid light command: " + str(e))
+        return
+      # A light command replaces the effect that is running on the tiles
+      effects_stop(tiles_to_command)
+      # Send command to tiles on the next frame
+      queue_light_command(tiles, group_id, brightness, pixels, trace_command(CmdType.LIGHT, tiles, received))
 
     case _:
       # Unknown command type, do nothing
       logging.warning("Websocket: " + str(websocket) + " tried to send unknown command type: " + type + " to tiles: " + str(tiles_to_command))
+      type = "unknown"
+  metric_ws_command.labels(type).observe(time.perf_counter() - started)
+
+def trace_command(type: CmdType, tiles: list[Tile], received: float) -> int | None:
+  """Starts tracing a command to the tiles (the online tiles that support tracing), returns the trace id (None = not traced)."""
+  return tracer.start(type.value, [tile.device_name for tile in tiles if tile.online and tile.supports(TRACE_FEATURE)], received)
+
+def get_tiles_to_command(message_json: dict, default_all: bool = False) -> tuple[list[str], str | None]:
+  """Returns the names of the tiles of a message ("group" or "tiles") and the group to publish to (None = publish per tile).
+
+  Without "group" and "tiles", all tiles are returned if default_all is set."""
+  group_id = message_json.get("group")
+  if group_id is None and "tiles" not in message_json and default_all:
+    group_id = GROUP_ALL
+  if group_id is not None:
+    group_id = str(group_id)
+    if group_id == GROUP_ALL:
+      return [tile.device_name for tile in registry], group_id
+    return list(registry.group_members(group_id)), group_id
+  tiles_to_command = list(map(str, message_json["tiles"]))
+  # Use a group topic if the tiles are exactly a group (one publish instead of one per tile)
+  return tiles_to_command, find_command_group(tiles_to_command)
+
+def find_command_group(tile_names: list[str]) -> str | None:
+  """Returns the group that consists of exactly the given tiles (GROUP_ALL if it's all known tiles), or None."""
+  tile_names = set(tile_names)
+  # A single tile is commanded on its own topic
+  if len(tile_names) < 2:
+    return None
+  if len(tile_names) == len(registry) and all(tile_name in registry for tile_name in tile_names):
+    return GROUP_ALL
+  return registry.find_group(tile_names)
+
+def ws_group(websocket: WebSocketServerProtocol, message_json: dict) -> None:
+  """Lists, sets or deletes the groups of tiles (that can be commanded with one publish)."""
+  type = str(message_json["type"])
+
+  if type == "list":
+    # Send all groups to the client
+    groups = {group_id: sorted(members) for group_id, members in registry.groups.items()}
+    ws_send(websocket, encode({"action": "groups", "groups": groups}))
+    return
+
+  group_id = str(message_json["group"])
+  # Group ids are used in topics, so they can't contain topic separators or wildcards
+  if group_id == GROUP_ALL or group_id == "" or any(char in group_id for char in "/+#"):
+    logging.warning("Websocket: " + str(websocket) + " tried to change group " + group_id + ", but that's not a valid group id")
+    return
+
+  if type == "set":
+    changed = registry.set_group(group_id, set(map(str, message_json["tiles"])))
+    logging.info("Websocket: " + str(websocket) + " set group " + group_id + " to tiles " + str(sorted(registry.group_members(group_id))))
+  elif type == "delete":
+    changed = registry.delete_group(group_id)
+    logging.info("Websocket: " + str(websocket) + " deleted group " + group_id)
+  else:
+    # Unknown group action, do nothing
+    logging.warning("Websocket: " + str(websocket) + " tried an unknown group action: " + type)
+    return
+  # Let the tiles that joined or left the group know their groups
+  for tile_name in changed:
+    mqtt_send_groups(mqtt_client, tile_name)
+
+def ws_effect(websocket: WebSocketServerProtocol, message_json: dict) -> None:
+  """Lists, starts or stops the effects (on the given tiles or group, default all tiles)."""
+  type = str(message_json["type"])
+
+  if type == "list":
+    # Send the available and the running effects to the client
+    running = [{"effect": running.name, "tiles": running.tile_names} for running in effects.effects]
+    ws_send(websocket, encode({"action": "effects", "effects": list(EFFECTS), "running": running}))
+    return
+
+  tile_names, _ = get_tiles_to_command(message_json, default_all=True)
+  if type == "start":
+    effect = str(message_json["effect"])
+    try:
+      effects_start(effect, tile_names, dict(message_json.get("args", {})))
+    except (ValueError, TypeError, KeyError) as e:
+      logging.warning("Websocket: " + str(websocket) + " tried to start effect " + effect + ": " + str(e))
+      return
+    logging.info("Websocket: " + str(websocket) + " started effect " + effect + " on " + str(len(tile_names)) + " tiles")
+  elif type == "stop":
+    effects_stop(tile_names)
+    logging.info("Websocket: " + str(websocket) + " stopped the effects on " + str(len(tile_names)) + " tiles")
+  else:
+    # Unknown effect action, do nothing
+    logging.warning("Websocket: " + str(websocket) + " tried an unknown effect action: " + type)
+
+def ws_send(websocket: WebSocketServerProtocol, message: str, key = None, coalesced_message: str = None) -> None:
+  """Queues a message in the send queue of the websocket.
+
+  A pending message with the same key is replaced (latest wins), messages without key are never replaced."""
+  outbox = outboxes.get(websocket)
+  if outbox is None:
+    # Websocket is already disconnected
+    return
+  outbox.put(key, message, coalesced_message)
+
+def ws_config(websocket: WebSocketServerProtocol, message_json: dict) -> None:
+  """Changes the settings of the websocket's connection."""
+  args = dict(message_json["args"])
+  if "max_rate" in args:
+    # Maximum amount of flushes of the send queue per second, a flush sends all pending messages (0 = no limit)
+    outboxes[websocket].max_rate = max(0.0, float(args["max_rate"]))
+    logging.info("Websocket: " + str(websocket) + " max rate set to " + str(outboxes[websocket].max_rate))
+
+def ws_stats(websocket: WebSocketServerProtocol) -> None:
+  """Sends the send queue counters (of this websocket and of all websockets) to the websocket."""
+  outbox = outboxes[websocket]
+  ws_send(websocket, encode({
+    "action": "stats",
+    "outbox": {
+      "clients": len(outboxes),
+      "pending": sum(outbox.pending for outbox in outboxes.values()),
+      **outbox_totals.to_dict()
+    },
+    "client": {
+      "pending": outbox.pending,
+      "max_rate": outbox.max_rate,
+      **outbox.counters.to_dict()
+    },
+    "scheduler": scheduler.to_dict(),
+    "effects": {
+      "running": len(effects.effects),
+      "tiles": sum(len(running.tile_names) for running in effects.effects),
+      "frames": effects.frames
+    },
+    "light_commands": {
+      "pending": len(pending_light_commands),
+      "coalesced": light_commands_coalesced
+    },
+    "discovery": discovery.to_dict(),
+    "snapshot": snapshot.to_dict() if snapshot is not None else None,
+    "presence": presence_store.to_dict() if presence_store is not None else None,
+    "metrics": metrics.to_dict(),
+    "profiler": profiler.to_dict(),
+    "tracing": tracer.to_dict()
+  }))
 
-async def ws_send_tile_state(websocket: WebSocketServerProtocol, tile: Tile, type: StateType) -> None:
+async def ws_query(websocket: WebSocketServerProtocol, message_json: dict) -> None:
+  """Sends the presence history of tiles ("group" or "tiles", default all) between "start" and "end" (epoch seconds, default the last day).
+
+  "resolution" is "minute", "hour" (summed rollups per bucket) or "raw" (the last presence events)."""
+  if presence_store is None:
+    logging.warning("Websocket: " + str(websocket) + " tried to query the presence history, but it is disabled")
+    return
+  tile_names, _ = get_tiles_to_command(message_json, default_all=True)
+  end = float(message_json.get("end", time.time()))
+  start = float(message_json.get("start", end - 86400))
+  resolution = str(message_json.get("resolution", "hour"))
+  reply = {"action": "query", "tiles": tile_names, "start": start, "end": end, "resolution": resolution}
+  if resolution == "raw":
+    reply["events"] = presence_store.query_events(tile_names, start, end)
+  else:
+    try:
+      reply.update(await presence_store.query(tile_names, start, end, resolution))
+    except ValueError as e:
+      logging.warning("Websocket: " + str(websocket) + " sent an invalid query: " + str(e))
+      reply["error"] = str(e)
+  ws_send(websocket, encode(reply))
+
+def ws_latency(websocket: WebSocketServerProtocol, message_json: dict) -> None:
+  """Sends the command latency (websocket to tile and back) of tiles ("group" or "tiles", default all) and per command type and stage."""
+  tile_names, _ = get_tiles_to_command(message_json, default_all=True)
+  ws_send(websocket, encode({
+    "action": "latency",
+    "tiles": tracer.tiles_to_dict(tile_names),
+    **tracer.to_dict()
+  }))
+
+def ws_is_admin(websocket: WebSocketServerProtocol, message_json: dict) -> bool:
+  """Returns true if the message has the admin token (admin actions are disabled without ADMIN_TOKEN)."""
+  if ADMIN_TOKEN != "" and hmac.compare_digest(str(message_json.get("token", "")), ADMIN_TOKEN):
+    return True
+  logging.warning("Websocket: " + str(websocket) + " tried an admin action without a valid token")
+  return False
+
+def ws_profile(websocket: WebSocketServerProtocol, message_json: dict) -> None:
+  """Profiles the controller (admin only) for "duration" seconds and sends the top functions and allocation sites.
+
+  "stop" ends a running profile early. The profile runs in a task, so the websocket can send other messages meanwhile."""
+  if not ws_is_admin(websocket, message_json):
+    ws_send(websocket, encode({"action": "profile", "error": "Not allowed"}))
+    return
+  if message_json.get("stop", False):
+    if not profiler.stop():
+      ws_send(websocket, encode({"action": "profile", "error": "No profile is running"}))
+    return
+  async def run() -> None:
+    try:
+      result = await profiler.profile(
+        float(message_json.get("duration", 10)),
+        cpu=bool(message_json.get("cpu", True)),
+        memory=bool(message_json.get("memory", True)),
+        top=int(message_json.get("top", 20)),
+        write_files=bool(message_json.get("write_files", False))
+      )
+    except RuntimeError as e:
+      logging.warning("Websocket: " + str(websocket) + " tried to profile: " + str(e))
+      result = {"error": str(e)}
+    ws_send(websocket, encode({"action": "profile", **result}))
+  asyncio.create_task(run())
+
+def ws_send_tile_state(websocket: WebSocketServerProtocol, tile: Tile, type: StateType) -> None:
   """Sends the state of the given tile to the websocket."""
-  # Create formatted responds
-  responds = {
-    "action": "state",
-    "type": type.value,
-    "tile": tile.device_name,
-    "args": tile.get_state(type)
-  }
-  # Send responds to client
-  await websocket.send(json.dumps(responds, indent=4))
-
-async def ws_send_tile_list_changes(websocket: WebSocketServerProtocol, tiles: list[Tile], change: TileListChange) -> None:
+  started = time.perf_counter()
+  ws_send(websocket, create_tile_state_message(tile, type), (tile.device_name, type.value))
+  metric_ws_send_tile_state.observe(time.perf_counter() - started)
+
+def ws_broadcast_tile_state(tile: Tile, type: StateType) -> None:
+  """Sends the state of the given tile to all websockets that are subscribed to it.
+
+  The message is encoded once and the same message is queued for every websocket,
+  replacing a pending (unsent) update of the same tile and state type."""
+  subscribers = registry.state_subscribers(tile.device_name)
+  # Don't encode the state if nobody is listening
+  if len(subscribers) == 0:
+    return
+  key = (tile.device_name, type.value)
+  message = create_tile_state_message(tile, type)
+  # Send the changed pixels to the websockets that asked for light deltas
+  if type == StateType.LIGHT:
+    delta_subscribers = registry.delta_subscribers(tile.device_name)
+    if len(delta_subscribers) > 0:
+      delta_message = create_tile_light_delta_message(tile)
+      for ws in delta_subscribers:
+        # A pending delta can't be replaced by a newer delta (changes would be lost), use the full light state instead
+        ws_send(ws, delta_message, key, message)
+      subscribers = subscribers - delta_subscribers
+  for ws in subscribers:
+    ws_send(ws, message, key)
+
+def ws_send_tile_list_changes(websocket: WebSocketServerProtocol, tiles: list[Tile], change: TileListChange) -> None:
   """Sends a list of tiles to the websocket, with the given change type."""
   # Check if tiles is not empty
   if len(tiles) == 0:
     logging.warning("Tried to send empty list of tiles to websocket: " + str(websocket))
     return
-  # Create formatted list of tiles (json)
-  responds = {
-    "action": "tiles",
-    "type": change.value,
-    "tiles": [tile.device_name for tile in tiles]
-  }
-  # Send list of tiles to client
-  await websocket.send(json.dumps(responds, indent=4))
+  # Send list of tiles to client (changes are never replaced)
+  ws_send(websocket, create_tile_list_message(tiles, change))
+
+def ws_broadcast_tile_list_changes(tiles: list[Tile], change: TileListChange) -> None:
+  """Sends a list of tiles to all websockets that are subscribed to the tile list, with the given change type."""
+  subscribers = registry.tile_list_subscribers
+  # Don't encode the list if nobody is listening
+  if len(subscribers) == 0:
+    return
+  message = create_tile_list_message(tiles, change)
+  for ws in subscribers:
+    ws_send(ws, message)
 
 # --- Project master ---
 class PMCmdType(Enum):
@@ -447,6 +805,63 @@ def process_pm_command(pm_command_type, tile: Tile, payload):
     # Unknown command type, do nothing
     logging.warning("Unknown project master command type: " + pm_command_type)
 
+def process_pm_group_command(pm_command_type, tiles: list[Tile], group_id: str, payload: str):
+  """Process a command from the project master for a group of tiles (one publish per command)"""
+  if pm_command_type == PMCmdType.COMMAND:
+    if payload == "ON":
+      # Brightness 127 (half brightness), the pixels keep their current value
+      light_command = create_light_command(127, PixelBuffer())
+      # Play sound "Mario jump" with volume 75%
+      audio_commands = {create_audio_command(1, False, "Mario jump", 75): tiles}
+    elif payload == "OFF":
+      # Brightness 0 (lights off)
+      light_command = create_light_command(0, PixelBuffer())
+      # Audio mode 4 (stop audio), the tiles keep their sound, loop and volume (like the OFF command of a single tile)
+      audio_commands = {}
+      for tile in tiles:
+        audio_commands.setdefault(tile.create_audio_command(mode=4), []).append(tile)
+    else:
+      # Unknown command, do nothing
+      logging.warning("Received unknown command command from project master: " + payload)
+      return
+    mqtt_send_command_to_tiles(mqtt_client, tiles, CmdType.LIGHT, light_command, group_id)
+    if len(audio_commands) == 1:
+      # The same audio command for every tile, published once on the group topic
+      mqtt_send_command_to_tiles(mqtt_client, tiles, CmdType.AUDIO, next(iter(audio_commands)), group_id)
+    else:
+      # The tiles have different audio settings, every tile gets its own command
+      for audio_command, command_tiles in audio_commands.items():
+        mqtt_send_command_to_tiles(mqtt_client, command_tiles, CmdType.AUDIO, audio_command)
+  elif pm_command_type == PMCmdType.RGB:
+    # Recieved message 'r,g,b' from project master
+    try:
+      rgb = payload.split(",")
+      color = (int(rgb[0]), int(rgb[1]), int(rgb[2]), 0)
+      # Check the values (0 - 255)
+      bytes(color)
+    except:
+      # Unknown command, do nothing
+      logging.warning("Received unknown rgb command from project master: " + payload)
+      return
+    group_tiles = [tile for tile in tiles if tile.supports(GROUP_FEATURE)]
+    if len(group_tiles) > 0:
+      # Enough pixels for the largest tile (tiles ignore the pixels they don't have), without brightness (keep current)
+      amount_of_pixels = max(len(tile.pixels) for tile in group_tiles)
+      pixels = PixelBuffer(amount_of_pixels)
+      pixels.fill(*color)
+      frame = encode_light_frame(None, pixels) if all(tile.supports(FRAME_FEATURE) for tile in group_tiles) else None
+      mqtt_send_group_command(mqtt_client, group_id, CmdType.LIGHT, create_light_command(None, pixels), frame)
+    # Tiles that don't support group topics get the command on their own topic (with their own brightness)
+    for tile in tiles:
+      if not tile.supports(GROUP_FEATURE):
+        process_pm_rgb_command(tile, payload)
+  elif pm_command_type == PMCmdType.EFFECT:
+    # Effects are rendered (and sent) per tile
+    process_pm_effect([tile.device_name for tile in tiles], payload)
+  else:
+    # Unknown command type, do nothing
+    logging.warning("Unknown project master command type: " + str(pm_command_type))
+
 def process_pm_command_command(tile: Tile, payload: str):
   if payload == "ON":
     # Send command to tile with brightness 127 (half brightness)
@@ -470,23 +885,137 @@ def process_pm_rgb_command(tile: Tile, payload: str):
     green = int(rgb[1])
     blue = int(rgb[2])
     white = 0
-    # Create list of pixels
-    pixels = [Pixel() for pixel in tile.pixels]
-    # Add values to pixels
-    for i in range(len(pixels)):
-      pixels[i].from_dict({"r": red, "g": green, "b": blue, "w": white})
+    # Create pixels (as many as the tile has) with the color
+    pixels = PixelBuffer(len(tile.pixels))
+    pixels.fill(red, green, blue, white)
     # Send command to tile with new pixels
     mqtt_send_command(mqtt_client, tile, CmdType.LIGHT, tile.create_light_command(pixels=pixels))
   except:
     # Unknown command, do nothing
     logging.warning("Received unknown rgb command from project master: " + payload)
 
-def process_pm_effect_command(tile: Tile, payload):
-  # This project does not have any effects at this time.
-  pass
+def process_pm_effect_command(tile: Tile, payload: str):
+  process_pm_effect([tile.device_name], payload)
+
+def process_pm_effect(tile_names: list[str], payload: str):
+  # Recieved message '<effect name>' or 'OFF' from project master
+  if payload == "OFF":
+    effects_stop(tile_names)
+    return
+  try:
+    effects_start(payload.lower(), tile_names, {})
+  except ValueError:
+    # Unknown effect, do nothing
+    logging.warning("Received unknown effect command from project master: " + payload)
+
+# --- Frames ---
+def queue_light_command(tiles: list[Tile], group_id: str | None, brightness: int, pixels: PixelBuffer, trace_id: int = None) -> None:
+  """Queues a light command, it's sent on the next frame.
+
+  A newer command for the same tiles (or group) replaces a command that hasn't been sent yet,
+  so streamed light commands are sent at most FRAME_FPS times per second."""
+  global light_commands_coalesced
+  key = group_id if group_id is not None else tuple(tile.device_name for tile in tiles)
+  replaced = pending_light_commands.pop(key, None)
+  if replaced is not None:
+    light_commands_coalesced += 1
+    # The replaced command is never sent
+    if replaced[4] is not None:
+      tracer.cancel(replaced[4])
+  # (Re)insert at the end, so commands are sent in the order of their latest version
+  pending_light_commands[key] = (tiles, group_id, brightness, pixels, trace_id)
+  scheduler.wake()
+
+def light_commands_tick(deadline: float) -> bool:
+  """Sends the queued light commands (called by the scheduler every frame)."""
+  commands = list(pending_light_commands.values())
+  pending_light_commands.clear()
+  for tiles, group_id, brightness, pixels, trace_id in commands:
+    try:
+      frame = encode_light_frame(brightness, pixels)
+    except struct.error as e:
+      # Never let one bad command drop the other commands of the frame
+      logging.error("Could not encode light command for " + str(group_id or [tile.device_name for tile in tiles]) + ": " + str(e))
+      if trace_id is not None:
+        tracer.cancel(trace_id)
+      continue
+    # Send command to tiles (as JSON and as light frame, for the tiles that support it)
+    mqtt_send_command_to_tiles(mqtt_client, tiles, CmdType.LIGHT, create_light_command(brightness, pixels), group_id, frame, trace_id)
+  # Keep ticking for one more frame after sending, so a command that follows right away waits for
+  # that frame (and is coalesced with the commands after it) instead of waking the scheduler right away
+  return len(commands) > 0
+
+def effects_start(effect: str, tile_names: list[str], args: dict) -> None:
+  """Starts the effect on the given tiles (and the scheduler, if it isn't running).
+
+  Raises a ValueError if the effect doesn't exist or the args are invalid."""
+  effects.start(effect, tile_names, args, asyncio.get_running_loop().time())
+  scheduler.wake()
+
+def effects_stop(tile_names: list[str] = None) -> None:
+  """Stops the effects on the given tiles (None = all tiles), the tiles keep their last frame."""
+  if effects.running:
+    effects.stop(tile_names)
+
+def effects_tick(deadline: float) -> bool:
+  """Renders the running effects (at the time of the frame) and sends the changed pixels to the tiles (called by the scheduler every frame)."""
+  if not effects.running:
+    return False
+  for tile_name, pixel_bytes, brightness in effects.render(deadline):
+    tile = get_existing_tile(tile_name)
+    if tile is None or tile.online == False:
+      continue
+    pixels = PixelBuffer(data=pixel_bytes)
+    # Send as many pixels as the tile has
+    if len(tile.pixels) > 0:
+      pixels.resize(len(tile.pixels))
+    mqtt_send_light_command(mqtt_client, tile, brightness, pixels)
+  return effects.running
 
 # --- Main ---
 async def main():
+  # Start the dispatcher (before the mqtt client, so no messages are lost)
+  global dispatcher
+  dispatcher = Dispatcher(mqtt_process_event)
+  dispatcher.start()
+
+  # Create the discovery of new tiles (before the mqtt client, tiles are found as soon as it connects)
+  global discovery
+  discovery = Discovery(discovery_send_command, DISCOVERY_CONCURRENCY, DISCOVERY_DELAY, DISCOVERY_TIMEOUT, attempts=DISCOVERY_ATTEMPTS)
+
+  # Load the tiles and groups of the last run (before the mqtt client connects, so websockets get their state right away)
+  global snapshot
+  snapshot_task = None
+  if SNAPSHOT_FILE != "":
+    snapshot = RegistrySnapshot(SNAPSHOT_FILE)
+    snapshot.open()
+    for tile in snapshot.load(registry):
+      # The values are known, the discovery only confirms them when the tile comes online
+      discovery.start(tile)
+    snapshot_task = asyncio.create_task(snapshot.run(registry, SNAPSHOT_INTERVAL))
+
+  # Open the presence history (continues the rollups of today, if the controller ran earlier today)
+  global presence_store
+  presence_task = None
+  if PRESENCE_DIR != "":
+    presence_store = PresenceStore(PRESENCE_DIR, minute_retention=PRESENCE_MINUTE_RETENTION)
+    presence_store.open()
+    presence_task = asyncio.create_task(presence_store.run(PRESENCE_FLUSH_INTERVAL))
+
+  # Let the frame scheduler send the effects and the streamed light commands
+  scheduler.add_callback(light_commands_tick)
+  scheduler.add_callback(effects_tick)
+
+  # Start the embedded MQTT broker (before the mqtt client connects to it)
+  global broker
+  if MQTT_EMBEDDED_BROKER:
+    broker = Broker(MQTT_HOST, MQTT_PORT)
+    await broker.start()
+    metrics.counter("broker_messages_in_total", "Messages received by the embedded MQTT broker", function=lambda: broker.stats.messages_in)
+    metrics.counter("broker_messages_out_total", "Messages sent to subscribers by the embedded MQTT broker", function=lambda: broker.stats.messages_out)
+    metrics.counter("broker_dropped_total", "Messages the embedded MQTT broker dropped for clients that didn't keep up", function=lambda: broker.stats.dropped)
+    metrics.gauge("broker_clients", "Clients connected to the embedded MQTT broker", function=lambda: len(broker.clients))
+
   # Start the mqtt client
   logging.info("Starting MQTT client")
   mqtt_task = asyncio.create_task(mqtt_controller(MQTT_HOST, MQTT_PORT))
@@ -498,9 +1027,23 @@ async def main():
   logging.info("Starting websocket server")
   ws_task = asyncio.create_task(ws_server())
 
+  # Serve the metrics (for Prometheus)
+  if METRICS_PORT != 0:
+    asyncio.create_task(serve_metrics(metrics, METRICS_HOST, METRICS_PORT))
+
   # Wait for mqtt client and websocket server to finish (never)
-  await mqtt_task
-  await ws_task
+  try:
+    await mqtt_task
+    await ws_task
+  finally:
+    # Save the last changes (e.g. after Ctrl+C)
+    if snapshot is not None:
+      snapshot_task.cancel()
+      await snapshot.save(registry)
+      snapshot.close()
+    if presence_store is not None:
+      presence_task.cancel()
+      await presence_store.flush()
 
 # Run the main function
 if __name__== "__main__":
@@ -0,0 +1,35 @@
+import json
+from enum import Enum
+from tile import Tile, StateType
+
+class TileListChange(Enum):
+  LIST = "list"
+  ADD = "add"
+  REMOVE = "remove"
+
+def encode(message: dict) -> str:
+  """Encodes a websocket message as compact JSON (without whitespace)."""
+  return json.dumps(message, separators=(",", ":"))
+
+def create_tile_state_message(tile: Tile, type: StateType) -> str:
+  """Creates the message with the (given type of) state of the tile.
+
+  Uses the cached JSON snapshot of the tile, so the state itself isn't encoded again."""
+  return '{"action":"state","type":"' + type.value + '","tile":' + json.dumps(tile.device_name) + ',"args":' + tile.get_state_json(type) + '}'
+
+def create_tile_light_delta_message(tile: Tile) -> str:
+  """Creates the message with the pixels that changed in the last light state update of the tile."""
+  return encode({
+    "action": "state",
+    "type": "light_delta",
+    "tile": tile.device_name,
+    "args": tile.get_light_delta()
+  })
+
+def create_tile_list_message(tiles: list[Tile], change: TileListChange) -> str:
+  """Creates the message with the list of tiles, with the given change type."""
+  return encode({
+    "action": "tiles",
+    "type": change.value,
+    "tiles": [tile.device_name for tile in tiles]
+  })
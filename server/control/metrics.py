@@ -0,0 +1,212 @@
+import math
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+# Upper bounds (in seconds) of the buckets of latency histograms, from the hot paths (microseconds) to slow I/O
+LATENCY_BOUNDS: list[float] = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0]
+CONTENT_TYPE: str = "text/plain; version=0.0.4; charset=utf-8" # Prometheus text exposition format
+
+# --- Metrics ---
+class Counter:
+  """Value that only goes up (e.g. amount of messages), counted directly or read from a function when collected."""
+  __slots__ = ("value", "function")
+
+  def __init__(self, function: Callable[[], float] = None):
+    self.value: float = 0
+    self.function: Callable[[], float] = function # Returns the value when collected (None = use value)
+
+  def inc(self, amount: float = 1) -> None:
+    self.value += amount
+
+  def get(self) -> float:
+    return self.function() if self.function is not None else self.value
+
+class Gauge:
+  """Value that goes up and down (e.g. a queue depth), set directly or read from a function when collected."""
+  __slots__ = ("value", "function")
+
+  def __init__(self, function: Callable[[], float] = None):
+    self.value: float = 0
+    self.function: Callable[[], float] = function # Returns the value when collected (None = use value)
+
+  def set(self, value: float) -> None:
+    self.value = value
+
+  def get(self) -> float:
+    return self.function() if self.function is not None else self.value
+
+class Histogram:
+  """Distribution of observed values (e.g. durations in seconds), with fixed buckets."""
+  __slots__ = ("bounds", "counts", "count", "sum", "max")
+
+  def __init__(self, bounds: list[float] = LATENCY_BOUNDS):
+    self.bounds: list[float] = bounds # Upper bounds of the buckets (the last bucket has no bound)
+    self.counts: list[int] = [0] * (len(bounds) + 1) # Observations per bucket (not cumulative)
+    self.count: int = 0
+    self.sum: float = 0.0
+    self.max: float = 0.0
+
+  def observe(self, value: float) -> None:
+    self.counts[bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def percentile(self, percentile: float) -> float:
+    """Returns the upper bound of the bucket that contains the given percentile (0 - 100), at most the maximum."""
+    if self.count == 0:
+      return 0.0
+    rank = percentile / 100 * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+    return self.max
+
+  def to_dict(self) -> dict:
+    """Returns the summary of the histogram in milliseconds."""
+    return {
+      "count": self.count,
+      "mean_ms": self.sum / self.count * 1000 if self.count > 0 else 0.0,
+      "max_ms": self.max * 1000,
+      "p50_ms": self.percentile(50) * 1000,
+      "p95_ms": self.percentile(95) * 1000,
+      "p99_ms": self.percentile(99) * 1000
+    }
+
+class MetricFamily:
+  """A named metric, with a child metric per combination of label values."""
+  def __init__(self, name: str, kind: str, help: str, label_names: tuple[str, ...], create: Callable[[], object]):
+    self.name: str = name
+    self.kind: str = kind # counter, gauge or histogram
+    self.help: str = help
+    self.label_names: tuple[str, ...] = label_names
+    self._create: Callable[[], object] = create
+    self.children: dict[tuple[str, ...], object] = {} # Label values -> metric
+
+  def labels(self, *values: str):
+    """Returns the metric of the given label values (created on first use).
+
+    Look the metric up once and keep it, for hot paths."""
+    child = self.children.get(values)
+    if child is None:
+      if len(values) != len(self.label_names):
+        raise ValueError("Metric " + self.name + " needs labels " + str(self.label_names) + ", got " + str(values))
+      child = self.children[values] = self._create()
+    return child
+
+class Metrics:
+  """The metrics of the controller, collected in Prometheus text format or as a dictionary (for the websocket stats).
+
+  Recording is a plain attribute update on a metric that is looked up in advance (no locks, everything runs
+  on the event loop), so the metrics can stay on in production. Gauges that mirror existing
+  counters or queues are read from a function when collected, they cost nothing on the hot path."""
+  # Constructor
+  def __init__(self, prefix: str = ""):
+    self.prefix: str = prefix # Put in front of every metric name
+    self.families: dict[str, MetricFamily] = {}
+
+  def counter(self, name: str, help: str, label_names: tuple[str, ...] = (), function: Callable[[], float] = None) -> MetricFamily:
+    """Adds a counter. With a function (and no labels), the value is read from the function when collected."""
+    return self._add(name, "counter", help, label_names, Counter, function)
+
+  def gauge(self, name: str, help: str, label_names: tuple[str, ...] = (), function: Callable[[], float] = None) -> MetricFamily:
+    """Adds a gauge. With a function (and no labels), the value is read from the function when collected."""
+    return self._add(name, "gauge", help, label_names, Gauge, function)
+
+  def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (), bounds: list[float] = LATENCY_BOUNDS) -> MetricFamily:
+    return self._add(name, "histogram", help, label_names, lambda: Histogram(bounds))
+
+  def _add(self, name: str, kind: str, help: str, label_names: tuple[str, ...], create: Callable[[], object], function: Callable[[], float] = None) -> MetricFamily:
+    name = self.prefix + name
+    if name in self.families:
+      raise ValueError("Metric " + name + " already exists")
+    family = self.families[name] = MetricFamily(name, kind, help, tuple(label_names), create)
+    if function is not None:
+      family.labels().function = function
+    return family
+
+  def render(self) -> str:
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for family in self.families.values():
+      lines.append("# HELP " + family.name + " " + family.help)
+      lines.append("# TYPE " + family.name + " " + family.kind)
+      for values, child in family.children.items():
+        labels = [name + '="' + _escape(value) + '"' for name, value in zip(family.label_names, values)]
+        if family.kind == "histogram":
+          cumulative = 0
+          for bound, count in zip(child.bounds + [math.inf], child.counts):
+            cumulative += count
+            lines.append(family.name + "_bucket" + _format_labels(labels + ['le="' + _format_value(bound) + '"']) + " " + str(cumulative))
+          lines.append(family.name + "_sum" + _format_labels(labels) + " " + _format_value(child.sum))
+          lines.append(family.name + "_count" + _format_labels(labels) + " " + str(child.count))
+        else:
+          value = child.get()
+          lines.append(family.name + _format_labels(labels) + " " + _format_value(value))
+    return "\n".join(lines) + "\n"
+
+  def to_dict(self) -> dict:
+    """Returns all metrics as a dictionary (metric name -> value, or label values joined by "," -> value)."""
+    result = {}
+    for family in self.families.values():
+      values = {}
+      for label_values, child in family.children.items():
+        value = child.to_dict() if family.kind == "histogram" else child.get()
+        values[",".join(label_values)] = value
+      # Metrics without labels have one value
+      result[family.name] = values.get("") if family.label_names == () else values
+    return result
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: list[str]) -> str:
+  return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+def _format_value(value: float) -> str:
+  if value == math.inf:
+    return "+Inf"
+  if isinstance(value, int) or float(value).is_integer():
+    return str(int(value))
+  return repr(float(value))
+
+# --- HTTP endpoint ---
+async def serve_metrics(metrics: Metrics, host: str, port: int) -> None:
+  """Serves the metrics in Prometheus text format on http://host:port/metrics (runs forever)."""
+  async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+      request_line = await asyncio.wait_for(reader.readline(), 5)
+      # Skip the headers of the request
+      while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+        pass
+      parts = request_line.decode("latin-1").split()
+      if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+        status, content_type, body = "200 OK", CONTENT_TYPE, metrics.render().encode("utf-8")
+      else:
+        status, content_type, body = "404 Not Found", "text/plain", b"Not found, the metrics are at /metrics\n"
+      writer.write(("HTTP/1.1 " + status + "\r\nContent-Type: " + content_type + "\r\nContent-Length: " + str(len(body)) + "\r\nConnection: close\r\n\r\n").encode("latin-1") + body)
+      await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+      logger.warning("Metrics request failed: " + str(e))
+    finally:
+      writer.close()
+
+  try:
+    server = await asyncio.start_server(handle, host, port)
+  except OSError as e:
+    # E.g. the port is in use, the controller works without the endpoint
+    logger.error("Failed to serve metrics on " + host + ":" + str(port) + ": " + str(e))
+    return
+  logger.info("Serving metrics on http://" + host + ":" + str(port) + "/metrics")
+  async with server:
+    await server.serve_forever()
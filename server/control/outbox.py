@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from websockets.exceptions import ConnectionClosed
+from websockets.server import WebSocketServerProtocol
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+CLOSE_CODE_OVERLOADED: int = 1013 # Websocket close code "try again later", used when the websocket doesn't keep up
+CLOSE_CODE_ERROR: int = 1011 # Websocket close code "internal error", used when sending failed
+
+class OutboxCounters:
+  """Counters of (a group of) outboxes."""
+  def __init__(self):
+    self.sent: int = 0 # Messages sent to the websocket
+    self.coalesced: int = 0 # Messages replaced by a newer message with the same key before they were sent
+    self.dropped: int = 0 # Messages dropped because the outbox was full
+
+  def to_dict(self) -> dict:
+    return {
+      "sent": self.sent,
+      "coalesced": self.coalesced,
+      "dropped": self.dropped
+    }
+
+class ClientOutbox:
+  """Bounded, latest-wins send queue of one websocket.
+
+  Messages are keyed (e.g. by tile and state type), a newer message replaces a pending
+  message with the same key that hasn't been sent yet. A task flushes the outbox (sends
+  everything that is pending), at most max_rate times per second (0 = no limit), so a slow
+  websocket only slows down (and coalesces) its own updates.
+
+  When full, the oldest keyed message is dropped (a newer message with its key brings the
+  websocket up to date), after dropping a message of a delta stream the next message with its
+  key is sent as full state. Messages without key (e.g. tile list changes) are never dropped:
+  if only those are pending, the websocket doesn't keep up and is closed."""
+  # Constructor
+  def __init__(self, websocket: WebSocketServerProtocol, maxsize: int = 1000, max_rate: float = 0.0, totals: OutboxCounters = None):
+    self._websocket: WebSocketServerProtocol = websocket
+    self._pending: OrderedDict = OrderedDict() # Key -> (message, full state if it's a delta stream, keyed), in the order they should be sent
+    self._resync: set = set() # Keys of delta streams whose next message must be the full state (a message of them was dropped)
+    self._maxsize: int = maxsize
+    self.max_rate: float = max_rate # Maximum amount of flushes per second, a flush sends all pending messages (0 = no limit)
+    self._wakeup: asyncio.Event = asyncio.Event()
+    self._task: asyncio.Task = None
+    self._close_task: asyncio.Task = None # Closes the websocket (set when the outbox gave up on it)
+    self._unique_keys = itertools.count() # Keys for messages that should never be coalesced
+    self.counters: OutboxCounters = OutboxCounters()
+    self._totals: OutboxCounters = totals if totals is not None else OutboxCounters()
+
+  @property
+  def pending(self) -> int:
+    return len(self._pending)
+
+  def start(self) -> None:
+    """Starts sending the pending messages (on the running event loop)."""
+    self._task = asyncio.create_task(self._run())
+
+  async def close(self) -> None:
+    """Stops sending and forgets the pending messages."""
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+    self._pending.clear()
+    self._resync.clear()
+
+  def put(self, key, message: str, coalesced_message: str = None) -> None:
+    """Queues a message to be sent.
+
+    If a message with the same key is still pending, it is replaced by this message
+    (or by coalesced_message if given, e.g. a full state instead of a delta).
+    Messages with key None are never coalesced nor dropped (the websocket is closed if only those are pending)."""
+    if self._close_task is not None:
+      # The websocket is being closed
+      return
+    keyed = key is not None
+    if not keyed:
+      key = (None, next(self._unique_keys))
+    elif key in self._resync:
+      # A message of this delta stream was dropped, send the full state instead of the delta
+      self._resync.discard(key)
+      if coalesced_message is not None:
+        message = coalesced_message
+    if key in self._pending:
+      # Latest wins (and moves to the back, so it isn't sent before older messages)
+      self._pending[key] = (coalesced_message if coalesced_message is not None else message, coalesced_message, keyed)
+      self._pending.move_to_end(key)
+      self.counters.coalesced += 1
+      self._totals.coalesced += 1
+    else:
+      if len(self._pending) >= self._maxsize:
+        # Outbox is full, drop the oldest keyed message
+        dropped_key = next((pending_key for pending_key, (_, _, pending_keyed) in self._pending.items() if pending_keyed), None)
+        self.counters.dropped += 1
+        self._totals.dropped += 1
+        if dropped_key is None:
+          # Only messages that can't be dropped are pending, give up on the websocket (and this message)
+          self._abort(CLOSE_CODE_OVERLOADED, "send queue is full")
+          return
+        _, full_message, _ = self._pending.pop(dropped_key)
+        if full_message is not None:
+          self._resync.add(dropped_key)
+      self._pending[key] = (message, coalesced_message, keyed)
+    self._wakeup.set()
+
+  async def _run(self) -> None:
+    """Sends the pending messages, waiting between flushes to respect max_rate."""
+    loop = asyncio.get_running_loop()
+    try:
+      while True:
+        await self._wakeup.wait()
+        self._wakeup.clear()
+        started = loop.time()
+        # Send everything that is pending
+        while len(self._pending) > 0:
+          _, (message, _, _) = self._pending.popitem(last=False)
+          await self._websocket.send(message)
+          self.counters.sent += 1
+          self._totals.sent += 1
+        # Wait till the next flush is allowed (new messages are coalesced in the meantime)
+        if self.max_rate > 0:
+          delay = 1 / self.max_rate - (loop.time() - started)
+          if delay > 0:
+            await asyncio.sleep(delay)
+    except ConnectionClosed:
+      # Websocket is closed, the handler cleans up
+      logger.info("Websocket: " + str(self._websocket) + " closed with " + str(len(self._pending)) + " pending messages")
+    except Exception as e:
+      # Without this task nothing is sent anymore, close the websocket (the handler cleans up)
+      logger.error("Websocket: " + str(self._websocket) + " failed to send: " + str(e))
+      self._abort(CLOSE_CODE_ERROR, "failed to send")
+
+  def _abort(self, code: int, reason: str) -> None:
+    """Forgets the pending messages and closes the websocket (its handler then closes the outbox)."""
+    logger.warning("Websocket: " + str(self._websocket) + " is closed, " + reason + " (" + str(len(self._pending)) + " pending messages)")
+    self.counters.dropped += len(self._pending)
+    self._totals.dropped += len(self._pending)
+    self._pending.clear()
+    self._resync.clear()
+    self._close_task = asyncio.create_task(self._websocket.close(code, reason))
@@ -0,0 +1,347 @@
+import os
+import time
+import asyncio
+import logging
+import numpy as np
+from collections import OrderedDict
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+SECONDS_PER_DAY: int = 86400
+RESOLUTIONS: dict[str, int] = {"minute": 60, "hour": 3600} # Resolution -> seconds per bucket
+MAX_BUCKETS: int = 11520 # Maximum amount of buckets a query returns (8 days of minutes, so any week fits)
+MAX_EVENTS: int = 10000 # Maximum amount of raw events a query returns
+
+# --- Raw events ---
+class PresenceRing:
+  """Ring buffer with the last presence events (time, detected) of one tile, in columns."""
+  __slots__ = ("times", "values", "count", "head")
+
+  def __init__(self, capacity: int):
+    self.times: np.ndarray = np.zeros(capacity, dtype=np.float64)
+    self.values: np.ndarray = np.zeros(capacity, dtype=np.bool_)
+    self.count: int = 0 # Amount of events in the buffer
+    self.head: int = 0 # Index the next event is written to
+
+  def append(self, t: float, detected: bool) -> None:
+    self.times[self.head] = t
+    self.values[self.head] = detected
+    self.head = (self.head + 1) % len(self.times)
+    self.count = min(self.count + 1, len(self.times))
+
+  def range(self, start: float, end: float) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the times and values of the events between start and end (in order)."""
+    order = (np.arange(self.count) + self.head - self.count) % len(self.times)
+    times = self.times[order]
+    # Events are appended in time order, so the range is found by binary search
+    first, last = np.searchsorted(times, [start, end])
+    return times[first:last], self.values[order[first:last]]
+
+# --- Rollups ---
+class Rollup:
+  """Counters of one day, per tile (rows) and per bucket (columns) of a resolution.
+
+  occupied: seconds presence was detected, detections: presence started, heartbeats: system states received."""
+  COLUMNS: list[str] = ["occupied", "detections", "heartbeats"]
+
+  def __init__(self, bucket_size: int, rows: int = 0):
+    self.bucket_size: int = bucket_size
+    buckets = SECONDS_PER_DAY // bucket_size
+    self.occupied: np.ndarray = np.zeros((rows, buckets), dtype=np.float32)
+    self.detections: np.ndarray = np.zeros((rows, buckets), dtype=np.uint32)
+    self.heartbeats: np.ndarray = np.zeros((rows, buckets), dtype=np.uint32)
+
+  def grow(self, rows: int) -> None:
+    """Makes room for at least `rows` rows (for new tiles, the room doubles so adding tiles one by one stays cheap)."""
+    capacity = len(self.occupied)
+    if rows <= capacity:
+      return
+    capacity = max(rows, capacity * 2, 16)
+    for column in self.COLUMNS:
+      array = getattr(self, column)
+      grown = np.zeros((capacity, array.shape[1]), dtype=array.dtype)
+      grown[:len(array)] = array
+      setattr(self, column, grown)
+
+  def add_occupied(self, row: int, start: float, end: float) -> None:
+    """Adds the seconds between start and end (seconds since the start of the day) to the buckets they fall in."""
+    _distribute(self.occupied[row], self.bucket_size, start, end)
+
+  def copy(self) -> "Rollup":
+    rollup = Rollup(self.bucket_size)
+    for column in self.COLUMNS:
+      setattr(rollup, column, getattr(self, column).copy())
+    return rollup
+
+def _distribute(series: np.ndarray, bucket_size: int, start: float, end: float) -> None:
+  """Adds the seconds between start and end to the buckets of the series they fall in."""
+  if end <= start:
+    return
+  first = int(start // bucket_size)
+  last = min(int(np.ceil(end / bucket_size)), len(series))
+  if last - first <= 4:
+    # Usually a few buckets, a loop is faster than creating arrays
+    for bucket in range(first, last):
+      series[bucket] += min(end, (bucket + 1) * bucket_size) - max(start, bucket * bucket_size)
+    return
+  buckets = np.arange(first, last)
+  series[first:last] += np.minimum(end, (buckets + 1) * bucket_size) - np.maximum(start, buckets * bucket_size)
+
+class Day:
+  """The rollups of one (UTC) day, with the tile of every row."""
+  def __init__(self, day: int, tile_names: list[str] = None, rollups: dict[str, Rollup] = None):
+    self.day: int = day # Days since the epoch
+    self.tile_names: list[str] = tile_names if tile_names is not None else []
+    self.rows: dict[str, int] = {tile_name: row for row, tile_name in enumerate(self.tile_names)}
+    self.rollups: dict[str, Rollup] = rollups if rollups is not None else {resolution: Rollup(size) for resolution, size in RESOLUTIONS.items()}
+
+  @property
+  def start(self) -> float:
+    return self.day * SECONDS_PER_DAY
+
+  def row(self, tile_name: str) -> int:
+    """Returns the row of the tile (adds a row for a new tile)."""
+    row = self.rows.get(tile_name)
+    if row is None:
+      row = len(self.tile_names)
+      self.tile_names.append(tile_name)
+      self.rows[tile_name] = row
+      for rollup in self.rollups.values():
+        rollup.grow(row + 1)
+    return row
+
+# --- Store ---
+class PresenceStore:
+  """Time series of the presence (and heartbeats) of the tiles.
+
+  Keeps the last raw presence events of every tile in a ring buffer, and counts every event in
+  per minute and per hour rollups of the current (UTC) day. The rollups are written to a columnar
+  file per day and resolution (<directory>/<day>.<resolution>.npz) every flush interval and when the
+  day is over, so queries over past days read the (cached) rollups instead of raw events.
+  Memory stays bounded: a ring buffer per tile, the rollups of one day and a cache of loaded days
+  (per resolution, a day of minutes is 60 times the size of a day of hours).
+  Minute rollups are deleted after minute_retention days, hour rollups are kept."""
+  # Constructor
+  def __init__(self, directory: str, raw_capacity: int = 256, minute_retention: int = 31, cache_days: dict[str, int] = None):
+    self.directory: str = directory
+    self.raw_capacity: int = raw_capacity # Raw events kept per tile
+    self.minute_retention: int = minute_retention # Days the minute rollups are kept on disk
+    self._raw: dict[str, PresenceRing] = {} # Tile name -> last raw events
+    self._since: dict[str, float] = {} # Tile name -> time presence was detected (while it is detected)
+    self._today: Day = None
+    self._cache: dict[str, OrderedDict] = {resolution: OrderedDict() for resolution in RESOLUTIONS} # Resolution -> day -> (tile names, rollup) of past days (least recently used first)
+    self._cache_days: dict[str, int] = cache_days if cache_days is not None else {"minute": 2, "hour": 93} # Resolution -> maximum amount of cached days
+    self._writes: set[asyncio.Task] = set() # Running writes of past days
+    self.events: int = 0 # Amount of presence events recorded
+    self.heartbeats: int = 0 # Amount of heartbeats recorded
+    self.flushes: int = 0 # Amount of files written
+
+  def open(self, now: float = None) -> None:
+    """Creates the directory and loads the rollups of today (if the controller ran earlier today)."""
+    if now is None:
+      now = time.time()
+    os.makedirs(self.directory, exist_ok=True)
+    day = int(now // SECONDS_PER_DAY)
+    rollups = {}
+    tile_names = None
+    for resolution in RESOLUTIONS:
+      loaded = _read_rollup(self._path(day, resolution))
+      if loaded is not None and (tile_names is None or loaded[0] == tile_names):
+        tile_names, rollups[resolution] = loaded
+    if tile_names is not None and len(rollups) == len(RESOLUTIONS):
+      self._today = Day(day, list(tile_names), rollups)
+    else:
+      self._today = Day(day)
+
+  # Recording
+  def record_presence(self, tile_name: str, detected: bool, now: float) -> None:
+    """Records a presence change of the tile (at wall clock time now)."""
+    self._rollover(now)
+    ring = self._raw.get(tile_name)
+    if ring is None:
+      ring = self._raw[tile_name] = PresenceRing(self.raw_capacity)
+    ring.append(now, detected)
+    self.events += 1
+    day = self._today
+    row = day.row(tile_name)
+    if detected:
+      if tile_name not in self._since:
+        self._since[tile_name] = now
+        for rollup in day.rollups.values():
+          rollup.detections[row, int((now - day.start) // rollup.bucket_size)] += 1
+    else:
+      since = self._since.pop(tile_name, None)
+      if since is not None:
+        for rollup in day.rollups.values():
+          rollup.add_occupied(row, since - day.start, now - day.start)
+
+  def record_heartbeat(self, tile_name: str, now: float) -> None:
+    """Records a heartbeat (system state) of the tile."""
+    self._rollover(now)
+    self.heartbeats += 1
+    day = self._today
+    row = day.row(tile_name)
+    for rollup in day.rollups.values():
+      rollup.heartbeats[row, int((now - day.start) // rollup.bucket_size)] += 1
+
+  def _rollover(self, now: float) -> None:
+    """Starts a new day when the day is over (the day that is over is written to disk)."""
+    day = int(now // SECONDS_PER_DAY)
+    if day <= self._today.day:
+      return
+    previous = self._today
+    # Presence that is still detected counts till the end of the day, and continues the next day
+    end = (previous.day + 1) * SECONDS_PER_DAY
+    for tile_name, since in self._since.items():
+      for rollup in previous.rollups.values():
+        rollup.add_occupied(previous.row(tile_name), since - previous.start, end - previous.start)
+      self._since[tile_name] = max(since, day * SECONDS_PER_DAY)
+    self._today = Day(day)
+    # Write the day that is over (it doesn't change anymore, no copy needed)
+    task = asyncio.get_running_loop().create_task(self._write(previous, previous.tile_names, previous.rollups))
+    self._writes.add(task)
+    task.add_done_callback(self._writes.discard)
+
+  # Writing
+  async def flush(self) -> None:
+    """Writes the rollups of today to disk (in a worker thread, from a copy)."""
+    day = self._today
+    await self._write(day, list(day.tile_names), {resolution: rollup.copy() for resolution, rollup in day.rollups.items()})
+
+  async def run(self, interval: float) -> None:
+    """Flushes every `interval` seconds (until cancelled)."""
+    while True:
+      await asyncio.sleep(interval)
+      self._rollover(time.time())
+      await self.flush()
+
+  async def _write(self, day: Day, tile_names: list[str], rollups: dict[str, Rollup]) -> None:
+    try:
+      await asyncio.to_thread(self._write_files, day.day, tile_names, rollups)
+    except OSError as e:
+      logger.error("Failed to write presence rollups of day " + str(day.day) + ": " + str(e))
+      return
+    self.flushes += 1
+    # Forget the cached (older) version of the day
+    for cache in self._cache.values():
+      cache.pop(day.day, None)
+
+  def _write_files(self, day: int, tile_names: list[str], rollups: dict[str, Rollup]) -> None:
+    """Writes the rollups of the day (runs in a worker thread), and deletes minute rollups that are too old."""
+    for resolution, rollup in rollups.items():
+      path = self._path(day, resolution)
+      # Write to a temporary file first, so a crash never leaves a half written file behind
+      temporary = path + ".tmp.npz"
+      np.savez_compressed(temporary, tile_names=np.array(tile_names, dtype=np.str_), **{column: getattr(rollup, column)[:len(tile_names)] for column in Rollup.COLUMNS})
+      os.replace(temporary, path)
+    for name in os.listdir(self.directory):
+      parts = name.split(".")
+      if len(parts) == 3 and parts[1] == "minute" and parts[0].isdigit() and int(parts[0]) < day - self.minute_retention:
+        os.remove(os.path.join(self.directory, name))
+
+  def _path(self, day: int, resolution: str) -> str:
+    return os.path.join(self.directory, str(day) + "." + resolution + ".npz")
+
+  # Querying
+  async def query(self, tile_names: list[str], start: float, end: float, resolution: str, now: float = None) -> dict:
+    """Returns the rollups of the given tiles (summed) per bucket between start and end (wall clock times).
+
+    Raises a ValueError if the resolution is unknown or the range has too many buckets."""
+    if now is None:
+      now = time.time()
+    if resolution not in RESOLUTIONS:
+      raise ValueError("Unknown resolution: " + resolution)
+    size = RESOLUTIONS[resolution]
+    first = int(start // size)
+    last = int(np.ceil(end / size))
+    if last - first > MAX_BUCKETS:
+      raise ValueError("Too many buckets: " + str(last - first) + " (maximum " + str(MAX_BUCKETS) + ")")
+    selected = set(tile_names)
+    series = {column: np.zeros(max(0, last - first), dtype=np.float64) for column in Rollup.COLUMNS}
+    buckets_per_day = SECONDS_PER_DAY // size
+    for day in range(first // buckets_per_day, (last - 1) // buckets_per_day + 1):
+      if day == self._today.day:
+        tile_order, rollup = self._today.tile_names, self._today.rollups[resolution]
+      else:
+        loaded = await self._load(day, resolution)
+        if loaded is None:
+          continue
+        tile_order, rollup = loaded
+      rows = [row for row, tile_name in enumerate(tile_order) if tile_name in selected]
+      if len(rows) == len(tile_order):
+        # All tiles of the day, a slice doesn't copy the rows
+        rows = slice(0, len(tile_order))
+      # Buckets of this day in the query (in buckets since the start of the day)
+      day_first = max(first - day * buckets_per_day, 0)
+      day_last = min(last - day * buckets_per_day, buckets_per_day)
+      offset = day * buckets_per_day + day_first - first
+      for column in Rollup.COLUMNS:
+        series[column][offset:offset + day_last - day_first] += getattr(rollup, column)[rows, day_first:day_last].sum(axis=0)
+    # Presence that is still detected counts till now
+    for tile_name in selected:
+      since = self._since.get(tile_name)
+      if since is not None:
+        _distribute(series["occupied"], size, max(since, first * size) - first * size, min(now, last * size) - first * size)
+    return {
+      "resolution": resolution,
+      "buckets": [(first + i) * size for i in range(last - first)],
+      "occupied": series["occupied"].round(3).tolist(),
+      "detections": series["detections"].astype(np.int64).tolist(),
+      "heartbeats": series["heartbeats"].astype(np.int64).tolist(),
+      "totals": {
+        "occupied": round(float(series["occupied"].sum()), 3),
+        "detections": int(series["detections"].sum()),
+        "heartbeats": int(series["heartbeats"].sum())
+      }
+    }
+
+  def query_events(self, tile_names: list[str], start: float, end: float) -> list[list]:
+    """Returns the raw presence events (time, tile, detected) of the given tiles between start and end (the last MAX_EVENTS)."""
+    events = []
+    for tile_name in tile_names:
+      ring = self._raw.get(tile_name)
+      if ring is None:
+        continue
+      times, values = ring.range(start, end)
+      events.extend([t, tile_name, detected] for t, detected in zip(times.tolist(), values.tolist()))
+    events.sort(key=lambda event: event[0])
+    return events[-MAX_EVENTS:]
+
+  async def _load(self, day: int, resolution: str) -> tuple[list[str], Rollup] | None:
+    """Returns the rollup of a past day (from the cache or from disk), None if there is none."""
+    cache = self._cache[resolution]
+    if day in cache:
+      cache.move_to_end(day)
+      return cache[day]
+    loaded = await asyncio.to_thread(_read_rollup, self._path(day, resolution))
+    if loaded is None:
+      return None
+    cache[day] = loaded
+    if len(cache) > self._cache_days[resolution]:
+      cache.popitem(last=False)
+    return loaded
+
+  def to_dict(self) -> dict:
+    return {
+      "tiles": len(self._today.tile_names),
+      "detected": len(self._since),
+      "events": self.events,
+      "heartbeats": self.heartbeats,
+      "flushes": self.flushes,
+      "cached_days": {resolution: len(cache) for resolution, cache in self._cache.items()}
+    }
+
+def _read_rollup(path: str) -> tuple[list[str], Rollup] | None:
+  """Reads the tile names and rollup of a day file, None if there is no (valid) file."""
+  try:
+    with np.load(path) as data:
+      tile_names = data["tile_names"].tolist()
+      rollup = Rollup(SECONDS_PER_DAY // data["occupied"].shape[1])
+      for column in Rollup.COLUMNS:
+        setattr(rollup, column, data[column])
+  except (OSError, KeyError, ValueError):
+    return None
+  return tile_names, rollup
@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+class _Sampler(threading.Thread):
+  """Samples the stack of a thread at a fixed interval (from a thread of its own, so it also sees a busy event loop)."""
+  def __init__(self, thread_id: int, interval: float):
+    super().__init__(name="profiler", daemon=True)
+    self.thread_id: int = thread_id # Thread that is sampled
+    self.interval: float = interval # Seconds between samples
+    self.stacks: Counter = Counter() # Stack (functions from the root to the leaf) -> amount of samples
+    self.samples: int = 0
+    self._stop_event: threading.Event = threading.Event()
+
+  def run(self) -> None:
+    while not self._stop_event.wait(self.interval):
+      frame = sys._current_frames().get(self.thread_id)
+      if frame is None:
+        return
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+      stack.reverse()
+      self.stacks[tuple(stack)] += 1
+      self.samples += 1
+
+  def stop(self) -> None:
+    self._stop_event.set()
+
+class Profiler:
+  """Profiles the running controller for a window of time: a sampling CPU profile of the event loop
+  thread and the allocations (tracemalloc) made in the window.
+
+  Sampling costs little (a stack walk every interval), and tracemalloc only runs during the window,
+  so profiling can be done on a live controller. One profile runs at a time."""
+  # Constructor
+  def __init__(self, directory: str = None, interval: float = 0.005, max_duration: float = 60.0):
+    self.directory: str = directory # Directory profile files are written to (None = don't write files)
+    self.interval: float = interval # Seconds between CPU samples
+    self.max_duration: float = max_duration # Maximum seconds of a window
+    self._stop_event: asyncio.Event = None # Set to end the running window early (None = not running)
+    self.profiles: int = 0 # Amount of finished profiles
+
+  @property
+  def running(self) -> bool:
+    return self._stop_event is not None
+
+  def stop(self) -> bool:
+    """Ends the running window early. Returns false if no profile is running."""
+    if self._stop_event is None:
+      return False
+    self._stop_event.set()
+    return True
+
+  async def profile(self, duration: float, cpu: bool = True, memory: bool = True, top: int = 20, write_files: bool = False) -> dict:
+    """Profiles the event loop thread for `duration` seconds (or till stop), returns the top functions and allocation sites.
+
+    Raises a RuntimeError if a profile is already running."""
+    if self.running:
+      raise RuntimeError("A profile is already running")
+    duration = min(max(float(duration), 0.1), self.max_duration)
+    self._stop_event = asyncio.Event()
+    sampler = None
+    started_tracing = False
+    before = None
+    try:
+      if memory:
+        # Only trace during the window (unless something else is tracing already)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+          tracemalloc.start()
+        else:
+          before = tracemalloc.take_snapshot()
+      if cpu:
+        sampler = _Sampler(threading.get_ident(), self.interval)
+        sampler.start()
+      logger.info("Profiling for " + str(duration) + " seconds")
+      started = time.monotonic()
+      try:
+        await asyncio.wait_for(self._stop_event.wait(), duration)
+      except asyncio.TimeoutError:
+        pass
+      elapsed = time.monotonic() - started
+      if sampler is not None:
+        sampler.stop()
+        await asyncio.to_thread(sampler.join)
+      snapshot = tracemalloc.take_snapshot() if memory else None
+    finally:
+      if started_tracing:
+        tracemalloc.stop()
+      if sampler is not None:
+        sampler.stop()
+      self._stop_event = None
+    self.profiles += 1
+
+    result = {"duration": elapsed}
+    if cpu:
+      result["cpu"] = _summarize_stacks(sampler.stacks, sampler.samples, top)
+    if memory:
+      # Leave out the allocations of the profiling itself
+      filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+      snapshot = snapshot.filter_traces(filters)
+      result["memory"] = _summarize_allocations(snapshot, before.filter_traces(filters) if before is not None else None, top)
+    if write_files and self.directory is not None:
+      result["files"] = await asyncio.to_thread(self._write_files, sampler.stacks if cpu else None, snapshot)
+    return result
+
+  def to_dict(self) -> dict:
+    return {
+      "running": self.running,
+      "profiles": self.profiles
+    }
+
+  def _write_files(self, stacks: Counter | None, snapshot: tracemalloc.Snapshot | None) -> list[str]:
+    """Writes the stacks in collapsed format (for flame graph tools) and the allocation snapshot (runs in a worker thread)."""
+    os.makedirs(self.directory, exist_ok=True)
+    name = os.path.join(self.directory, "profile-" + time.strftime("%Y%m%d-%H%M%S"))
+    files = []
+    if stacks is not None:
+      with open(name + ".folded", "w") as file:
+        for stack, count in stacks.items():
+          file.write(";".join(_format_function(function) for function in stack) + " " + str(count) + "\n")
+      files.append(name + ".folded")
+    if snapshot is not None:
+      # Load with tracemalloc.Snapshot.load()
+      snapshot.dump(name + ".tracemalloc")
+      files.append(name + ".tracemalloc")
+    return files
+
+def _format_function(function: tuple[str, int, str]) -> str:
+  filename, line, name = function
+  return name + " (" + os.path.basename(filename) + ":" + str(line) + ")"
+
+def _summarize_stacks(stacks: Counter, samples: int, top: int) -> dict:
+  """Returns the functions with the most samples: on top of the stack (self) and anywhere in the stack (total)."""
+  own = Counter()
+  total = Counter()
+  for stack, count in stacks.items():
+    own[stack[-1]] += count
+    # A recursive function counts once per sample
+    for function in set(stack):
+      total[function] += count
+  percent = lambda count: round(count / samples * 100, 2) if samples > 0 else 0.0
+  return {
+    "samples": samples,
+    "self": [{"function": _format_function(function), "samples": count, "percent": percent(count)} for function, count in own.most_common(top)],
+    "total": [{"function": _format_function(function), "samples": count, "percent": percent(count)} for function, count in total.most_common(top)]
+  }
+
+def _summarize_allocations(snapshot: tracemalloc.Snapshot, before: tracemalloc.Snapshot | None, top: int) -> dict:
+  """Returns the allocation sites that grew the most during the window."""
+  if before is not None:
+    statistics = snapshot.compare_to(before, "lineno")
+    sites = [{"site": str(statistic.traceback), "size_kb": round(statistic.size_diff / 1024, 1), "count": statistic.count_diff} for statistic in statistics[:top]]
+  else:
+    # Tracing started with the window, everything that is traced was allocated in the window
+    statistics = snapshot.statistics("lineno")
+    sites = [{"site": str(statistic.traceback), "size_kb": round(statistic.size / 1024, 1), "count": statistic.count} for statistic in statistics[:top]]
+  return {
+    "traced_kb": round(sum(statistic.size for statistic in snapshot.statistics("filename")) / 1024, 1),
+    "sites": sites
+  }
@@ -0,0 +1,168 @@
+from tile import Tile
+from typing import Iterator
+from websockets.server import WebSocketServerProtocol
+
+class TileRegistry:
+  """Keeps track of all known tiles and the websockets that are subscribed to them.
+
+  Tiles are hashed by name, every channel is a set of websockets and every websocket
+  keeps a reverse index of the tiles it is subscribed to, so lookups, (un)subscribes
+  and disconnects don't depend on the size of the fleet."""
+  # Constructor
+  def __init__(self):
+    self._tiles: dict[str, Tile] = {} # Tile name -> tile
+    self._channel_tiles: set[WebSocketServerProtocol] = set() # Websockets that are subscribed to changes in the tile list
+    self._channel_states: dict[str, set[WebSocketServerProtocol]] = {} # Tile name -> websockets that are subscribed to the state of that tile
+    self._channel_deltas: dict[str, set[WebSocketServerProtocol]] = {} # Tile name -> websockets (of the state channel) that want light deltas
+    self._client_states: dict[WebSocketServerProtocol, set[str]] = {} # Websocket -> names of the tiles it is subscribed to
+    self._groups: dict[str, set[str]] = {} # Group id -> names of the tiles in the group
+    self._tile_groups: dict[str, set[str]] = {} # Tile name -> ids of the groups the tile is in
+
+  # Tiles
+  def __len__(self) -> int:
+    return len(self._tiles)
+
+  def __contains__(self, tile_name: str) -> bool:
+    return tile_name in self._tiles
+
+  def __iter__(self) -> Iterator[Tile]:
+    return iter(self._tiles.values())
+
+  @property
+  def tiles(self) -> list[Tile]:
+    return list(self._tiles.values())
+
+  def get(self, tile_name: str) -> Tile | None:
+    """Returns the tile with the given name, or None if it doesn't exist."""
+    return self._tiles.get(tile_name)
+
+  def add(self, tile: Tile) -> None:
+    """Adds a tile to the registry and creates its (empty) state channel."""
+    self._tiles[tile.device_name] = tile
+    self._channel_states.setdefault(tile.device_name, set())
+    self._channel_deltas.setdefault(tile.device_name, set())
+
+  # Groups
+  @property
+  def groups(self) -> dict[str, set[str]]:
+    return self._groups
+
+  def group_members(self, group_id: str) -> set[str]:
+    """Returns the names of the tiles in the given group (empty if the group doesn't exist)."""
+    return self._groups.get(group_id, set())
+
+  def tile_groups(self, tile_name: str) -> set[str]:
+    """Returns the ids of the groups the given tile is in."""
+    return self._tile_groups.get(tile_name, set())
+
+  def find_group(self, tile_names: set[str]) -> str | None:
+    """Returns the id of a group with exactly the given tiles, or None if there is no such group."""
+    for group_id, members in self._groups.items():
+      if members == tile_names:
+        return group_id
+    return None
+
+  def set_group(self, group_id: str, tile_names: set[str]) -> set[str]:
+    """Sets the tiles of the given group (creates the group if it doesn't exist).
+
+    Returns the names of the tiles that were added to or removed from the group."""
+    members = self._groups.get(group_id, set())
+    changed = members ^ tile_names
+    for tile_name in members - tile_names:
+      self._leave_group(group_id, tile_name)
+    for tile_name in tile_names - members:
+      self._tile_groups.setdefault(tile_name, set()).add(group_id)
+    self._groups[group_id] = set(tile_names)
+    return changed
+
+  def delete_group(self, group_id: str) -> set[str]:
+    """Deletes the given group.
+
+    Returns the names of the tiles that were in the group."""
+    members = self._groups.pop(group_id, set())
+    for tile_name in members:
+      self._leave_group(group_id, tile_name)
+    return members
+
+  def _leave_group(self, group_id: str, tile_name: str) -> None:
+    groups = self._tile_groups.get(tile_name)
+    if groups is not None:
+      groups.discard(group_id)
+      if not groups:
+        del self._tile_groups[tile_name]
+
+  # Tile list channel
+  @property
+  def tile_list_subscribers(self) -> set[WebSocketServerProtocol]:
+    return self._channel_tiles
+
+  def subscribe_tile_list(self, websocket: WebSocketServerProtocol) -> bool:
+    """Subscribes the websocket to changes in the tile list.
+
+    Returns false if the websocket was already subscribed."""
+    if websocket in self._channel_tiles:
+      return False
+    self._channel_tiles.add(websocket)
+    return True
+
+  def unsubscribe_tile_list(self, websocket: WebSocketServerProtocol) -> bool:
+    """Unsubscribes the websocket from changes in the tile list.
+
+    Returns false if the websocket wasn't subscribed."""
+    if websocket not in self._channel_tiles:
+      return False
+    self._channel_tiles.discard(websocket)
+    return True
+
+  # State channels
+  def state_subscribers(self, tile_name: str) -> set[WebSocketServerProtocol]:
+    """Returns the websockets that are subscribed to the state of the given tile."""
+    return self._channel_states.get(tile_name, set())
+
+  def delta_subscribers(self, tile_name: str) -> set[WebSocketServerProtocol]:
+    """Returns the websockets that want light deltas (instead of the full light state) of the given tile."""
+    return self._channel_deltas.get(tile_name, set())
+
+  def is_subscribed_to_state(self, websocket: WebSocketServerProtocol, tile_name: str) -> bool:
+    return tile_name in self._client_states.get(websocket, ())
+
+  def subscribe_state(self, websocket: WebSocketServerProtocol, tile_name: str, delta: bool = False) -> bool:
+    """Subscribes the websocket to the state of the given tile (with light deltas if delta is true).
+
+    Returns false if the tile doesn't exist or the websocket was already subscribed."""
+    channel = self._channel_states.get(tile_name)
+    if channel is None or websocket in channel:
+      return False
+    channel.add(websocket)
+    if delta:
+      self._channel_deltas[tile_name].add(websocket)
+    self._client_states.setdefault(websocket, set()).add(tile_name)
+    return True
+
+  def unsubscribe_state(self, websocket: WebSocketServerProtocol, tile_name: str) -> bool:
+    """Unsubscribes the websocket from the state of the given tile.
+
+    Returns false if the websocket wasn't subscribed."""
+    channel = self._channel_states.get(tile_name)
+    if channel is None or websocket not in channel:
+      return False
+    channel.discard(websocket)
+    self._channel_deltas[tile_name].discard(websocket)
+    subscriptions = self._client_states.get(websocket)
+    if subscriptions is not None:
+      subscriptions.discard(tile_name)
+      if not subscriptions:
+        del self._client_states[websocket]
+    return True
+
+  # Clients
+  def remove_client(self, websocket: WebSocketServerProtocol) -> None:
+    """Removes the websocket from all channels it is subscribed to.
+
+    Only the channels of this websocket are visited (via the reverse index)."""
+    self._channel_tiles.discard(websocket)
+    for tile_name in self._client_states.pop(websocket, ()):
+      channel = self._channel_states.get(tile_name)
+      if channel is not None:
+        channel.discard(websocket)
+        self._channel_deltas[tile_name].discard(websocket)
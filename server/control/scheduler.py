@@ -0,0 +1,116 @@
+import math
+import asyncio
+import logging
+from collections import deque
+from typing import Callable
+from metrics import Histogram
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+LATENESS_BOUNDS: list[float] = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25] # Upper bounds (in seconds) of the buckets of the tick lateness
+
+class FrameScheduler:
+  """Calls the frame callbacks at a fixed rate (fps), on the monotonic clock of the event loop.
+
+  Ticks are planned on deadlines (start + n / fps), so they don't drift. When a tick is more
+  than a frame late, the missed frames are skipped (and counted) instead of being run back to back.
+  The scheduler only runs while there is work: wake() starts it, and it stops when none of
+  the callbacks returned true (more frames wanted)."""
+  # Constructor
+  def __init__(self, fps: float = 30.0, window: float = 5.0, lateness: Histogram = None):
+    self.fps: float = fps
+    self._callbacks: list[Callable[[float], bool]] = []
+    self._task: asyncio.Task = None
+    self._tick_times: deque = deque() # Times of the ticks of the last `window` seconds
+    self._window: float = window
+    self.ticks: int = 0 # Amount of ticks
+    self.skipped: int = 0 # Amount of frames skipped because the scheduler was behind
+    self.lateness: Histogram = lateness if lateness is not None else Histogram(LATENESS_BOUNDS) # How late the ticks were (in seconds)
+
+  @property
+  def running(self) -> bool:
+    return self._task is not None and not self._task.done()
+
+  @property
+  def interval(self) -> float:
+    return 1 / self.fps
+
+  def add_callback(self, callback: Callable[[float], bool]) -> None:
+    """Adds a callback that is called every tick with the deadline of the frame.
+
+    The callback returns true if it wants the next frame too."""
+    self._callbacks.append(callback)
+
+  def wake(self) -> None:
+    """Starts ticking (if not ticking already), the first tick is right away."""
+    if not self.running:
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self) -> None:
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+
+  def achieved_fps(self, now: float = None) -> float:
+    """Returns the amount of ticks per second over the ticks of the last `window` seconds (0 if less than 2 ticks)."""
+    if now is None:
+      now = asyncio.get_running_loop().time()
+    self._forget_ticks(now)
+    if len(self._tick_times) < 2 or self._tick_times[-1] == self._tick_times[0]:
+      return 0.0
+    return (len(self._tick_times) - 1) / (self._tick_times[-1] - self._tick_times[0])
+
+  def to_dict(self) -> dict:
+    return {
+      "fps": self.fps,
+      "achieved_fps": self.achieved_fps(),
+      "running": self.running,
+      "ticks": self.ticks,
+      "skipped": self.skipped,
+      "lateness": self.lateness.to_dict()
+    }
+
+  def _forget_ticks(self, now: float) -> None:
+    while len(self._tick_times) > 0 and self._tick_times[0] < now - self._window:
+      self._tick_times.popleft()
+
+  async def _run(self) -> None:
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    frame = 0
+    while True:
+      deadline = start + frame * self.interval
+      delay = deadline - loop.time()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      now = loop.time()
+      lateness = max(0.0, now - deadline)
+      # More than a frame late: skip the missed frames (the next deadline is in the future again)
+      if lateness >= self.interval:
+        missed = math.floor(lateness / self.interval)
+        self.skipped += missed
+        frame += missed
+        deadline = start + frame * self.interval
+        lateness = now - deadline
+      self.lateness.observe(lateness)
+      self.ticks += 1
+      self._tick_times.append(now)
+      self._forget_ticks(now)
+      # Call the callbacks, stop ticking when none of them wants another frame
+      more = False
+      for callback in self._callbacks:
+        try:
+          more = callback(deadline) or more
+        except Exception as e:
+          # Never let one bad callback stop the other callbacks
+          logger.error("Frame callback failed: " + str(e))
+      if not more:
+        return
+      frame += 1
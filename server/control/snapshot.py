@@ -0,0 +1,158 @@
+import json
+import time
+import struct
+import sqlite3
+import asyncio
+import logging
+from tile import Tile, StateType
+from registry import TileRegistry
+from lightframe import encode_light_frame
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# States that are saved (the online state isn't, a loaded tile is offline till the broker says otherwise)
+SAVED_STATE_TYPES: list[StateType] = [StateType.SYSTEM, StateType.AUDIO, StateType.LIGHT, StateType.PRESENCE]
+
+class RegistrySnapshot:
+  """Saves the tiles and groups of the registry to a SQLite database, so a restarted controller starts warm.
+
+  Only tiles whose state versions changed since the last save are saved. The changes are collected
+  on the event loop, in chunks (so messages are handled in between), and written in a worker thread,
+  in one transaction, so a crash while writing leaves the previous snapshot intact.
+  The light state is saved as a binary light frame."""
+  # Constructor
+  def __init__(self, path: str, chunk_size: int = 100):
+    self.path: str = path
+    self.chunk_size: int = chunk_size # Tiles collected before letting the event loop handle other work
+    self._db: sqlite3.Connection = None
+    self._lock: asyncio.Lock = asyncio.Lock() # Only one write at a time (the connection is used from worker threads)
+    self._saved_versions: dict[str, tuple[int, ...]] = {} # Tile name -> state versions that are in the database
+    self._saved_groups: dict[str, set[str]] = None # Groups that are in the database (None = unknown)
+    self.saves: int = 0 # Amount of writes
+    self.saved_tiles: int = 0 # Amount of tile rows written
+    self.last_duration: float = 0.0 # Seconds the last write took (in the worker thread)
+
+  def open(self) -> None:
+    """Opens (or creates) the database."""
+    self._db = sqlite3.connect(self.path, check_same_thread=False)
+    # Write ahead log: a write never leaves a half written snapshot behind, and is cheap
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    self._db.execute("CREATE TABLE IF NOT EXISTS tiles (name TEXT PRIMARY KEY, system TEXT, audio TEXT, light BLOB, presence TEXT)")
+    self._db.execute("CREATE TABLE IF NOT EXISTS groups (id TEXT PRIMARY KEY, tiles TEXT)")
+    self._db.commit()
+
+  def close(self) -> None:
+    if self._db is not None:
+      self._db.close()
+      self._db = None
+
+  def load(self, registry: TileRegistry) -> list[Tile]:
+    """Adds the saved tiles (that aren't in the registry yet) and groups to the registry.
+
+    Returns the loaded tiles."""
+    tiles = []
+    for name, system, audio, light, presence in self._db.execute("SELECT name, system, audio, light, presence FROM tiles"):
+      if name in registry:
+        continue
+      tile = Tile(name)
+      tile.update_state(StateType.SYSTEM, system)
+      tile.update_state(StateType.AUDIO, audio)
+      tile.update_state(StateType.LIGHT, bytes(light))
+      tile.update_state(StateType.PRESENCE, presence)
+      registry.add(tile)
+      self._saved_versions[name] = _get_versions(tile)
+      tiles.append(tile)
+    groups = {group_id: set(json.loads(tile_names)) for group_id, tile_names in self._db.execute("SELECT id, tiles FROM groups")}
+    for group_id, tile_names in groups.items():
+      registry.set_group(group_id, tile_names)
+    self._saved_groups = groups
+    logger.info("Loaded " + str(len(tiles)) + " tiles and " + str(len(groups)) + " groups from " + self.path)
+    return tiles
+
+  async def save(self, registry: TileRegistry) -> None:
+    """Saves the tiles that changed (and the groups, if they changed) since the last save."""
+    async with self._lock:
+      rows = []
+      versions = {}
+      tiles = registry.tiles
+      for start in range(0, len(tiles), self.chunk_size):
+        rows.extend(self._collect_tiles(tiles[start:start + self.chunk_size], versions))
+        await asyncio.sleep(0)
+      groups = self._collect_groups(registry)
+      if len(rows) == 0 and groups is None:
+        return
+      started = time.perf_counter()
+      try:
+        await asyncio.to_thread(self._write, rows, groups)
+      except sqlite3.Error as e:
+        # Nothing is marked as saved, so everything is written again on the next save
+        logger.error("Failed to save snapshot to " + self.path + ": " + str(e))
+        return
+      # Only what is in the database now is marked as saved
+      self._saved_versions.update(versions)
+      if groups is not None:
+        self._saved_groups = {group_id: set(tile_names) for group_id, tile_names in groups.items()}
+      self.last_duration = time.perf_counter() - started
+      self.saves += 1
+      self.saved_tiles += len(rows)
+
+  async def run(self, registry: TileRegistry, interval: float) -> None:
+    """Saves the changes every `interval` seconds (until cancelled)."""
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        await self.save(registry)
+      except Exception as e:
+        # Never let one failed save stop the snapshots
+        logger.error("Failed to save snapshot to " + self.path + ": " + str(e))
+
+  def to_dict(self) -> dict:
+    return {
+      "path": self.path,
+      "saves": self.saves,
+      "saved_tiles": self.saved_tiles,
+      "last_duration_ms": self.last_duration * 1000
+    }
+
+  def _collect_tiles(self, tiles: list[Tile], versions: dict[str, tuple[int, ...]]) -> list[tuple]:
+    """Returns the rows of the given tiles that changed (and adds their state versions to versions)."""
+    rows = []
+    for tile in tiles:
+      tile_versions = _get_versions(tile)
+      if self._saved_versions.get(tile.device_name) == tile_versions:
+        continue
+      try:
+        light = encode_light_frame(tile.brightness, tile.pixels)
+      except struct.error as e:
+        # E.g. a brightness the tile reported out of range, skip the tile (it's tried again on the next save)
+        logger.warning("Failed to save tile " + tile.device_name + " to snapshot: " + str(e))
+        continue
+      rows.append((
+        tile.device_name,
+        tile.get_state_json(StateType.SYSTEM),
+        tile.get_state_json(StateType.AUDIO),
+        light,
+        tile.get_state_json(StateType.PRESENCE)
+      ))
+      versions[tile.device_name] = tile_versions
+    return rows
+
+  def _collect_groups(self, registry: TileRegistry) -> dict[str, list[str]] | None:
+    """Returns the groups if they changed (None if not)."""
+    if registry.groups == self._saved_groups:
+      return None
+    return {group_id: sorted(tile_names) for group_id, tile_names in registry.groups.items()}
+
+  def _write(self, rows: list[tuple], groups: dict[str, list[str]] | None) -> None:
+    """Writes the rows (and groups) in one transaction (runs in a worker thread)."""
+    with self._db:
+      self._db.executemany("INSERT OR REPLACE INTO tiles (name, system, audio, light, presence) VALUES (?, ?, ?, ?, ?)", rows)
+      if groups is not None:
+        self._db.execute("DELETE FROM groups")
+        self._db.executemany("INSERT INTO groups (id, tiles) VALUES (?, ?)", [(group_id, json.dumps(tile_names)) for group_id, tile_names in groups.items()])
+
+def _get_versions(tile: Tile) -> tuple[int, ...]:
+  return tuple(tile.version(state_type) for state_type in SAVED_STATE_TYPES)
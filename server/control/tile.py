@@ -1,7 +1,8 @@
-from pixel import Pixel
+from pixel import Pixel, PixelBuffer
 from enum import Enum
 import json
 import logging
+from lightframe import decode_light_frame, decode_frame_trace
 
 # --- Configure Logging ---
 # Create a logger
@@ -33,13 +34,20 @@ class Tile:
     self._pinging: bool = False
     self._uptime: int = 0
     self._sounds: list[str] = []
+    self._features: list[str] = [] # Optional protocol features the tile supports (e.g. "groups")
     self._audio_state: int = 0
     self._audio_looping: bool = False
     self._audio_sound: str = ""
     self._audio_volume: int = 0
     self._brightness: int = 0
-    self._pixels: list[Pixel] = []
+    self._pixels: PixelBuffer = PixelBuffer()
     self._detected: bool = False
+    self._changed_pixels: list[int] = [] # Indices of the pixels that changed in the last light state update
+    self._trace: tuple[int, float] | None = None # Command id and seconds the tile took, echoed in the last state update (see take_trace)
+    # Version of each state section (increases every time the section changes)
+    self._versions: dict[StateType, int] = {state_type: 0 for state_type in StateType if state_type != StateType.FULL}
+    # Cached JSON of each state section, as (version, json) (only rebuilt when the version changed)
+    self._snapshots: dict[StateType, tuple[int, str]] = {}
 
   # Properties
   @property
@@ -66,6 +74,14 @@ class Tile:
   def sounds(self) -> list[str]:
     return self._sounds
   
+  @property
+  def features(self) -> list[str]:
+    return self._features
+
+  def supports(self, feature: str) -> bool:
+    """Returns true if the tile announced support for the given feature."""
+    return feature in self._features
+
   @property
   def audio_state(self) -> int:
     return self._audio_state
@@ -87,7 +103,7 @@ class Tile:
     return self._brightness
 
   @property
-  def pixels(self) -> list[Pixel]:
+  def pixels(self) -> PixelBuffer:
     return self._pixels
 
   @property
@@ -95,8 +111,29 @@ class Tile:
     return self._detected
   
   # Methods
-  def update_state(self, state_type: StateType, state: str) -> None:
-    """Set the state of the tile from a JSON string"""
+  def version(self, state_type: StateType) -> int:
+    """Get the version of a state section (the full state version increases when any section changes)"""
+    if state_type == StateType.FULL:
+      return sum(self._versions.values())
+    return self._versions[state_type]
+
+  def _changed(self, state_type: StateType) -> None:
+    """Mark a state section as changed (invalidates its cached snapshot)"""
+    self._versions[state_type] += 1
+
+  def take_trace(self) -> tuple[int, float] | None:
+    """Returns (and forgets) the command id and the seconds the tile took, if the last state update echoed a command"""
+    trace = self._trace
+    self._trace = None
+    return trace
+
+  def _read_trace(self, state_json: dict) -> None:
+    """Remembers the echoed command of a JSON state (tiles that support tracing add it to the state after a command)"""
+    if isinstance(state_json.get("id"), int):
+      self._trace = (state_json["id"], float(state_json.get("tile_time", 0.0)))
+
+  def update_state(self, state_type: StateType, state: str | bytes) -> None:
+    """Set the state of the tile from a JSON string (or a binary light frame)"""
     match state_type:
       case StateType.ONLINE:
         self.update_online_state(state)
@@ -105,7 +142,10 @@ class Tile:
       case StateType.AUDIO:
         self.update_audio_state(state)
       case StateType.LIGHT:
-        self.update_light_state(state)
+        if isinstance(state, str):
+          self.update_light_state(state)
+        else:
+          self.update_light_frame(state)
       case StateType.PRESENCE:
         self.update_presence_state(state)
       case _:
@@ -114,15 +154,18 @@ class Tile:
   def update_online_state(self, state: str) -> None:
     """Set the self state of the tile from a JSON string"""
     if state == "ONLINE":
-      self._online = True
+      online = True
       logger.info("Tile " + self.device_name + " is online")
     elif state == "OFFLINE":
-      self._online = False
+      online = False
       logger.info("Tile " + self.device_name + " is offline")
     else:
       # Invalid device state, ignore
       logger.warning("Tile " + self.device_name + " has invalid online state: " + state)
       return
+    if online != self._online:
+      self._online = online
+      self._changed(StateType.ONLINE)
     logger.info("Tile " + self.device_name + " online state updated")
 
   def update_system_state(self, state: str) -> None:
@@ -130,12 +173,24 @@ class Tile:
     try:
       # Convert JSON string to JSON object
       state_json: dict = json.loads(state)
+      self._read_trace(state_json)
       # System
-      self._firmware_version = str(state_json["firmware"])
-      self._hardware_version = str(state_json["hardware"])
-      self._pinging = bool(state_json["ping"])
-      self._uptime = int(state_json["uptime"])
-      self._sounds = list(map(str, state_json["sounds"]))
+      firmware_version = str(state_json["firmware"])
+      hardware_version = str(state_json["hardware"])
+      pinging = bool(state_json["ping"])
+      uptime = int(state_json["uptime"])
+      sounds = list(map(str, state_json["sounds"]))
+      # Features are optional (older firmware doesn't announce them)
+      features = list(map(str, state_json.get("features", [])))
+      # Only update (and change the version) if something changed
+      if (firmware_version, hardware_version, pinging, uptime, sounds, features) != (self._firmware_version, self._hardware_version, self._pinging, self._uptime, self._sounds, self._features):
+        self._firmware_version = firmware_version
+        self._hardware_version = hardware_version
+        self._pinging = pinging
+        self._uptime = uptime
+        self._sounds = sounds
+        self._features = features
+        self._changed(StateType.SYSTEM)
     except:
       # Invalid JSON string (missing keys, wrong types, etc.)
       pass
@@ -147,11 +202,19 @@ class Tile:
     try:
       # Convert JSON string to JSON object
       state_json: dict = json.loads(state)
+      self._read_trace(state_json)
       # Audio
-      self._audio_state = int(state_json["state"])
-      self._audio_looping = bool(state_json["looping"])
-      self._audio_sound = str(state_json["sound"])
-      self._audio_volume = int(state_json["volume"])
+      audio_state = int(state_json["state"])
+      audio_looping = bool(state_json["looping"])
+      audio_sound = str(state_json["sound"])
+      audio_volume = int(state_json["volume"])
+      # Only update (and change the version) if something changed
+      if (audio_state, audio_looping, audio_sound, audio_volume) != (self._audio_state, self._audio_looping, self._audio_sound, self._audio_volume):
+        self._audio_state = audio_state
+        self._audio_looping = audio_looping
+        self._audio_sound = audio_sound
+        self._audio_volume = audio_volume
+        self._changed(StateType.AUDIO)
     except:
       # Invalid JSON string (missing keys, wrong types, etc.)
       pass
@@ -163,31 +226,63 @@ class Tile:
     try:
       # Convert JSON string to JSON object
       state_json: dict = json.loads(state)
+      self._read_trace(state_json)
       # Light
-      self._brightness = int(state_json["brightness"])
+      brightness = int(state_json["brightness"])
       pixels = list(map(dict, state_json["pixels"]))
+      # Apply the values to a copy of the current pixels (missing values keep their current value)
+      new_pixels = self._pixels.copy()
+      new_pixels.resize(len(pixels))
       for i in range(len(pixels)):
-        # Add new pixels if needed
-        if i >= len(self._pixels):
-          self._pixels.append(Pixel())
-        # Update pixel
-        self._pixels[i].from_dict(pixels[i])
-      # Remove extra unused pixels
-      if len(self._pixels) > len(pixels):
-        self._pixels = self._pixels[:len(pixels)]
+        new_pixels[i].from_dict(pixels[i])
+      # Compare the whole buffer at once
+      changed_pixels = self._pixels.diff(new_pixels)
+      previous_length = len(self._pixels)
+      self._pixels = new_pixels
+      # Only change the version (and remember what changed) if something changed
+      if brightness != self._brightness or len(changed_pixels) > 0 or previous_length != len(self._pixels):
+        self._brightness = brightness
+        self._changed_pixels = changed_pixels
+        self._changed(StateType.LIGHT)
     except:
       # Invalid JSON string (missing keys, wrong types, etc.)
       pass
     else:
       logger.info("Tile " + self.device_name + " light state updated")
 
+  def update_light_frame(self, frame: bytes) -> None:
+    """Set the light state of the tile from a binary light frame"""
+    try:
+      brightness, pixel_bytes = decode_light_frame(frame)
+      self._trace = decode_frame_trace(frame)
+      if brightness is None:
+        brightness = self._brightness
+      # Copy the pixels straight from the frame (no intermediate dictionaries) and compare the whole buffer at once
+      new_pixels = PixelBuffer(data=pixel_bytes)
+      changed_pixels = self._pixels.diff(new_pixels)
+      previous_length = len(self._pixels)
+      self._pixels = new_pixels
+      # Only change the version (and remember what changed) if something changed
+      if brightness != self._brightness or len(changed_pixels) > 0 or previous_length != len(self._pixels):
+        self._brightness = brightness
+        self._changed_pixels = changed_pixels
+        self._changed(StateType.LIGHT)
+    except ValueError:
+      # Invalid light frame
+      pass
+    else:
+      logger.info("Tile " + self.device_name + " light state updated")
+
   def update_presence_state(self, state: str) -> None:
     """Set the presence state of the tile from a JSON string"""
     try:
       # Convert JSON string to JSON object
       state_json: dict = json.loads(state)
       # Detection
-      self._detected = bool(state_json["detected"])
+      detected = bool(state_json["detected"])
+      if detected != self._detected:
+        self._detected = detected
+        self._changed(StateType.PRESENCE)
     except:
       # Invalid JSON string (missing keys, wrong types, etc.)
       pass
@@ -213,6 +308,29 @@ class Tile:
         logger.error("Invalid state type")
         return ""
   
+  def get_state_json(self, state_type: StateType) -> str:
+    """Get the state of the tile as a compact JSON string
+
+    The JSON is cached per state section and only rebuilt when that section changed."""
+    version = self.version(state_type)
+    snapshot = self._snapshots.get(state_type)
+    if snapshot is not None and snapshot[0] == version:
+      return snapshot[1]
+    if state_type == StateType.FULL:
+      # Build the full state from the (cached) sections
+      state_json = (
+        '{"online":' + ("true" if self._online else "false")
+        + ',"system":' + self.get_state_json(StateType.SYSTEM)
+        + ',"audio":' + self.get_state_json(StateType.AUDIO)
+        + ',"light":' + self.get_state_json(StateType.LIGHT)
+        + ',"presence":' + self.get_state_json(StateType.PRESENCE)
+        + '}'
+      )
+    else:
+      state_json = json.dumps(self.get_state(state_type), separators=(",", ":"))
+    self._snapshots[state_type] = (version, state_json)
+    return state_json
+
   def get_online_state(self) -> dict:
     """Get the self state of the tile as a dictionary"""
     # Create a dictionary to hold the state
@@ -230,7 +348,8 @@ class Tile:
       "hardware": self._hardware_version,
       "ping": self._pinging,
       "uptime": self._uptime,
-      "sounds": self._sounds
+      "sounds": self._sounds,
+      "features": self._features
     }
     # Return the dictionary
     return state
@@ -249,18 +368,28 @@ class Tile:
   
   def get_light_state(self) -> dict:
     """Get the light state of the tile as a dictionary"""
-    # Convert the pixels to a list of dictionaries
-    pixels_dict: list[dict] = []
-    for pixel in self._pixels:
-      pixels_dict.append(pixel.to_dict())
     # Create a dictionary to hold the state
     state: dict = {
       "brightness": self._brightness,
-      "pixels": pixels_dict
+      "pixels": self._pixels.to_dicts()
     }
     # Return the dictionary
     return state
   
+  def get_light_delta(self) -> dict:
+    """Get the changes of the last light state update as a dictionary
+
+    Only contains the pixels that changed (by index), the version is the light state version after the change."""
+    # Create a dictionary to hold the changes
+    delta: dict = {
+      "version": self.version(StateType.LIGHT),
+      "brightness": self._brightness,
+      "length": len(self._pixels),
+      "pixels": {str(i): self._pixels[i].to_dict() for i in self._changed_pixels}
+    }
+    # Return the dictionary
+    return delta
+
   def get_presence_state(self) -> dict:
     """Get the presence state of the tile as a dictionary"""
     # Create a dictionary to hold the state
@@ -289,15 +418,7 @@ class Tile:
     if ping is None:
       ping = self._pinging
 
-    # Create a dictionary to hold the command
-    command: dict = {
-      "reboot": reboot,
-      "ping": ping
-    }
-
-    # Convert the dictionary to a JSON string
-    command_json: str = json.dumps(command)
-    return command_json
+    return create_system_command(reboot, ping)
   
   def create_audio_command(self, mode: int = None, looping: bool = None, sound: str = None, volume: int = None):
     """Create a command to send to the tile to change the audio state"""
@@ -311,38 +432,58 @@ class Tile:
       sound = self._audio_sound
     if volume is None:
       volume = self._audio_volume
-    
-    # Create a dictionary to hold the command
-    command: dict = {
-      "mode": mode,
-      "loop": looping,
-      "sound": sound,
-      "volume": volume
-    }
-
-    # Convert the dictionary to a JSON string
-    command_json: str = json.dumps(command)
-    return command_json
+    return create_audio_command(mode, looping, sound, volume)
 
-  def create_light_command(self, brightness: int = None, pixels: list[Pixel] = None):
+  def create_light_command(self, brightness: int = None, pixels: PixelBuffer = None):
     """Create a command to send to the tile to change the light state"""
     # Replace None values with the current state
     if brightness is None:
       brightness = self._brightness
     if pixels is None:
       pixels = self._pixels
+    return create_light_command(brightness, pixels)
 
-    # Convert the pixels to a list of dictionaries
-    pixels_dict: list[dict] = []
-    for pixel in pixels:
-      pixels_dict.append(pixel.to_dict())
+# --- Commands ---
+# The payload of a command doesn't depend on the tile, so the same payload can be sent to a group of tiles
+def create_system_command(reboot: bool, ping: bool) -> str:
+  """Create a command to change the system state"""
+  # Create a dictionary to hold the command
+  command: dict = {
+    "reboot": reboot,
+    "ping": ping
+  }
 
-    # Create a dictionary to hold the command
-    command: dict = {
-      "brightness": brightness,
-      "pixels": pixels_dict
-    }
+  # Convert the dictionary to a JSON string
+  command_json: str = json.dumps(command)
+  return command_json
+
+def create_audio_command(mode: int, looping: bool, sound: str, volume: int) -> str:
+  """Create a command to change the audio state"""
+  # Create a dictionary to hold the command
+  command: dict = {
+    "mode": mode,
+    "loop": looping,
+    "sound": sound,
+    "volume": volume
+  }
+
+  # Convert the dictionary to a JSON string
+  command_json: str = json.dumps(command)
+  return command_json
+
+def create_light_command(brightness: int | None, pixels: PixelBuffer) -> str:
+  """Create a command to change the light state
+
+  Pixels that aren't given keep their current value, brightness None keeps the current brightness
+  (only tiles that support group topics understand a command without brightness)."""
+  # Create a dictionary to hold the command
+  command: dict = {
+    "brightness": brightness,
+    "pixels": pixels.to_dicts()
+  }
+  if brightness is None:
+    del command["brightness"]
 
-    # Convert the dictionary to a JSON string
-    command_json: str = json.dumps(command)
-    return command_json
+  # Convert the dictionary to a JSON string
+  command_json: str = json.dumps(command)
+  return command_json
@@ -0,0 +1,138 @@
+import itertools
+import logging
+from collections import OrderedDict
+from metrics import Histogram, MetricFamily
+
+# --- Configure Logging ---
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# --- Constants ---
+TRACE_FEATURE: str = "trace" # Feature a tile announces (in its system state) when it echoes the id of a command in its next state
+# Stages of a traced command (seconds):
+# controller: websocket message received -> command published (includes waiting for the next frame of light commands)
+# broker: command published -> state received, minus the time the tile took (both ways through the broker)
+# tile: command received by the tile -> state published by the tile (measured by the tile)
+# fanout: state received -> state queued for the websockets
+# total: websocket message received -> state queued for the websockets
+STAGES: list[str] = ["controller", "broker", "tile", "fanout", "total"]
+
+def add_trace_id(command: str, trace_id: int) -> str:
+  """Adds the trace id to a JSON command (an object), without parsing it again."""
+  return command[:command.rindex("}")] + ', "id": ' + str(trace_id) + "}"
+
+class CommandTrace:
+  """A command that is on its way to the tiles."""
+  __slots__ = ("id", "type", "received", "published", "pending")
+
+  def __init__(self, trace_id: int, type: str, received: float, tile_names: set[str]):
+    self.id: int = trace_id
+    self.type: str = type # Command type (system, audio, light)
+    self.received: float = received # Time the command was received from the websocket (time.monotonic())
+    self.published: float = None # Time the command was published (time.monotonic(), the first publish)
+    self.pending: set[str] = tile_names # Tiles that didn't echo the command yet
+
+class CommandTracer:
+  """Traces commands from the websocket to the tiles and back, with the time of every stage.
+
+  A command gets an id that is sent along with the command (to tiles that support TRACE_FEATURE)
+  and echoed by the tiles in their next state, with the time the tile took. The stages are
+  recorded per command type and the total per tile. Commands of which not all tiles answered
+  within the timeout are forgotten (and counted)."""
+  # Constructor
+  def __init__(self, timeout: float = 10.0, max_pending: int = 10000, stage_metric: MetricFamily = None):
+    self.timeout: float = timeout # Seconds to wait for all tiles to echo a command
+    self.max_pending: int = max_pending # Maximum amount of traced commands on their way (the oldest is forgotten)
+    self._ids = itertools.count(1)
+    self._pending: OrderedDict[int, CommandTrace] = OrderedDict() # Trace id -> trace (oldest first)
+    self._stage_metric: MetricFamily = stage_metric # Histograms per command type and stage (labels type, stage), shared with the metrics
+    self.stages: dict[str, dict[str, Histogram]] = {} # Command type -> stage -> histogram
+    self.tiles: dict[str, Histogram] = {} # Tile name -> histogram of the total time
+    self.started: int = 0 # Traced commands
+    self.completed: int = 0 # Traced commands all tiles echoed
+    self.echoes: int = 0 # Echoes of tiles that were matched to a command
+    self.unmatched: int = 0 # Echoes that didn't match a command (e.g. too late, or from before a restart)
+    self.timeouts: int = 0 # Tiles that didn't echo a command in time
+    self.cancelled: int = 0 # Traced commands that were never sent (e.g. replaced by a newer light command)
+
+  def start(self, type: str, tile_names: list[str], received: float) -> int | None:
+    """Starts tracing a command to the given tiles (that support tracing), returns the trace id (None if no tiles)."""
+    self._expire(received)
+    if len(tile_names) == 0:
+      return None
+    # Ids fit in 32 bits (light frames)
+    trace_id = next(self._ids) & 0xFFFFFFFF
+    self._pending[trace_id] = CommandTrace(trace_id, type, received, set(tile_names))
+    self.started += 1
+    if len(self._pending) > self.max_pending:
+      _, trace = self._pending.popitem(last=False)
+      self.timeouts += len(trace.pending)
+    return trace_id
+
+  def published(self, trace_id: int, now: float) -> None:
+    """Records the time the command was published (the first publish counts)."""
+    trace = self._pending.get(trace_id)
+    if trace is not None and trace.published is None:
+      trace.published = now
+
+  def cancel(self, trace_id: int) -> None:
+    """Forgets a command that won't be sent."""
+    if self._pending.pop(trace_id, None) is not None:
+      self.cancelled += 1
+
+  def complete(self, tile_name: str, trace_id: int, tile_time: float, state_received: float, fanned_out: float) -> None:
+    """Records the echo of a command by a tile: the state was received at state_received and fanned out at fanned_out."""
+    trace = self._pending.get(trace_id)
+    if trace is None or trace.published is None or tile_name not in trace.pending:
+      self.unmatched += 1
+      return
+    self.echoes += 1
+    round_trip = max(state_received - trace.published, 0.0)
+    tile_time = min(max(tile_time, 0.0), round_trip)
+    stages = self.stages.get(trace.type)
+    if stages is None:
+      stages = self.stages[trace.type] = {stage: self._create_histogram(trace.type, stage) for stage in STAGES}
+    stages["controller"].observe(trace.published - trace.received)
+    stages["broker"].observe(round_trip - tile_time)
+    stages["tile"].observe(tile_time)
+    stages["fanout"].observe(fanned_out - state_received)
+    stages["total"].observe(fanned_out - trace.received)
+    histogram = self.tiles.get(tile_name)
+    if histogram is None:
+      histogram = self.tiles[tile_name] = Histogram()
+    histogram.observe(fanned_out - trace.received)
+    trace.pending.discard(tile_name)
+    if len(trace.pending) == 0:
+      del self._pending[trace_id]
+      self.completed += 1
+
+  def to_dict(self) -> dict:
+    return {
+      "pending": len(self._pending),
+      "started": self.started,
+      "completed": self.completed,
+      "echoes": self.echoes,
+      "unmatched": self.unmatched,
+      "timeouts": self.timeouts,
+      "cancelled": self.cancelled,
+      "types": {type: {stage: histogram.to_dict() for stage, histogram in stages.items()} for type, stages in self.stages.items()}
+    }
+
+  def tiles_to_dict(self, tile_names: list[str]) -> dict:
+    """Returns the total time histograms of the given tiles (tiles without traced commands are left out)."""
+    return {tile_name: self.tiles[tile_name].to_dict() for tile_name in tile_names if tile_name in self.tiles}
+
+  def _create_histogram(self, type: str, stage: str) -> Histogram:
+    if self._stage_metric is not None:
+      return self._stage_metric.labels(type, stage)
+    return Histogram()
+
+  def _expire(self, now: float) -> None:
+    """Forgets the commands that are older than the timeout (oldest first, so it stops at the first that isn't)."""
+    while len(self._pending) > 0:
+      trace = next(iter(self._pending.values()))
+      if now - trace.received < self.timeout:
+        return
+      self._pending.popitem(last=False)
+      self.timeouts += len(trace.pending)
+      logger.info("Command " + str(trace.id) + " (" + trace.type + ") wasn't echoed by " + str(len(trace.pending)) + " tiles in time")